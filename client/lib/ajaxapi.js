@@ -1,6 +1,11 @@
 /*jslint nomen: true, plusplus: true, browser:true, todo:true */
 /*global module, require, window, Promise */
 require('es6-promise').polyfill();
+var COLUMNAR_CONTENT_TYPE = require('./columnar.js').COLUMNAR_CONTENT_TYPE;
+var unpack_columns = require('./columnar.js').unpack_columns;
+
+// Ask for lists packed into columns where the server can, plain JSON otherwise
+var JSON_ACCEPT = COLUMNAR_CONTENT_TYPE + ", application/json;q=0.9";
 
 /**
   * Promise-based AJAX API wrapping jQuery
@@ -22,7 +27,7 @@ module.exports = function AjaxApi(jqAjax) {
     this.getJson = function (url, extras) {
         return this.ajax({
             type: 'GET',
-            headers: { accept: "application/json" },
+            headers: { accept: JSON_ACCEPT },
             url: url
         }, extras).then(function (data) {
             if (typeof data !== 'object') {
@@ -38,7 +43,7 @@ module.exports = function AjaxApi(jqAjax) {
             data: JSON.stringify(data),
             contentType: 'application/json',
             type: 'POST',
-            headers: { accept: "application/json" },
+            headers: { accept: JSON_ACCEPT },
             url: url
         }, extras).then(function (data) {
             if (typeof data !== 'object') {
@@ -61,7 +66,10 @@ module.exports = function AjaxApi(jqAjax) {
                 reject(new Error("tutorweb::neterror::Currently offline"));
             }
 
-            jqAjax(args).then(function (data) {
+            jqAjax(args).then(function (data, textStatus, jqXHR) {
+                if (jqXHR && (jqXHR.getResponseHeader('Content-Type') || '').indexOf(COLUMNAR_CONTENT_TYPE) === 0) {
+                    data = unpack_columns(data);
+                }
                 resolve(data);
             }).fail(function (jqXHR, textStatus, errorThrown) {
                 var err;
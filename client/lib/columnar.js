@@ -0,0 +1,36 @@
+"use strict";
+/*jslint todo: true, regexp: true, nomen: true */
+
+/** Content-type the server uses for responses with lists of objects packed into columns */
+module.exports.COLUMNAR_CONTENT_TYPE = 'application/vnd.tutorweb.columnar+json';
+
+/**
+  * Undo the server's pack_columns, i.e. turn any {_columns: [a, b], _values: [[1, 3], [2, 4]]}
+  * back into [{a: 1, b: 2}, {a: 3, b: 4}]
+  */
+module.exports.unpack_columns = function unpack_columns(value) {
+    var out;
+
+    if (Array.isArray(value)) {
+        return value.map(unpack_columns);
+    }
+    if (value === null || typeof value !== 'object') {
+        return value;
+    }
+
+    if (Array.isArray(value._columns) && Array.isArray(value._values)) {
+        out = (value._values[0] || []).map(function () { return {}; });
+        value._columns.map(function (k, col_i) {
+            value._values[col_i].map(function (v, i) {
+                out[i][k] = unpack_columns(v);
+            });
+        });
+        return out;
+    }
+
+    out = {};
+    Object.keys(value).map(function (k) {
+        out[k] = unpack_columns(value[k]);
+    });
+    return out;
+};
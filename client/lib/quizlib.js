@@ -572,6 +572,43 @@ module.exports = function Quiz(rawLocalStorage, ajaxApi) {
         });
     }
 
+    // Apply promise-returning fn to values in batches of batchSize
+    function batchPromise(values, batchSize, fn) {
+        var p = Promise.resolve();
+
+        function batchFn(batch) {
+            return function () {
+                return Promise.all(batch.map(fn));
+            };
+        }
+
+        values = values.slice();
+        while (values.length > 0) {
+            p = p.then(batchFn(values.splice(0, batchSize)));
+        }
+        return p;
+    }
+
+    // Apply entries changed since last sync to the synced part of preQ, return queue of synced entries
+    function _deltaMerge(preQ, deltaQ) {
+        var byKey = {};
+
+        function key(a) {
+            return a.time_end + ':' + a.time_offset;
+        }
+
+        preQ.concat(deltaQ).map(function (a) {
+            if (a.synced) {
+                byKey[key(a)] = a;
+            }
+        });
+        return Object.keys(byKey).map(function (k) {
+            return byKey[k];
+        }).sort(function (a, b) {
+            return (a.time_end - b.time_end) || (a.time_offset - b.time_offset);
+        });
+    }
+
     /**
       * Sync the subscription table and everything within.
       * opts can contain:
@@ -587,22 +624,6 @@ module.exports = function Quiz(rawLocalStorage, ajaxApi) {
     this.syncSubscriptions = function (opts, progressFn) {
         var self = this;
 
-        // Apply promise-returning fn to values in batches of batchSize
-        function batchPromise(values, batchSize, fn) {
-            var p = Promise.resolve();
-
-            function batchFn(batch) {
-                return function () {
-                    return Promise.all(batch.map(fn));
-                };
-            }
-
-            while (values.length > 0) {
-                p = p.then(batchFn(values.splice(0, batchSize)));
-            }
-            return p;
-        }
-
         progressFn(3, 0, "Syncing subscriptions...");
         return Promise.resolve().then(function () {
             if (opts.lectureAdd) {
@@ -628,18 +649,16 @@ module.exports = function Quiz(rawLocalStorage, ajaxApi) {
                 opSucceeded = 0,
                 opTotal = lectureUris.length + 1;
 
-            return batchPromise(lectureUris, 6, function (uri) {
-                return self.syncLecture(uri, {
-                    ifMissing: 'fetch',
-                    syncForce: opts.syncForce,
-                    skipQuestions: false,
-                    skipCleanup: true,
-                }, function (lecSucceeded, lecTotal, message) {
-                    if (lecSucceeded === lecTotal) {
-                        opSucceeded = opSucceeded + 1;
-                    }
-                    progressFn(opTotal, opSucceeded, uri + ": " + message);
-                });
+            return self.syncLectures(lectureUris, {
+                ifMissing: 'fetch',
+                syncForce: opts.syncForce,
+                skipQuestions: false,
+                skipCleanup: true,
+            }, function (uri, lecSucceeded, lecTotal, message) {
+                if (lecSucceeded === lecTotal) {
+                    opSucceeded = opSucceeded + 1;
+                }
+                progressFn(opTotal, opSucceeded, uri + ": " + message);
             }).then(function () {
                 progressFn(opTotal - 1, opTotal, "Tidying up...");
                 return opts.skipCleanup ? null : self.removeUnusedObjects();
@@ -667,48 +686,146 @@ module.exports = function Quiz(rawLocalStorage, ajaxApi) {
             }
             progressFn(0, 3, "Fetching lecture...");
 
-            preSyncLecture.current_time = curTime();
-            return self.ajaxApi.postJson(preSyncLecture.uri, preSyncLecture, { timeout: 60 * 1000 }).then(function (newLecture) {
-                // Check it's for the same user
-                if (preSyncLecture.user && preSyncLecture.user !== newLecture.user) {
-                    throw new Error("tutorweb::error::You are trying to download a lecture as '" +
-                        newLecture.user + "', but you were logged in previously as '" +
-                        preSyncLecture.user + "'. Return to the menu and log out first.");
+            return self.ajaxApi.postJson(preSyncLecture.uri, self._syncBody(preSyncLecture), { timeout: 60 * 1000 }).then(function (newLecture) {
+                return self._syncApply(lecUri, preSyncLecture, newLecture, opts);
+            }).then(function (curLecture) {
+                return self._syncQuestions(lecUri, curLecture, opts, progressFn);
+            }).then(function () {
+                progressFn(2, 3, "Tidying up...");
+                return opts.skipCleanup ? null : self.removeUnusedObjects();
+            }).then(function () {
+                progressFn(3, 3, "Done");
+            });
+        });
+    };
+
+    /**
+      * Return promise that all (lecUris) are synced, sending up to 25 in each
+      * request to /api/stage/sync-many. opts are as syncLecture, progressFn
+      * gets the lecture URI as an extra first argument.
+      */
+    this.syncLectures = function (lecUris, opts, progressFn) {
+        var self = this;
+
+        return Promise.all(lecUris.map(function (lecUri) {
+            return self._getLecture(lecUri, opts.ifMissing === 'fetch');
+        })).then(function (preSyncLectures) {
+            var batches = [], toSync = [];
+
+            preSyncLectures.map(function (preSyncLecture, i) {
+                if (!opts.syncForce && preSyncLecture.hasOwnProperty('questions') && isSynced(preSyncLecture)) {
+                    // Nothing to do
+                    progressFn(lecUris[i], 3, 3, "Done");
+                    return;
                 }
+                toSync.push({ lecUri: lecUris[i], preSyncLecture: preSyncLecture });
+            });
+            while (toSync.length > 0) {
+                batches.push(toSync.splice(0, 25));
+            }
 
-                // Write out replacement lecture
-                return self._withLecture(lecUri, function (curLecture) {
-                    // Copy contents of newLec over curLec, since otherwise _withLecture won't update
-                    Object.keys(newLecture).map(function (k) {
-                        curLecture[k] = k === 'answerQueue'
-                            ? _queueMerge(preSyncLecture.answerQueue, curLecture.answerQueue, newLecture.answerQueue)
-                            : newLecture[k];
-                    });
-                    return newLecture;
-                }, opts.ifMissing === 'fetch');
-            }).then(function (curLecture) {
-                // Check if either we have no question bank yet, or we have missing questions
-                var missingQns = opts.forceQuestions || curLecture.questions.length === 0 || curLecture.questions.find(function (q) {
-                    return (self.ls.getItem(q.uri) === null);
+            return batchPromise(batches, 1, function (batch) {
+                batch.map(function (x) {
+                    progressFn(x.lecUri, 0, 3, "Fetching lecture...");
                 });
 
-                if (missingQns) {
-                    curLecture.question_uri = '/api/stage/material?path=' + encodeURIComponent(curLecture.path);
-                    progressFn(1, 3, "Fetching questions... ");
-                    return ajaxApi.getJson(curLecture.question_uri, {timeout: 60 * 1000}).then(function (data) {
-                        return self._withLecture(lecUri, function (curLecture) {
-                            curLecture.questions = data.stats;
-                            Object.keys(data.data).map(function (qnId) {
-                                self.ls.setItem(qnId, data.data[qnId]);
+                return self.ajaxApi.postJson('/api/stage/sync-many', {
+                    stages: batch.map(function (x) {
+                        return Object.assign({ path: x.preSyncLecture.path || x.preSyncLecture.uri }, self._syncBody(x.preSyncLecture));
+                    }),
+                }, { timeout: 60 * 1000 }).then(function (data) {
+                    var errors = [];
+
+                    // Apply everything that worked, then fail if anything didn't
+                    return batchPromise(batch.map(function (x, i) {
+                        return { lecUri: x.lecUri, preSyncLecture: x.preSyncLecture, newLecture: data.stages[i] };
+                    }), 6, function (x) {
+                        if (x.newLecture.error) {
+                            errors.push(new Error("tutorweb::error::" + x.newLecture.error.type + ": " +
+                                x.newLecture.error.message + " whilst syncing " + x.lecUri));
+                            return;
+                        }
+                        return self._syncApply(x.lecUri, x.preSyncLecture, x.newLecture, opts).then(function (curLecture) {
+                            return self._syncQuestions(x.lecUri, curLecture, opts, function (opSucceeded, opTotal, message) {
+                                progressFn(x.lecUri, opSucceeded, opTotal, message);
                             });
+                        }).then(function () {
+                            progressFn(x.lecUri, 3, 3, "Done");
                         });
+                    }).then(function () {
+                        if (errors.length > 0) {
+                            throw errors[0];
+                        }
                     });
-                }
+                });
             }).then(function () {
-                progressFn(2, 3, "Tidying up...");
                 return opts.skipCleanup ? null : self.removeUnusedObjects();
-            }).then(function () {
-                progressFn(3, 3, "Done");
+            });
+        });
+    };
+
+    /** Body to send to the server to sync (preSyncLecture) */
+    this._syncBody = function (preSyncLecture) {
+        preSyncLecture.current_time = curTime();
+        // Only send what the server hasn't seen, it will return what we haven't seen since sync_cursor
+        return Object.assign({}, preSyncLecture, {
+            answerQueue: preSyncLecture.answerQueue.filter(function (a) { return !a.synced; }),
+            sync_cursor: preSyncLecture.sync_cursor || null,
+        });
+    };
+
+    /** Promise to merge server response (newLecture) into what we have stored, returning the updated lecture */
+    this._syncApply = function (lecUri, preSyncLecture, newLecture, opts) {
+        var self = this;
+
+        // Check it's for the same user
+        if (preSyncLecture.user && preSyncLecture.user !== newLecture.user) {
+            return Promise.reject(new Error("tutorweb::error::You are trying to download a lecture as '" +
+                newLecture.user + "', but you were logged in previously as '" +
+                preSyncLecture.user + "'. Return to the menu and log out first."));
+        }
+
+        // Write out replacement lecture
+        return self._withLecture(lecUri, function (curLecture) {
+            var serverQ = newLecture.answerQueue;
+
+            if (newLecture.hasOwnProperty('sync_cursor')) {
+                // Server only sent changes, apply them to what we had
+                serverQ = _deltaMerge(preSyncLecture.answerQueue, newLecture.answerQueue);
+                if (String(serverQ.length) !== newLecture.sync_cursor.split(':').pop()) {
+                    // We don't agree with the server on queue length, get everything next time
+                    newLecture.sync_cursor = null;
+                }
+            }
+
+            // Copy contents of newLec over curLec, since otherwise _withLecture won't update
+            Object.keys(newLecture).map(function (k) {
+                curLecture[k] = k === 'answerQueue'
+                    ? _queueMerge(preSyncLecture.answerQueue, curLecture.answerQueue, serverQ)
+                    : newLecture[k];
+            });
+            return newLecture;
+        }, opts.ifMissing === 'fetch');
+    };
+
+    /** Promise to fetch question bank for lecture, if we have none or some are missing */
+    this._syncQuestions = function (lecUri, curLecture, opts, progressFn) {
+        var self = this,
+            missingQns = opts.forceQuestions || curLecture.questions.length === 0 || curLecture.questions.find(function (q) {
+                return (self.ls.getItem(q.uri) === null);
+            });
+
+        if (!missingQns) {
+            return Promise.resolve();
+        }
+        curLecture.question_uri = '/api/stage/material?path=' + encodeURIComponent(curLecture.path);
+        progressFn(1, 3, "Fetching questions... ");
+        return ajaxApi.getJson(curLecture.question_uri, {timeout: 60 * 1000}).then(function (data) {
+            return self._withLecture(lecUri, function (curLecture) {
+                curLecture.questions = data.stats;
+                Object.keys(data.data).map(function (qnId) {
+                    self.ls.setItem(qnId, data.data[qnId]);
+                });
             });
         });
     };
@@ -0,0 +1,35 @@
+"use strict";
+/*jslint nomen: true, plusplus: true*/
+var test = require('tape');
+
+var unpack_columns = require('../lib/columnar.js').unpack_columns;
+
+test('UnpackColumns', function (t) {
+    // Columns turn back into objects
+    t.deepEqual(unpack_columns({
+        _columns: ['a', 'b'],
+        _values: [[1, 2, 3], ['x', 'y', null]],
+    }), [
+        {a: 1, b: 'x'},
+        {a: 2, b: 'y'},
+        {a: 3, b: null},
+    ]);
+
+    // Anything else is left alone
+    t.deepEqual(unpack_columns([]), []);
+    t.deepEqual(unpack_columns([1, 2, 3]), [1, 2, 3]);
+    t.deepEqual(unpack_columns([{}, {}]), [{}, {}]);
+    t.deepEqual(unpack_columns("moo"), "moo");
+    t.deepEqual(unpack_columns(null), null);
+
+    // Nested columns get unpacked
+    t.deepEqual(unpack_columns({answerQueue: {
+        _columns: ['uri', 'ug_reviews'],
+        _values: [['a', 'b'], [{_columns: ['mark'], _values: [[1, 2]]}, []]],
+    }, path: 'x.y'}), {answerQueue: [
+        {uri: 'a', ug_reviews: [{mark: 1}, {mark: 2}]},
+        {uri: 'b', ug_reviews: []},
+    ], path: 'x.y'});
+
+    t.end();
+});
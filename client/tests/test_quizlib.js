@@ -327,9 +327,9 @@ function syncMockSubscriptions(quiz, default_settings) {
             ] },
         ]});
 
-        return quiz.ajaxApi.waitForQueue(["POST /api/stage?path=t0.l0.s0 3"]);
+        return quiz.ajaxApi.waitForQueue(["POST /api/stage/sync-many 3"]);
     }).then(function () {
-        quiz.ajaxApi.setResponse("POST /api/stage?path=t0.l0.s0", 3, {
+        quiz.ajaxApi.setResponse("POST /api/stage/sync-many", 3, { stages: [{
             "answerQueue": [],
             "material_tags": ["path.t0.l0.s0"],
             "questions": [
@@ -340,7 +340,7 @@ function syncMockSubscriptions(quiz, default_settings) {
             "settings": default_settings || {},
             "uri": "/api/stage?path=t0.l0.s0",
             "path": "t0.l0.s0",
-        });
+        }] });
 
         return quiz.ajaxApi.waitForQueue(["GET /api/stage/material?path=t0.l0.s0 4"]);
     }).then(function () {
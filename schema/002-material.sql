@@ -22,6 +22,7 @@ CREATE TABLE IF NOT EXISTS material_source (
     next_material_source_id  INTEGER NULL,
     FOREIGN KEY (next_material_source_id) REFERENCES material_source(material_source_id)
 );
+ALTER TABLE material_source ADD COLUMN IF NOT EXISTS render_cache BOOLEAN NOT NULL DEFAULT TRUE;
 CREATE INDEX IF NOT EXISTS material_source_material_tags ON material_source USING GIN (material_tags);
 CREATE INDEX IF NOT EXISTS material_source_next_material_source_id ON material_source(next_material_source_id);
 COMMENT ON TABLE  material_source IS 'Source for material, i.e. a file in the material repository';
@@ -31,6 +32,7 @@ COMMENT ON COLUMN material_source.md5sum   IS 'MD5sum of this version';
 COMMENT ON COLUMN material_source.permutation_count IS 'Number of question permutations';
 COMMENT ON COLUMN material_source.initial_answered IS 'Initial value for # of times this question has been answered';
 COMMENT ON COLUMN material_source.initial_correct IS 'Initial value for # of times this question has been correctly answered';
+COMMENT ON COLUMN material_source.render_cache IS 'Can rendered output be cached? False if the question is non-deterministic';
 COMMENT ON COLUMN material_source.next_material_source_id IS
     'This bank/path/revision has been superseded by this one, i.e. this one should be ignored';
 
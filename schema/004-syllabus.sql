@@ -47,6 +47,7 @@ CREATE TABLE IF NOT EXISTS stage (
     lastupdate               TIMESTAMP NOT NULL DEFAULT NOW()
 );
 SELECT ddl_lastupdate_trigger('stage');
+CREATE INDEX IF NOT EXISTS stage_material_tags ON stage USING GIN (material_tags);  -- For stage_material_source_link triggers
 COMMENT ON TABLE  stage IS 'An individual stage in this syllabus item, and the tags for relevant content within';
 COMMENT ON COLUMN stage.syllabus_id IS 'Syllabus item this stage is part of';
 COMMENT ON COLUMN stage.stage_name IS 'An alphanumeric ID, used in URLs. Cannot vary between versions';
@@ -58,6 +59,23 @@ COMMENT ON COLUMN stage.stage_setting_spec IS 'dict of setting key to a combinat
     '...or "variant:registered", and another set of values below it'
     '...or "deleted", if this stage is now removed';
 COMMENT ON COLUMN stage.next_stage_id IS 'The replacement stage_id, or NULL if this field is current';
+
+
+CREATE TABLE IF NOT EXISTS stage_lineage (
+    stage_id                 INTEGER NOT NULL,
+    FOREIGN KEY (stage_id) REFERENCES stage(stage_id),
+    PRIMARY KEY (stage_id),
+
+    latest_stage_id          INTEGER NOT NULL,
+    FOREIGN KEY (latest_stage_id) REFERENCES stage(stage_id),
+    version                  INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stage_lineage_latest_stage_id ON stage_lineage(latest_stage_id);
+COMMENT ON TABLE  stage_lineage IS 'Every stage revision and the current stage that replaces it, maintained by stage_next_stage_id_after_insert';
+COMMENT ON COLUMN stage_lineage.latest_stage_id IS 'The current revision of this stage, i.e. the one with next_stage_id NULL';
+COMMENT ON COLUMN stage_lineage.version IS 'Position within the lineage, starting at 1 for the oldest revision';
+
+
 CREATE OR REPLACE FUNCTION stage_next_stage_id_before_insert_fn() RETURNS TRIGGER AS $$
 BEGIN
    NEW.next_stage_id := NULL;
@@ -77,6 +95,15 @@ BEGIN
        AND stage_name = NEW.stage_name
        AND stage_id != NEW.stage_id
        AND next_stage_id IS NULL;
+
+   -- Everything in their lineage is now in ours, then add ourselves to the end
+   UPDATE stage_lineage
+       SET latest_stage_id = NEW.stage_id
+       WHERE latest_stage_id IN (SELECT stage_id FROM stage WHERE next_stage_id = NEW.stage_id);
+   INSERT INTO stage_lineage (stage_id, latest_stage_id, version)
+       SELECT NEW.stage_id, NEW.stage_id, COUNT(*) + 1
+         FROM stage_lineage
+        WHERE latest_stage_id = NEW.stage_id;
    RETURN NEW;
 END;
 $$ LANGUAGE 'plpgsql';
@@ -84,47 +111,102 @@ DROP TRIGGER IF EXISTS stage_next_stage_id_after_insert on stage;
 CREATE TRIGGER stage_next_stage_id_after_insert AFTER INSERT ON stage FOR EACH ROW EXECUTE PROCEDURE stage_next_stage_id_after_insert_fn();
 
 
+-- Fill in stage_lineage for stages that existed before it
+DO
+$do$
+BEGIN
+   IF EXISTS (SELECT * FROM stage_lineage) THEN
+       -- Nothing to do, exit.
+       RETURN;
+   END IF;
+
+   INSERT INTO stage_lineage (stage_id, latest_stage_id, version)
+       WITH RECURSIVE all_stage_versions(v, stage_id, syllabus_id, stage_name, latest_stage_id, next_stage_id) AS (
+       SELECT 0 v
+            , stage.stage_id
+            , stage.syllabus_id
+            , stage.stage_name
+            , stage.stage_id latest_stage_id
+            , stage.next_stage_id
+         FROM stage
+        WHERE next_stage_id IS NULL
+           UNION ALL
+       SELECT (all_stage_versions.v + 1) v
+            , stage.stage_id
+            , stage.syllabus_id
+            , stage.stage_name
+            , all_stage_versions.latest_stage_id latest_stage_id
+            , stage.next_stage_id
+         FROM stage
+            , all_stage_versions
+        WHERE stage.next_stage_id = all_stage_versions.stage_id
+   )
+   SELECT stage_id, latest_stage_id
+        , COUNT(*) OVER (PARTITION BY all_stage_versions.latest_stage_id)::INT - all_stage_versions.v
+     FROM all_stage_versions;
+END
+$do$;
+
+
 CREATE OR REPLACE VIEW all_stage_versions AS
-    WITH RECURSIVE all_stage_versions(v, stage_id, syllabus_id, stage_name, latest_stage_id, next_stage_id) AS (
-        SELECT 0 v
-             , stage.stage_id
-             , stage.syllabus_id
-             , stage.stage_name
-             , stage.stage_id latest_stage_id
-             , stage.next_stage_id
-          FROM stage
-         WHERE next_stage_id IS NULL
-            UNION ALL
-        SELECT (all_stage_versions.v + 1) v
-             , stage.stage_id
-             , stage.syllabus_id
-             , stage.stage_name
-             , all_stage_versions.latest_stage_id latest_stage_id
-             , stage.next_stage_id
-          FROM stage
-             , all_stage_versions
-         WHERE stage.next_stage_id = all_stage_versions.stage_id
-    )
-    SELECT COUNT(*) OVER (PARTITION BY all_stage_versions.latest_stage_id)::INT - all_stage_versions.v AS v
-         , stage_id, syllabus_id, stage_name, latest_stage_id, next_stage_id FROM all_stage_versions;
+    SELECT sl.version AS v
+         , st.stage_id, st.syllabus_id, st.stage_name, sl.latest_stage_id, st.next_stage_id
+      FROM stage_lineage sl
+      JOIN stage st ON st.stage_id = sl.stage_id;
 COMMENT ON VIEW all_stage_versions IS 'IDs of all stage revisions, by the latest stage ID, with a numeric version';
 
-CREATE TABLE IF NOT EXISTS stage_setting (
+CREATE TABLE IF NOT EXISTS user_stage_setting (
     stage_id                 INTEGER NOT NULL,
     FOREIGN KEY (stage_id) REFERENCES stage(stage_id),
-    user_id                  INTEGER,
+    user_id                  INTEGER NOT NULL,
     FOREIGN KEY (user_id) REFERENCES "user"(user_id),
-    key                      TEXT,
-    PRIMARY KEY (stage_id, user_id, key),
+    PRIMARY KEY (stage_id, user_id),
 
-    value                    TEXT,
+    settings                 JSONB NOT NULL DEFAULT '{}',
 
     lastupdate               TIMESTAMP NOT NULL DEFAULT NOW()
 );
-SELECT ddl_lastupdate_trigger('stage_setting');
-COMMENT ON TABLE  stage_setting IS 'All chosen settings for a stage, generic and per-student';
-COMMENT ON COLUMN stage_setting.user_id IS 'Student setting is for, or one of the special students:'
-     '"(any)" for any student';
+SELECT ddl_lastupdate_trigger('user_stage_setting');
+COMMENT ON TABLE  user_stage_setting IS 'Settings chosen for a student in a stage';
+COMMENT ON COLUMN user_stage_setting.settings IS 'Object of setting key -> chosen value, for customised settings';
+
+CREATE TABLE IF NOT EXISTS user_stage_bank (
+    stage_id                 INTEGER NOT NULL,
+    FOREIGN KEY (stage_id) REFERENCES stage(stage_id) ON DELETE CASCADE,
+    user_id                  INTEGER NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES "user"(user_id),
+    PRIMARY KEY (stage_id, user_id),
+
+    refresh_epoch            INTEGER NOT NULL,
+    question_cap             INTEGER NOT NULL,
+    material_source_ids      INTEGER[] NOT NULL,
+    permutations             INTEGER[] NOT NULL
+);
+COMMENT ON TABLE  user_stage_bank IS 'Question bank OriginalAllocation chose for a student, kept until their next refresh';
+COMMENT ON COLUMN user_stage_bank.refresh_epoch IS 'Answers in all versions of the stage // allocation_refresh_interval, when the bank was chosen';
+
+
+-- Move settings from stage_setting, which had a row per setting. The old
+-- table is kept as stage_setting_old, to roll back to if need be.
+-- NB: user_id was part of stage_setting's primary key, so couldn't be NULL
+--     (i.e. "(any)" student rows never existed). If one did, the insert
+--     would fail, rather than lose it.
+DO
+$do$
+BEGIN
+   IF to_regclass('stage_setting') IS NULL THEN
+       -- Nothing to do, exit.
+       RETURN;
+   END IF;
+
+   INSERT INTO user_stage_setting (stage_id, user_id, settings)
+   SELECT stage_id, user_id, JSONB_OBJECT_AGG(key, value)
+     FROM stage_setting
+ GROUP BY stage_id, user_id
+       ON CONFLICT DO NOTHING;
+   ALTER TABLE stage_setting RENAME TO stage_setting_old;
+END
+$do$;
 
 
 CREATE TABLE IF NOT EXISTS subscription (
@@ -34,17 +34,403 @@ COMMENT ON COLUMN answer.time_offset IS 'Difference between server and client UT
 COMMENT ON COLUMN answer.coins_awarded IS 'SMLY awarded for this question, in milli-SMLY';
 COMMENT ON COLUMN answer.student_answer IS 'The student_answer object, i.e. the raw form selections';
 COMMENT ON COLUMN answer.review IS 'The students review of the material, if they did one';
+ALTER TABLE answer ADD COLUMN IF NOT EXISTS mark INTEGER;
+ALTER TABLE answer ADD COLUMN IF NOT EXISTS mark_stamp TEXT;
+COMMENT ON COLUMN answer.mark IS 'Mark for user-generated material, based on reviews';
+COMMENT ON COLUMN answer.mark_stamp IS 'What correct / coins_awarded / mark were based on, NULL if not marked yet';
 
+-- Make the client's identity for an answer unique, so retried syncs can't insert it twice
+-- NB: Not stage_id / time_offset, these change if the stage is upgraded / the client's clock is reset between retries
+DO
+$do$
+BEGIN
+   IF EXISTS (SELECT * FROM pg_indexes WHERE tablename = 'answer' AND indexname = 'answer_client_identity'
+               AND indexdef LIKE '%(user_id, client_id, time_end)') THEN
+       -- Nothing to do, exit.
+       RETURN;
+   END IF;
+   DROP INDEX IF EXISTS answer_client_identity;
 
-CREATE OR REPLACE VIEW answer_stats AS
-    SELECT a.stage_id
-         , a.material_source_id
-         , a.permutation
-         , COUNT(*) answered
-         , COUNT(NULLIF(a.correct, false)) correct
-    FROM answer a
-    GROUP BY 1, 2, 3;
-COMMENT ON VIEW answer_stats IS 'Answer stats for each stage/material_source/permutation combo';
+   IF EXISTS (SELECT 1 FROM answer
+               GROUP BY user_id, client_id, time_end
+              HAVING COUNT(*) > 1) THEN
+       -- NB: Duplicates may have been reviewed / awarded coins separately, so can't pick one to drop for you
+       RAISE EXCEPTION 'answer has duplicate (user_id, client_id, time_end) rows, cannot create answer_client_identity'
+           USING HINT = 'Find them with SELECT user_id, client_id, time_end, ARRAY_AGG(answer_id) FROM answer GROUP BY 1, 2, 3 HAVING COUNT(*) > 1, remove all but one of each and re-run';
+   END IF;
+
+   CREATE UNIQUE INDEX answer_client_identity ON answer(user_id, client_id, time_end);
+END
+$do$;
+
+ALTER TABLE answer ADD COLUMN IF NOT EXISTS sync_txid BIGINT;
+CREATE INDEX IF NOT EXISTS answer_user_id_sync_txid ON answer(user_id, sync_txid);
+COMMENT ON COLUMN answer.sync_txid IS 'Transaction that last changed what the client sees of this answer, for delta-syncing';
+CREATE OR REPLACE FUNCTION answer_sync_txid_before_fn() RETURNS TRIGGER AS $$
+BEGIN
+   IF TG_OP = 'INSERT' THEN
+       NEW.sync_txid := txid_current();
+   ELSIF (NEW.correct, NEW.grade, NEW.mark, NEW.student_answer, NEW.review)
+         IS DISTINCT FROM (OLD.correct, OLD.grade, OLD.mark, OLD.student_answer, OLD.review) THEN
+       NEW.sync_txid := txid_current();
+   END IF;
+   RETURN NEW;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS answer_sync_txid_before on answer;
+CREATE TRIGGER answer_sync_txid_before BEFORE INSERT OR UPDATE ON answer FOR EACH ROW EXECUTE PROCEDURE answer_sync_txid_before_fn();
+
+
+CREATE TABLE IF NOT EXISTS answer_queue_sync (
+    user_id                  INTEGER NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES "user"(user_id),
+    PRIMARY KEY (user_id),
+
+    change_txid              BIGINT NOT NULL
+);
+COMMENT ON TABLE  answer_queue_sync IS 'Most recent transaction that changed anything in a students answer queues';
+COMMENT ON COLUMN answer_queue_sync.change_txid IS 'Transaction ID, anything synced in a snapshot after this is up to date';
+CREATE OR REPLACE FUNCTION answer_queue_sync_after_fn() RETURNS TRIGGER AS $$
+BEGIN
+   IF TG_OP = 'UPDATE' THEN
+       IF NEW.sync_txid IS NOT DISTINCT FROM OLD.sync_txid THEN
+           RETURN NULL;
+       END IF;
+   END IF;
+
+   -- Invalidate the student, and if this is a review, the author of the material under review
+   INSERT INTO answer_queue_sync (user_id, change_txid)
+        SELECT NEW.user_id, NEW.sync_txid WHERE NEW.user_id IS NOT NULL
+         UNION
+        SELECT a.user_id, NEW.sync_txid FROM answer a WHERE NEW.permutation < 0 AND a.answer_id = 0 - NEW.permutation AND a.user_id IS NOT NULL
+   ON CONFLICT (user_id) DO UPDATE SET change_txid = GREATEST(answer_queue_sync.change_txid, EXCLUDED.change_txid);
+   RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS answer_queue_sync_after on answer;
+CREATE TRIGGER answer_queue_sync_after AFTER INSERT OR UPDATE ON answer FOR EACH ROW EXECUTE PROCEDURE answer_queue_sync_after_fn();
+
+
+CREATE TABLE IF NOT EXISTS user_stage_progress (
+    user_id                  INTEGER NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES "user"(user_id),
+    syllabus_id              INTEGER NOT NULL,
+    FOREIGN KEY (syllabus_id) REFERENCES syllabus(syllabus_id),
+    stage_name               TEXT NOT NULL,
+    PRIMARY KEY (user_id, syllabus_id, stage_name),
+
+    latest_grade             NUMERIC(5, 3) NOT NULL,
+    max_grade                NUMERIC(5, 3) NOT NULL,
+    answer_count             INTEGER NOT NULL,
+    last_time_end            TIMESTAMP WITHOUT TIME ZONE,  -- NB: Always UTC
+
+    lastupdate               TIMESTAMP NOT NULL DEFAULT NOW()
+);
+SELECT ddl_lastupdate_trigger('user_stage_progress');
+CREATE INDEX IF NOT EXISTS user_stage_progress_syllabus_id ON user_stage_progress(syllabus_id);
+COMMENT ON TABLE  user_stage_progress IS 'Summary of each students answers to all versions of a stage, maintained by answer_user_stage_progress_after_* triggers';
+COMMENT ON COLUMN user_stage_progress.stage_name IS 'Stage within syllabus item, constant between versions';
+COMMENT ON COLUMN user_stage_progress.latest_grade IS 'Grade after the answer with the latest time_end';
+COMMENT ON COLUMN user_stage_progress.max_grade IS 'Highest grade the student has achieved';
+COMMENT ON COLUMN user_stage_progress.answer_count IS 'Number of answers the student has made';
+COMMENT ON COLUMN user_stage_progress.last_time_end IS 'time_end of the latest answer, in UTC';
+CREATE OR REPLACE FUNCTION answer_user_stage_progress_after_insert_fn() RETURNS TRIGGER AS $$
+BEGIN
+   -- NB: Ordered, so concurrent transactions lock rows in the same order
+   INSERT INTO user_stage_progress AS usp (user_id, syllabus_id, stage_name, latest_grade, max_grade, answer_count, last_time_end)
+        SELECT DISTINCT ON (n.user_id, st.syllabus_id, st.stage_name)
+               n.user_id
+             , st.syllabus_id
+             , st.stage_name
+             , n.grade
+             , MAX(n.grade) OVER usp
+             , COUNT(*) OVER usp
+             , MAX(n.time_end) OVER usp
+          FROM new_rows n
+          JOIN stage st ON st.stage_id = n.stage_id
+         WHERE n.user_id IS NOT NULL
+        WINDOW usp AS (PARTITION BY n.user_id, st.syllabus_id, st.stage_name)
+      ORDER BY n.user_id, st.syllabus_id, st.stage_name, n.time_end DESC NULLS LAST, n.answer_id DESC
+   ON CONFLICT (user_id, syllabus_id, stage_name) DO UPDATE SET
+       latest_grade = CASE WHEN usp.last_time_end IS NULL OR EXCLUDED.last_time_end >= usp.last_time_end
+                           THEN EXCLUDED.latest_grade
+                           ELSE usp.latest_grade END,
+       max_grade = GREATEST(usp.max_grade, EXCLUDED.max_grade),
+       answer_count = usp.answer_count + EXCLUDED.answer_count,
+       last_time_end = GREATEST(usp.last_time_end, EXCLUDED.last_time_end);
+   RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS answer_user_stage_progress_after_insert on answer;
+CREATE TRIGGER answer_user_stage_progress_after_insert AFTER INSERT ON answer
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE answer_user_stage_progress_after_insert_fn();
+CREATE OR REPLACE FUNCTION user_stage_progress_recalculate(user_ids INTEGER[], syllabus_ids INTEGER[], stage_names TEXT[]) RETURNS VOID AS $$
+   -- Grades can go down as well as up, so work out progress again from all answers for these students/stages
+   DELETE FROM user_stage_progress usp
+    USING UNNEST(user_ids, syllabus_ids, stage_names) p(user_id, syllabus_id, stage_name)
+    WHERE usp.user_id = p.user_id
+      AND usp.syllabus_id = p.syllabus_id
+      AND usp.stage_name = p.stage_name
+      AND NOT EXISTS (
+          SELECT 1 FROM answer a JOIN stage st ON st.stage_id = a.stage_id
+           WHERE a.user_id = p.user_id AND st.syllabus_id = p.syllabus_id AND st.stage_name = p.stage_name
+      );
+   INSERT INTO user_stage_progress AS usp (user_id, syllabus_id, stage_name, latest_grade, max_grade, answer_count, last_time_end)
+        SELECT DISTINCT ON (a.user_id, st.syllabus_id, st.stage_name)
+               a.user_id
+             , st.syllabus_id
+             , st.stage_name
+             , a.grade
+             , MAX(a.grade) OVER usp
+             , COUNT(*) OVER usp
+             , MAX(a.time_end) OVER usp
+          FROM answer a
+          JOIN stage st ON st.stage_id = a.stage_id
+          JOIN UNNEST(user_ids, syllabus_ids, stage_names) p(user_id, syllabus_id, stage_name)
+            ON p.user_id = a.user_id AND p.syllabus_id = st.syllabus_id AND p.stage_name = st.stage_name
+        WINDOW usp AS (PARTITION BY a.user_id, st.syllabus_id, st.stage_name)
+      ORDER BY a.user_id, st.syllabus_id, st.stage_name, a.time_end DESC NULLS LAST, a.answer_id DESC
+   ON CONFLICT (user_id, syllabus_id, stage_name) DO UPDATE SET
+       latest_grade = EXCLUDED.latest_grade,
+       max_grade = EXCLUDED.max_grade,
+       answer_count = EXCLUDED.answer_count,
+       last_time_end = EXCLUDED.last_time_end;
+$$ LANGUAGE SQL;
+CREATE OR REPLACE FUNCTION answer_user_stage_progress_after_update_fn() RETURNS TRIGGER AS $$
+BEGIN
+   -- NB: Most updates are re-marking, which doesn't change anything we summarise
+   PERFORM user_stage_progress_recalculate(ARRAY_AGG(c.user_id), ARRAY_AGG(c.syllabus_id), ARRAY_AGG(c.stage_name))
+      FROM (
+          SELECT DISTINCT x.user_id, st.syllabus_id, st.stage_name
+            FROM old_rows o
+            JOIN new_rows n ON n.answer_id = o.answer_id
+           CROSS JOIN LATERAL (VALUES (o.user_id, o.stage_id), (n.user_id, n.stage_id)) x(user_id, stage_id)
+            JOIN stage st ON st.stage_id = x.stage_id
+           WHERE x.user_id IS NOT NULL
+             AND (o.user_id, o.stage_id, o.grade, o.time_end) IS DISTINCT FROM (n.user_id, n.stage_id, n.grade, n.time_end)
+      ) c
+    HAVING COUNT(*) > 0;
+   RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS answer_user_stage_progress_after_update on answer;
+CREATE TRIGGER answer_user_stage_progress_after_update AFTER UPDATE ON answer
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE answer_user_stage_progress_after_update_fn();
+CREATE OR REPLACE FUNCTION answer_user_stage_progress_after_delete_fn() RETURNS TRIGGER AS $$
+BEGIN
+   PERFORM user_stage_progress_recalculate(ARRAY_AGG(c.user_id), ARRAY_AGG(c.syllabus_id), ARRAY_AGG(c.stage_name))
+      FROM (
+          SELECT DISTINCT o.user_id, st.syllabus_id, st.stage_name
+            FROM old_rows o
+            JOIN stage st ON st.stage_id = o.stage_id
+           WHERE o.user_id IS NOT NULL
+      ) c
+    HAVING COUNT(*) > 0;
+   RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS answer_user_stage_progress_after_delete on answer;
+CREATE TRIGGER answer_user_stage_progress_after_delete AFTER DELETE ON answer
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE answer_user_stage_progress_after_delete_fn();
+DO
+$do$
+BEGIN
+   IF EXISTS (SELECT * FROM user_stage_progress) THEN
+       -- Already populated, trigger will keep it up to date
+       RETURN;
+   END IF;
+
+   INSERT INTO user_stage_progress (user_id, syllabus_id, stage_name, latest_grade, max_grade, answer_count, last_time_end)
+       SELECT DISTINCT ON (a.user_id, st.syllabus_id, st.stage_name)
+              a.user_id
+            , st.syllabus_id
+            , st.stage_name
+            , a.grade
+            , MAX(a.grade) OVER usp
+            , COUNT(*) OVER usp
+            , MAX(a.time_end) OVER usp
+         FROM answer a, stage st
+        WHERE a.stage_id = st.stage_id
+          AND a.user_id IS NOT NULL
+       WINDOW usp AS (PARTITION BY a.user_id, st.syllabus_id, st.stage_name)
+     ORDER BY a.user_id, st.syllabus_id, st.stage_name, a.time_end DESC NULLS LAST, a.answer_id DESC;
+END
+$do$;
+
+DO
+$do$
+BEGIN
+   IF NOT EXISTS (SELECT * FROM pg_views WHERE viewname = 'answer_stats') THEN
+       -- Nothing to do, exit.
+       RETURN;
+   END IF;
+
+   -- Replaced with a table below
+   DROP VIEW answer_stats;
+END
+$do$;
+CREATE TABLE IF NOT EXISTS answer_stats (
+    stage_id                 INTEGER NOT NULL,
+    FOREIGN KEY (stage_id) REFERENCES stage(stage_id),
+    material_source_id       INTEGER NOT NULL,
+    permutation              INTEGER NOT NULL,
+    PRIMARY KEY (stage_id, material_source_id, permutation),
+
+    answered                 INTEGER NOT NULL DEFAULT 0,
+    correct                  INTEGER NOT NULL DEFAULT 0
+);
+COMMENT ON TABLE  answer_stats IS 'Answer stats for each stage/material_source/permutation combo, maintained by answer_stats_after_* triggers';
+COMMENT ON COLUMN answer_stats.answered IS 'Number of answers to this material within this stage';
+COMMENT ON COLUMN answer_stats.correct IS 'Number of those answers that were correct';
+CREATE OR REPLACE FUNCTION answer_stats_after_insert_fn() RETURNS TRIGGER AS $$
+BEGIN
+   -- NB: Ordered, so concurrent transactions lock rows in the same order
+   INSERT INTO answer_stats AS ast (stage_id, material_source_id, permutation, answered, correct)
+        SELECT n.stage_id, n.material_source_id, n.permutation, COUNT(*), COUNT(NULLIF(n.correct, false))
+          FROM new_rows n
+         WHERE n.material_source_id IS NOT NULL AND n.permutation IS NOT NULL
+      GROUP BY 1, 2, 3
+      ORDER BY 1, 2, 3
+   ON CONFLICT (stage_id, material_source_id, permutation) DO UPDATE SET
+       answered = ast.answered + EXCLUDED.answered,
+       correct = ast.correct + EXCLUDED.correct;
+   RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS answer_stats_after_insert on answer;
+CREATE TRIGGER answer_stats_after_insert AFTER INSERT ON answer
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE answer_stats_after_insert_fn();
+CREATE OR REPLACE FUNCTION answer_stats_after_update_fn() RETURNS TRIGGER AS $$
+BEGIN
+   -- Remove old rows from counts, add new ones
+   INSERT INTO answer_stats AS ast (stage_id, material_source_id, permutation, answered, correct)
+        SELECT d.stage_id, d.material_source_id, d.permutation, SUM(d.answered), SUM(d.correct)
+          FROM (
+              SELECT o.stage_id, o.material_source_id, o.permutation, -1 answered, CASE WHEN o.correct THEN -1 ELSE 0 END correct
+                FROM old_rows o
+               UNION ALL
+              SELECT n.stage_id, n.material_source_id, n.permutation, 1 answered, CASE WHEN n.correct THEN 1 ELSE 0 END correct
+                FROM new_rows n
+          ) d
+         WHERE d.material_source_id IS NOT NULL AND d.permutation IS NOT NULL
+      GROUP BY 1, 2, 3
+        HAVING SUM(d.answered) != 0 OR SUM(d.correct) != 0  -- i.e. ignore updates that didn't change anything we count
+      ORDER BY 1, 2, 3
+   ON CONFLICT (stage_id, material_source_id, permutation) DO UPDATE SET
+       answered = ast.answered + EXCLUDED.answered,
+       correct = ast.correct + EXCLUDED.correct;
+   RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS answer_stats_after_update on answer;
+CREATE TRIGGER answer_stats_after_update AFTER UPDATE ON answer
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE answer_stats_after_update_fn();
+CREATE OR REPLACE FUNCTION answer_stats_after_delete_fn() RETURNS TRIGGER AS $$
+BEGIN
+   UPDATE answer_stats ast
+      SET answered = ast.answered - d.answered
+        , correct = ast.correct - d.correct
+     FROM (
+        SELECT o.stage_id, o.material_source_id, o.permutation, COUNT(*) answered, COUNT(NULLIF(o.correct, false)) correct
+          FROM old_rows o
+         WHERE o.material_source_id IS NOT NULL AND o.permutation IS NOT NULL
+      GROUP BY 1, 2, 3
+     ) d
+    WHERE ast.stage_id = d.stage_id
+      AND ast.material_source_id = d.material_source_id
+      AND ast.permutation = d.permutation;
+   RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS answer_stats_after_delete on answer;
+CREATE TRIGGER answer_stats_after_delete AFTER DELETE ON answer
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE answer_stats_after_delete_fn();
+DO
+$do$
+BEGIN
+   IF EXISTS (SELECT * FROM answer_stats) OR NOT EXISTS (SELECT * FROM answer) THEN
+       -- Already populated, triggers will keep it up to date
+       RETURN;
+   END IF;
+
+   -- NB: answer_stats_rebuild in tutorweb_quizdb.stage.answer_stats does the same
+   INSERT INTO answer_stats (stage_id, material_source_id, permutation, answered, correct)
+       SELECT a.stage_id, a.material_source_id, a.permutation
+            , COUNT(*)
+            , COUNT(NULLIF(a.correct, false))
+         FROM answer a
+        WHERE a.material_source_id IS NOT NULL
+          AND a.permutation IS NOT NULL
+     GROUP BY 1, 2, 3;
+END
+$do$;
+
+
+CREATE TABLE IF NOT EXISTS stage_material_source_link (
+    stage_id                 INTEGER NOT NULL,
+    FOREIGN KEY (stage_id) REFERENCES stage(stage_id) ON DELETE CASCADE,
+    material_source_id       INTEGER NOT NULL,
+    FOREIGN KEY (material_source_id) REFERENCES material_source(material_source_id) ON DELETE CASCADE,
+    PRIMARY KEY (stage_id, material_source_id)
+);
+CREATE INDEX IF NOT EXISTS stage_material_source_link_material_source_id ON stage_material_source_link(material_source_id);
+COMMENT ON TABLE  stage_material_source_link IS 'Every (stage, material_source) pair where the stage''s material_tags are a subset of the material''s, '
+    'maintained by triggers on stage & material_source';
+-- NB: material_tags never change, a new stage / material_source revision is added instead
+CREATE OR REPLACE FUNCTION stage_material_source_link_stage_after_insert_fn() RETURNS TRIGGER AS $$
+BEGIN
+   INSERT INTO stage_material_source_link (stage_id, material_source_id)
+        SELECT n.stage_id, ms.material_source_id
+          FROM new_rows n
+          JOIN material_source ms
+            ON n.material_tags <@ ms.material_tags
+   ON CONFLICT DO NOTHING;
+   RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS stage_material_source_link_stage_after_insert on stage;
+CREATE TRIGGER stage_material_source_link_stage_after_insert AFTER INSERT ON stage
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE stage_material_source_link_stage_after_insert_fn();
+CREATE OR REPLACE FUNCTION stage_material_source_link_material_source_after_insert_fn() RETURNS TRIGGER AS $$
+BEGIN
+   INSERT INTO stage_material_source_link (stage_id, material_source_id)
+        SELECT s.stage_id, n.material_source_id
+          FROM new_rows n
+          JOIN stage s
+            ON s.material_tags <@ n.material_tags
+   ON CONFLICT DO NOTHING;
+   RETURN NULL;
+END;
+$$ LANGUAGE 'plpgsql';
+DROP TRIGGER IF EXISTS stage_material_source_link_material_source_after_insert on material_source;
+CREATE TRIGGER stage_material_source_link_material_source_after_insert AFTER INSERT ON material_source
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE PROCEDURE stage_material_source_link_material_source_after_insert_fn();
+
+
+-- Fill in stage_material_source_link for stages / material that existed before it
+DO
+$do$
+BEGIN
+   IF EXISTS (SELECT * FROM stage_material_source_link) THEN
+       -- Nothing to do, exit.
+       RETURN;
+   END IF;
+
+   INSERT INTO stage_material_source_link (stage_id, material_source_id)
+       SELECT s.stage_id, ms.material_source_id
+         FROM stage s
+         JOIN material_source ms
+           ON s.material_tags <@ ms.material_tags;
+END
+$do$;
 
 
 CREATE OR REPLACE VIEW stage_material AS
@@ -53,28 +439,30 @@ CREATE OR REPLACE VIEW stage_material AS
          , GENERATE_SERIES(1, ms.permutation_count) "permutation"
          , ms.initial_answered
          , ms.initial_correct
-    FROM stage s
-    JOIN material_source ms
-      ON s.material_tags <@ ms.material_tags
+    FROM stage_material_source_link sml
+    JOIN stage s ON s.stage_id = sml.stage_id
+    JOIN material_source ms ON ms.material_source_id = sml.material_source_id
     WHERE ms.next_material_source_id IS NULL
       AND s.next_stage_id IS NULL;
 COMMENT ON VIEW stage_material IS 'All appropriate current material for all current stages, and their stats';
 
 
 CREATE OR REPLACE VIEW stage_material_sources AS
-    SELECT s.stage_id
+    SELECT sml.stage_id
          , ms.material_source_id
          , ms.material_tags
-    FROM stage s
-    JOIN material_source ms
-      ON s.material_tags <@ ms.material_tags;
+    FROM stage_material_source_link sml
+    JOIN material_source ms ON ms.material_source_id = sml.material_source_id;
 COMMENT ON VIEW stage_material_sources IS 'All appropriate material for all stages, including historical';
 
 
-CREATE OR REPLACE VIEW stage_ugmaterial AS
+-- NB: a.* expands when answer gains columns, so recreate rather than replace
+DROP VIEW IF EXISTS stage_ugmaterial;
+CREATE VIEW stage_ugmaterial AS
     SELECT DISTINCT ON (CASE WHEN a.permutation < 0 THEN 0 - a.permutation ELSE a.answer_id END)
     a.*
     , JSONB_AGG(JSONB_BUILD_ARRAY(user_id, review)) OVER curqn AS reviews
+    , MAX(a.sync_txid) OVER curqn AS reviews_sync_txid
     FROM answer a
     WINDOW curqn AS (
         -- i.e. all rows dealing with the current question
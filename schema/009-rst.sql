@@ -0,0 +1,15 @@
+BEGIN;
+
+
+CREATE TABLE IF NOT EXISTS rst_render_cache (
+    digest                   TEXT PRIMARY KEY,
+    version                  TEXT NOT NULL,
+    html                     TEXT NOT NULL
+);
+COMMENT ON TABLE  rst_render_cache IS 'Output of RST renderer, shared between server processes';
+COMMENT ON COLUMN rst_render_cache.digest IS 'SHA256 of renderer version & RST source';
+COMMENT ON COLUMN rst_render_cache.version IS 'Renderer version that produced html, older versions get purged';
+COMMENT ON COLUMN rst_render_cache.html IS 'Rendered HTML fragment';
+
+
+COMMIT;
@@ -0,0 +1,22 @@
+BEGIN;
+
+
+CREATE TABLE IF NOT EXISTS exam_sheet (
+    stage_id                 INTEGER NOT NULL,
+    FOREIGN KEY (stage_id) REFERENCES stage(stage_id) ON DELETE CASCADE,
+    user_id                  INTEGER NOT NULL,
+    FOREIGN KEY (user_id) REFERENCES "user"(user_id),
+    position                 INTEGER NOT NULL,
+    PRIMARY KEY (stage_id, user_id, position),
+
+    material_source_id       INTEGER NOT NULL,
+    FOREIGN KEY (material_source_id) REFERENCES material_source(material_source_id),
+    permutation              INTEGER NOT NULL,
+    rendered                 JSONB NULL
+);
+COMMENT ON TABLE  exam_sheet IS 'Questions chosen ahead of time for each student in an exam stage, see ExamAllocation';
+COMMENT ON COLUMN exam_sheet.position IS 'Order questions should be asked in, from 0';
+COMMENT ON COLUMN exam_sheet.rendered IS 'Output of material_render, or NULL if it should be rendered when requested';
+
+
+COMMIT;
@@ -0,0 +1,18 @@
+BEGIN;
+
+
+CREATE TABLE IF NOT EXISTS material_render_cache (
+    material_source_id       INTEGER NOT NULL,
+    FOREIGN KEY (material_source_id) REFERENCES material_source(material_source_id) ON DELETE CASCADE,
+    permutation              INTEGER NOT NULL,
+    dataframe_digest         TEXT NOT NULL,
+    PRIMARY KEY (material_source_id, permutation, dataframe_digest),
+
+    rendered                 JSONB NOT NULL
+);
+COMMENT ON TABLE  material_render_cache IS 'Output of material_render, shared between server processes';
+COMMENT ON COLUMN material_render_cache.dataframe_digest IS 'SHA256 of student dataframes the material uses, empty if none';
+COMMENT ON COLUMN material_render_cache.rendered IS 'Output of material_render. Rows are removed when material_source is superseded';
+
+
+COMMIT;
@@ -30,6 +30,27 @@ tutorweb.script.is_https = ${SERVER_IS_HTTPS}
 
 tutorweb.lti.secrets = ${APP_LTI_SECRETS}
 
+tutorweb.rst.persistent_cache = ${APP_RST_PERSISTENT_CACHE-false}
+tutorweb.material.render_persistent_cache = ${APP_MATERIAL_RENDER_PERSISTENT_CACHE-true}
+
+# R question rendering, see tutorweb_quizdb/material/renderer/r.py
+# Worker processes to render in, one per CPU by default. 0 renders in the
+# web server process, with no timeout (only for development / testing)
+tutorweb.r_render.processes = ${APP_R_RENDER_PROCESSES-$(nproc)}
+# Restart a worker after this many renders, or once it uses this many MiB (0 for no limit)
+tutorweb.r_render.max_renders = ${APP_R_RENDER_MAX_RENDERS-1000}
+tutorweb.r_render.max_memory = ${APP_R_RENDER_MAX_MEMORY-0}
+# Seconds a render can take before its worker is killed
+tutorweb.r_render.timeout = ${APP_R_RENDER_TIMEOUT-30}
+# Admission control, off by default: Seconds to wait for a free worker,
+# and renders that can be waiting, before refusing (0 to wait / queue forever)
+tutorweb.r_render.queue_timeout = ${APP_R_RENDER_QUEUE_TIMEOUT-0}
+tutorweb.r_render.max_queue = ${APP_R_RENDER_MAX_QUEUE-0}
+# Stop rendering a question after this many timeouts in a row, until its
+# source changes, or this many seconds have passed
+tutorweb.r_render.breaker_failures = ${APP_R_RENDER_BREAKER_FAILURES-3}
+tutorweb.r_render.breaker_reset = ${APP_R_RENDER_BREAKER_RESET-600}
+
 mail.default_sender = ${UWSGI_MAILSENDER}
 mail.host = ${UWSGI_MAILHOST}
 mail.port = ${UWSGI_MAILPORT}
@@ -0,0 +1,115 @@
+"""
+Micro-benchmarks for performance-sensitive parts of tutorweb_quizdb
+
+Run from the server directory, e.g. ``./bin/python -m benchmarks.sync_answer_queue``.
+Each creates a throwaway database with testing.postgresql, so needs the
+"testing" extras installed.
+"""
+import contextlib
+import os
+import time
+
+import transaction
+from zope.sqlalchemy import mark_changed
+
+
+@contextlib.contextmanager
+def bench_database():
+    """Start a throwaway database with our schema, and point DBSession at it"""
+    import testing.postgresql
+    import tutorweb_quizdb
+    from tests.requires_postgresql import initDatabase
+
+    old_cwd = os.getcwd()
+    os.chdir(os.path.join(os.path.dirname(__file__), '..'))
+    try:
+        postgresql = testing.postgresql.Postgresql()
+        initDatabase(postgresql)
+    finally:
+        os.chdir(old_cwd)
+    try:
+        db_session = tutorweb_quizdb.initialize_dbsession(dict(url=postgresql.url()))
+        yield db_session
+        transaction.abort()
+        db_session.remove()
+    finally:
+        postgresql.stop()
+
+
+class StatementCounter():
+    """
+    Count statements (i.e. round trips) executed, and note the time of the
+    first statement that matches (lock_marker)
+    """
+    def __init__(self, engine, lock_marker='FOR UPDATE'):
+        from sqlalchemy import event
+
+        self.engine = engine
+        self.lock_marker = lock_marker
+        self.statements = 0
+        self.lock_time = None
+        event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+        if self.lock_time is None and self.lock_marker in statement:
+            self.lock_time = time.perf_counter()
+
+    def reset(self):
+        self.statements = 0
+        self.lock_time = None
+
+    def close(self):
+        from sqlalchemy import event
+
+        event.remove(self.engine, 'after_cursor_execute', self._after_cursor_execute)
+
+
+def create_student(user_name):
+    """Create a bare student, returning their User object"""
+    from tutorweb_quizdb import DBSession
+    from tutorweb_quizdb.models import User
+
+    (user_id,) = DBSession.execute("""
+        INSERT INTO "user" (host_id, user_name, email, pw_hash, salt)
+             VALUES (1, :user_name, :user_name || '@example.com', '-', '-')
+          RETURNING user_id
+    """, dict(user_name=user_name)).fetchone()
+    mark_changed(DBSession())
+    return DBSession.query(User).get(user_id)
+
+
+def create_stage(lec_path, stage_setting_spec, material_tags):
+    """Create a lecture with a single stage, returning the stage"""
+    from sqlalchemy_utils import Ltree
+    from tutorweb_quizdb import DBSession, Base
+    from tutorweb_quizdb.syllabus.add import lec_import
+
+    lec_parent, lec_name = lec_path.rsplit('.', 1)
+    lec_import(dict(
+        path=lec_parent,
+        titles=[p for p in lec_parent.split('.')],
+        lectures=[[lec_name, 'Benchmark lecture']],
+        stage_template=[dict(
+            name='stage0', version=0,
+            title='Benchmark stage',
+            material_tags=material_tags,
+            setting_spec=stage_setting_spec,
+        )],
+    ))
+    return (DBSession.query(Base.classes.stage)
+                     .join(Base.classes.syllabus)
+                     .filter(Base.classes.syllabus.path == Ltree(lec_path))
+                     .one())
+
+
+def create_material(bank, count, material_tags, permutation_count=10):
+    """Add (count) material_source entries, without needing a material bank"""
+    from tutorweb_quizdb import DBSession
+
+    DBSession.execute("""
+        INSERT INTO material_source (bank, path, revision, md5sum, permutation_count, material_tags)
+             SELECT :bank, 'q' || i || '.q.R', 'r1', MD5(i::TEXT), :permutation_count, :material_tags
+               FROM GENERATE_SERIES(1, :count) i
+    """, dict(bank=bank, count=count, permutation_count=permutation_count, material_tags=material_tags))
+    mark_changed(DBSession())
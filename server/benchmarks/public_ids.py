@@ -0,0 +1,80 @@
+"""
+Per-ID cost of OriginalAllocation public ID encoding, for an answer queue's
+worth of IDs:
+
+* uncached: As before, a new cipher per request and encrypting every ID
+* cold: Batch API, cipher cached but no IDs seen before
+* warm: Batch API, all IDs seen before (i.e. the next sync of the same queue)
+
+    ./bin/python -m benchmarks.public_ids
+"""
+import base64
+import struct
+import time
+
+import skippy
+
+from tutorweb_quizdb.stage import allocation
+from tutorweb_quizdb.stage.allocation import get_allocation
+
+QUEUE_LENGTH = 2000
+REQUESTS = 10
+
+
+def uncached_to_public_ids(encryption_key, items):
+    """to_public_id as it was, with the cipher made in OriginalAllocation.__init__"""
+    cipher = skippy.Skippy(encryption_key.encode('ascii'))
+    return [base64.b64encode(struct.pack(
+        'cII',
+        b'B' if permutation < 0 else b'A',
+        cipher.encrypt(mss_id),
+        cipher.encrypt(abs(permutation)),
+    )).decode('ascii') for mss_id, permutation in items]
+
+
+def alloc(encryption_key):
+    return get_allocation(dict(
+        allocation_method='original',
+        allocation_seed=44,
+        allocation_encryption_key=encryption_key,
+    ), None, None)
+
+
+def time_per_id(fn):
+    """Run fn() for each request, return microseconds per ID"""
+    start = time.perf_counter()
+    for i in range(REQUESTS):
+        fn(i)
+    return (time.perf_counter() - start) / (REQUESTS * QUEUE_LENGTH) * 1000000
+
+
+def main():
+    items = [(i % 500 + 1, i % 10 + 1) for i in range(QUEUE_LENGTH)]
+
+    def clear_caches():
+        allocation.get_cipher.cache_clear()
+        allocation.encrypt_public_id.cache_clear()
+        allocation.decrypt_public_id.cache_clear()
+
+    def cold(i):
+        clear_caches()
+        alloc('key%d' % i).to_public_ids(items)
+
+    def warm(i):
+        alloc('warmkey').to_public_ids(items)
+
+    def warm_decode(i):
+        a = alloc('warmkey')
+        a.from_public_ids(a.to_public_ids(items))
+
+    clear_caches()
+    alloc('warmkey').from_public_ids(alloc('warmkey').to_public_ids(items))
+    print("%-10s %12s" % ('method', 'us per ID'))
+    print("%-10s %12.2f" % ('uncached', time_per_id(lambda i: uncached_to_public_ids('key%d' % i, items))))
+    print("%-10s %12.2f" % ('cold', time_per_id(cold)))
+    print("%-10s %12.2f" % ('warm', time_per_id(warm)))
+    print("%-10s %12.2f" % ('round-trip', time_per_id(warm_decode)))
+
+
+if __name__ == '__main__':
+    main()
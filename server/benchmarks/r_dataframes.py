@@ -0,0 +1,78 @@
+"""
+Time to render a student's material download for a dataframe-driven
+lecture, as /stage/material would with material_render_many, when student
+dataframes are converted into R for every question, compared to converting
+once & re-using the R object from R_DATAFRAME_CACHE.
+
+    ./bin/python -m benchmarks.r_dataframes
+"""
+import os
+import random
+import tempfile
+import time
+import types
+
+from tutorweb_quizdb.material.render import material_render_many
+from tutorweb_quizdb.material.renderer.r import R_DATAFRAME_CACHE
+
+QUESTIONS = 10
+QUESTION_CAP = 100
+ROWS = [10, 100, 1000]
+DOWNLOADS = 5
+
+QUESTION_TEMPLATE = """
+# TW:TAGS=bench,
+# TW:PERMUTATIONS=100
+# TW:DATAFRAMES=agelength
+question <- function (permutation, data_frames) {
+    df <- data_frames$agelength$data
+    fit <- lm(length ~ age, data = df)
+    list(
+        content = sprintf("<p>Question %(n)d.%%d: slope is %%.2f</p>", permutation, coef(fit)[[2]]),
+        correct = list()
+    )
+}
+"""
+
+
+def main():
+    with tempfile.TemporaryDirectory() as bank:
+        mss = []
+        for n in range(QUESTIONS):
+            path = 'bench%02d.q.R' % n
+            with open(os.path.join(bank, path), 'w') as f:
+                f.write(QUESTION_TEMPLATE % dict(n=n))
+            mss.append(types.SimpleNamespace(
+                bank=bank,
+                path=path,
+                md5sum='bench%d' % n,
+                permutation_count=100,
+                material_tags=['type.question'],
+                dataframe_paths=['agelength'],
+            ))
+
+        print("%-10s %8s %10s %16s" % ('impl', 'rows', 'renders', 'download (ms)'))
+        for rows in ROWS:
+            rng = random.Random(rows)
+            student_dataframes = dict(agelength=dict(data=[
+                dict(age=rng.randint(1, 20), length=rng.uniform(10, 100)) for _ in range(rows)
+            ]))
+            items = [(mss[i % QUESTIONS], i // QUESTIONS + 1, student_dataframes) for i in range(QUESTION_CAP)]
+            material_render_many(items[:QUESTIONS])  # Source every question first
+
+            for impl, cached in (('convert', False), ('cached', True)):
+                R_DATAFRAME_CACHE.clear()
+                start = time.perf_counter()
+                for _ in range(DOWNLOADS):
+                    if cached:
+                        material_render_many(items)
+                    else:
+                        for item in items:
+                            R_DATAFRAME_CACHE.clear()
+                            material_render_many([item])
+                elapsed = time.perf_counter() - start
+                print("%-10s %8d %10d %16.1f" % (impl, rows, len(items) * DOWNLOADS, elapsed / DOWNLOADS * 1000))
+
+
+if __name__ == '__main__':
+    main()
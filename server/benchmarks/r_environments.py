@@ -0,0 +1,90 @@
+"""
+Time to render R questions when every render sources the question's script
+again, compared to keeping sourced scripts resident in R_ENV_CACHE. Renders
+a skewed sequence of questions from a generated material bank, the way a
+class working through a lecture would, in this process.
+
+    ./bin/python -m benchmarks.r_environments
+"""
+import os
+import random
+import tempfile
+import time
+import types
+
+from tutorweb_quizdb.material.renderer.r import r_render_local, R_ENV_CACHE
+
+QUESTIONS = 200
+RENDERS = 2000
+
+QUESTION_TEMPLATE = """
+# TW:TAGS=bench,
+# TW:PERMUTATIONS=100
+library(htmltools)
+
+ages <- data.frame(
+    age = c(%(ages)s),
+    length = c(%(lengths)s)
+)
+
+format_choice <- function (x) {
+    withTags(li(sprintf("%%.2f", x)))
+}
+
+choices <- function (permutation) {
+    fit <- lm(length ~ age, data = ages)
+    correct <- coef(fit)[[2]] * (1 + permutation / 100)
+    sample(c(correct, correct * c(0.5, 1.5, 2)))
+}
+
+question <- function (permutation, data_frames) {
+    set.seed(permutation)
+    x <- choices(permutation)
+    list(
+        content = as.character(withTags(div(
+            p("Question %(n)d: what is the slope?"),
+            ol(lapply(x, format_choice))
+        ))),
+        correct = list(choice_correct = list(nonempty = TRUE))
+    )
+}
+"""
+
+
+def write_bank(bank):
+    """Write QUESTIONS scripts into (bank), return list of fake material sources"""
+    rng = random.Random(0)
+    out = []
+    for n in range(QUESTIONS):
+        path = 'bench%03d.q.R' % n
+        with open(os.path.join(bank, path), 'w') as f:
+            f.write(QUESTION_TEMPLATE % dict(
+                n=n,
+                ages=", ".join(str(rng.randint(1, 20)) for _ in range(50)),
+                lengths=", ".join("%.1f" % rng.uniform(10, 100) for _ in range(50)),
+            ))
+        out.append(types.SimpleNamespace(bank=bank, path=path, md5sum='bench%d' % n))
+    return out
+
+
+def main():
+    with tempfile.TemporaryDirectory() as bank:
+        mss = write_bank(bank)
+        # Most renders are a few popular questions
+        rng = random.Random(1)
+        sequence = [(rng.choices(mss, weights=[1 / (i + 1) for i in range(len(mss))])[0], rng.randrange(100)) for _ in range(RENDERS)]
+
+        print("%-10s %10s %12s %14s" % ('impl', 'renders', 'time (s)', 'per render (ms)'))
+        for impl, resident in (('source', False), ('resident', True)):
+            R_ENV_CACHE.clear()
+            start = time.perf_counter()
+            for ms, permutation in sequence:
+                if not resident:
+                    R_ENV_CACHE.clear()
+                r_render_local(ms, permutation)
+            elapsed = time.perf_counter() - start
+            print("%-10s %10d %12.2f %14.2f" % (impl, len(sequence), elapsed, elapsed / len(sequence) * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Throughput of regrade() over a cohort's answers, compared to regrading one
+answer queue at a time with a query per student. All stored grades start
+wrong, so "update" rewrites every answer, then "check" finds nothing to do.
+Most of "update" is answer's row triggers, telling clients to resync.
+Times are extrapolated to 10M answers.
+
+    ./bin/python -m benchmarks.regrade
+"""
+import time
+
+import transaction
+from zope.sqlalchemy import mark_changed
+
+from tutorweb_quizdb import DBSession
+from tutorweb_quizdb.stage.iaa import answer_queue_grades
+from tutorweb_quizdb.syllabus.regrade import regrade
+
+from benchmarks import bench_database, create_stage, create_material
+
+STUDENTS = 1000
+ANSWERS_PER_STUDENT = 200
+
+
+def per_student_regrade(stage_id, settings):
+    """Fetch & grade each student's answer queue separately"""
+    discrepancies = 0
+    user_ids = [r[0] for r in DBSession.execute("SELECT DISTINCT user_id FROM answer WHERE stage_id = :stage_id", dict(stage_id=stage_id))]
+    for user_id in user_ids:
+        rows = DBSession.execute("""
+            SELECT correct, grade FROM answer
+             WHERE stage_id = :stage_id AND user_id = :user_id
+          ORDER BY time_end, time_offset
+        """, dict(stage_id=stage_id, user_id=user_id)).fetchall()
+        grades = answer_queue_grades([float(r[0]) for r in rows], settings)
+        discrepancies += sum(1 for r, g in zip(rows, grades) if abs(g - float(r[1])) > 0.0005)
+    return discrepancies
+
+
+def main():
+    with bench_database():
+        create_material('bench', 50, ['type.question', 'bench'])
+        stage_id = create_stage('bench.tut.lec0', {}, ['type.question', 'bench']).stage_id
+        DBSession.execute("""
+            INSERT INTO "user" (host_id, user_name, email, pw_hash, salt)
+                 SELECT 1, 'bench_' || i, 'bench_' || i || '@example.com', '-', '-'
+                   FROM GENERATE_SERIES(1, :students) i
+        """, dict(students=STUDENTS))
+        DBSession.execute("""
+            INSERT INTO answer (stage_id, user_id, material_source_id, permutation, client_id, time_end, correct, grade)
+                 SELECT :stage_id, u.user_id, (SELECT MIN(material_source_id) FROM material_source), 1, 'bench'
+                      , TIMESTAMP '2020-01-01' + i * INTERVAL '1 minute', (u.user_id + i) % 3 > 0, 0
+                   FROM "user" u, GENERATE_SERIES(1, :answers) i
+                  WHERE u.user_name LIKE 'bench_%'
+        """, dict(stage_id=stage_id, answers=ANSWERS_PER_STUDENT))
+        mark_changed(DBSession())
+        transaction.commit()
+        DBSession.execute("ANALYZE")  # Otherwise the planner has no idea how big answer now is
+        total = STUDENTS * ANSWERS_PER_STUDENT
+
+        print("%-12s %10s %14s %12s %18s" % ('impl', 'answers', 'discrepancies', 'time (s)', '10M answers (min)'))
+        start = time.perf_counter()
+        discrepancies = per_student_regrade(stage_id, {})
+        elapsed = time.perf_counter() - start
+        print("%-12s %10d %14d %12.2f %18.1f" % ('per-student', total, discrepancies, elapsed, elapsed / total * 10000000 / 60))
+
+        for impl, update in (('update', True), ('check', False)):
+            summary = {}
+            for _ in regrade('bench', update=update, summary=summary):
+                pass
+            print("%-12s %10d %14d %12.2f %18.1f" % (
+                impl, summary['answers'], summary['discrepancies'], summary['elapsed'],
+                summary['elapsed'] / summary['answers'] * 10000000 / 60,
+            ))
+        transaction.abort()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Time taken by OriginalAllocation to choose a student's question bank from
+a large stage, once material & stats have been fetched:
+
+* uniform: As before, random.sample ignoring difficulty
+* weighted: difficulty_weights & weighted_sample around the student's grade
+* index: allocation_bank_selection=index, from permutation counts of 10 per material
+
+...then the whole of get_material() against a database, including the
+queries that fetch material (and for difficulty, the PERCENT_RANK over
+answer_stats). "difficulty" is the cost when the bank is chosen, i.e. at the
+first sync after a refresh, "snapshot" is every request after that.
+
+    ./bin/python -m benchmarks.sample_material
+"""
+import random
+import time
+
+import numpy as np
+import transaction
+from zope.sqlalchemy import mark_changed
+
+from tutorweb_quizdb import DBSession, Base
+from tutorweb_quizdb.stage.allocation import get_allocation, difficulty_weights, weighted_sample, material_at_index
+
+from benchmarks import bench_database, create_student, create_stage, create_material
+
+BANK_SIZES = [1000, 10000, 50000, 1000000]
+DB_BANK_SIZES = [1000, 10000, 50000]
+QUESTION_CAP = 100
+REQUESTS = 100
+DB_REQUESTS = 10
+
+
+def main():
+    print("%-10s %10s %12s" % ('method', 'bank', 'ms'))
+    for bank_size in BANK_SIZES:
+        data_rng = np.random.default_rng(0)
+        material = [(i // 10 + 1, i % 10 + 1) for i in range(bank_size)]
+        # Rows as returned by get_material's query, i.e. with difficulty percentile
+        rows = [m + (float(p),) for m, p in zip(material, data_rng.random(bank_size))]
+
+        start = time.perf_counter()
+        for i in range(REQUESTS):
+            local_random = random.Random()
+            local_random.seed(44 + i)
+            local_random.sample(material, QUESTION_CAP)
+        print("%-10s %10d %12.2f" % ('uniform', bank_size, (time.perf_counter() - start) / REQUESTS * 1000))
+
+        start = time.perf_counter()
+        for i in range(REQUESTS):
+            chosen = weighted_sample(
+                difficulty_weights(np.fromiter((m[2] for m in rows), float, len(rows)), i % 10),
+                QUESTION_CAP,
+                np.random.default_rng([44, i]),
+            )
+            [rows[x][:2] for x in chosen]
+        print("%-10s %10d %12.2f" % ('weighted', bank_size, (time.perf_counter() - start) / REQUESTS * 1000))
+
+        # Rows as returned by _get_material_by_index's query
+        counts = [(i + 1, 10) for i in range(bank_size // 10)]
+        start = time.perf_counter()
+        for i in range(REQUESTS):
+            mss_ids = np.array([c[0] for c in counts], dtype=int)
+            permutation_counts = np.array([c[1] for c in counts], dtype=int)
+            indexes = np.random.default_rng([44, i]).choice(int(permutation_counts.sum()), size=QUESTION_CAP, replace=False)
+            material_at_index(mss_ids, permutation_counts, indexes)
+        print("%-10s %10d %12.2f" % ('index', bank_size, (time.perf_counter() - start) / REQUESTS * 1000))
+
+    print("")
+    print("get_material(), including queries")
+    print("%-10s %10s %12s" % ('method', 'bank', 'ms'))
+    with bench_database():
+        for bank_size in DB_BANK_SIZES:
+            bank_tag = 'bench%d' % bank_size
+            create_material(bank_tag, bank_size // 10, ['type.question', bank_tag])
+            stage_id = create_stage('bench.tut.lec%d' % bank_size, {}, ['type.question', bank_tag]).stage_id
+            user_id = create_student('bench_%d' % bank_size).id
+            # Give every question some (made up) stats
+            DBSession.execute("""
+                INSERT INTO answer_stats (stage_id, material_source_id, permutation, answered, correct)
+                     SELECT sm.stage_id, sm.material_source_id, sm.permutation, 10, (sm.material_source_id * sm.permutation) % 11
+                       FROM stage_material sm
+                      WHERE sm.stage_id = :stage_id
+            """, dict(stage_id=stage_id))
+            mark_changed(DBSession())
+            transaction.commit()
+            DBSession.execute("ANALYZE")
+
+            def get_alloc(bank_selection):
+                from tutorweb_quizdb.models import User
+                alloc = get_allocation(dict(
+                    allocation_method='original',
+                    allocation_bank_selection=bank_selection,
+                    allocation_seed=44,
+                    allocation_encryption_key='toottoottoot',
+                ), DBSession.query(Base.classes.stage).get(stage_id), DBSession.query(User).get(user_id))
+                alloc.question_cap = QUESTION_CAP
+                return alloc
+
+            for bank_selection in ('uniform', 'difficulty', 'index'):
+                alloc = get_alloc(bank_selection)
+                start = time.perf_counter()
+                for i in range(DB_REQUESTS):
+                    alloc.get_material()
+                print("%-10s %10d %12.2f" % (bank_selection, bank_size, (time.perf_counter() - start) / DB_REQUESTS * 1000))
+
+            alloc = get_alloc('difficulty')
+            alloc.update_bank()
+            start = time.perf_counter()
+            for i in range(DB_REQUESTS):
+                alloc.get_material()
+            print("%-10s %10d %12.2f" % ('snapshot', bank_size, (time.perf_counter() - start) / DB_REQUESTS * 1000))
+            transaction.abort()
+
+
+if __name__ == '__main__':
+    main()
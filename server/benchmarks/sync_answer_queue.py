@@ -0,0 +1,134 @@
+"""
+Compare round trips & lock hold time of sync_answer_queue against the
+previous ORM implementation, which locked the student's answers and
+flushed after every entry.
+
+    ./bin/python -m benchmarks.sync_answer_queue
+"""
+import time
+
+import transaction
+
+from tutorweb_quizdb import DBSession, Base
+from tutorweb_quizdb.stage.allocation import get_allocation
+from tutorweb_quizdb.stage.answer_queue import sync_answer_queue, mark_aq_entry, db_to_incoming
+from tutorweb_quizdb.stage.setting import getStudentSettings
+from tutorweb_quizdb.timestamp import timestamp_to_datetime, datetime_to_timestamp
+
+from benchmarks import bench_database, StatementCounter, create_student, create_stage, create_material
+
+
+def orm_sync_answer_queue(alloc, in_queue, time_offset):
+    """sync_answer_queue as it was, an ORM object per answer and a flush per entry"""
+    all_stages = [x[0] for x in DBSession.execute("""
+        SELECT stage_id FROM stage_lineage WHERE latest_stage_id = :stage_id
+    """, dict(stage_id=alloc.db_stage.stage_id))]
+    db_queue = (DBSession.query(Base.classes.answer)
+                .filter(Base.classes.answer.stage_id.in_(all_stages))
+                .filter(Base.classes.answer.user_id == alloc.db_student.id)
+                .order_by(Base.classes.answer.time_end, Base.classes.answer.time_offset)
+                .with_for_update().all())
+    for a in in_queue:
+        a['time_offset'] = time_offset
+    in_queue.sort(key=lambda a: (a['time_end'], a['time_offset']))
+
+    db_i = in_i = additions = 0
+    out = []
+    grade_hwm = 0
+    while db_i < len(db_queue) or in_i < len(in_queue):
+        if db_i >= len(db_queue):
+            cmp = -1
+        elif in_i >= len(in_queue):
+            cmp = 1
+        else:
+            cmp = in_queue[in_i]['time_end'] - datetime_to_timestamp(db_queue[db_i].time_end)
+        if cmp == 0:
+            db_entry = db_queue[db_i]
+            db_i += 1
+            in_i += 1
+        elif cmp < 0:
+            (mss_id, permutation) = alloc.from_public_id(in_queue[in_i]['uri'])
+            DBSession.query(Base.classes.material_source).filter_by(material_source_id=mss_id).one()
+            db_entry = Base.classes.answer(
+                stage_id=alloc.db_stage.stage_id,
+                user_id=alloc.db_student.id,
+                material_source_id=mss_id,
+                permutation=permutation,
+                client_id=in_queue[in_i]['client_id'],
+                time_start=timestamp_to_datetime(in_queue[in_i]['time_start']),
+                time_end=timestamp_to_datetime(in_queue[in_i]['time_end']),
+                time_offset=time_offset,
+                correct=in_queue[in_i]['correct'],
+                grade=in_queue[in_i]['grade_after'],
+                coins_awarded=0,
+                student_answer=in_queue[in_i]['student_answer'],
+                review=None,
+            )
+            DBSession.add(db_entry)
+            additions += 1
+            in_i += 1
+        else:
+            db_entry = db_queue[db_i]
+            db_i += 1
+        db_entry.ug_reviews = None
+        mark_aq_entry(db_entry, alloc, grade_hwm)
+        out.append(db_to_incoming(alloc, db_entry))
+        grade_hwm = max(grade_hwm, db_entry.grade)
+        DBSession.flush()
+    return (out, additions)
+
+
+def answers(alloc, start, count):
+    """Generate (count) answers to the benchmark material"""
+    return [dict(
+        client_id='bench',
+        uri=alloc.to_public_id(i % 50 + 1, i % 10 + 1),
+        time_start=1000 + i * 10,
+        time_end=1005 + i * 10,
+        correct=bool(i % 2),
+        grade_after=min(i / 10, 9.9),
+        student_answer=dict(choice=i % 4),
+    ) for i in range(start, start + count)]
+
+
+def main():
+    with bench_database() as db_session:
+        counter = StatementCounter(db_session.get_bind())
+        create_material('bench', 50, ['type.question', 'bench'])
+        stage_id = create_stage('bench.tut.lec0', dict(
+            allocation_method=dict(value='original'),
+        ), ['type.question', 'bench']).stage_id
+        transaction.commit()
+
+        print("%-8s %8s %8s %12s %16s" % ('impl', 'existing', 'new', 'statements', 'lock held (ms)'))
+        for i, (existing, new) in enumerate([(0, 50), (500, 50), (2000, 50), (2000, 1)]):
+            for impl_name, impl in (('orm', orm_sync_answer_queue), ('core', sync_answer_queue)):
+                user_id = create_student('bench_%d_%s' % (i, impl_name)).id
+                transaction.commit()
+
+                def get_alloc():
+                    from tutorweb_quizdb.models import User
+                    db_stage = DBSession.query(Base.classes.stage).get(stage_id)
+                    db_student = DBSession.query(User).get(user_id)
+                    return get_allocation(getStudentSettings(db_stage, db_student), db_stage, db_student)
+
+                # Fill up existing answer queue, this isn't measured
+                if existing > 0:
+                    alloc = get_alloc()
+                    sync_answer_queue(alloc, answers(alloc, 0, existing), 0)
+                    transaction.commit()
+
+                alloc = get_alloc()
+                counter.reset()
+                impl(alloc, answers(alloc, existing, new), 0)
+                transaction.commit()
+                if counter.lock_time is None:
+                    lock_held = '-'  # No rows locked
+                else:
+                    lock_held = '%.1f' % ((time.perf_counter() - counter.lock_time) * 1000)
+                print("%-8s %8d %8d %12d %16s" % (impl_name, existing, new, counter.statements, lock_held))
+        counter.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Size & serialization time of a stage sync response with a long answer queue,
+as plain JSON and each of the columnar options a client can ask for.
+
+    ./bin/python -m benchmarks.wire_format
+"""
+import time
+
+from pyramid import testing
+from pyramid.request import Request
+
+from tutorweb_quizdb.columnar_renderer import ColumnarRenderer, compress, COLUMNAR_CONTENT_TYPE
+
+QUEUE_LENGTH = 5000
+REQUESTS = 10
+
+FORMATS = [
+    ('json', dict(Accept='application/json')),
+    ('json+gzip', dict(Accept='application/json')),
+    ('columnar', dict(Accept=COLUMNAR_CONTENT_TYPE)),
+    ('columnar+gzip', {'Accept': COLUMNAR_CONTENT_TYPE, 'Accept-Encoding': 'gzip'}),
+    ('columnar+deflate', {'Accept': COLUMNAR_CONTENT_TYPE, 'Accept-Encoding': 'deflate'}),
+]
+
+
+def stage_response():
+    """Something that looks like stage_index output, see db_to_incoming"""
+    return dict(
+        uri='/api/stage?path=dept.tutorial.lec0.stage0',
+        path='dept.tutorial.lec0.stage0',
+        user='student0',
+        answerQueue=[dict(
+            uri='dept/tutorial/lec0/q%d.q.R:%d:1' % (i % 500, i % 10 + 1),
+            client_id='01',
+            time_start=1500000000 + i * 60,
+            time_end=1500000000 + i * 60 + 45,
+            time_offset=0,
+            correct=i % 3 != 0,
+            grade_after=round(i % 100 / 10, 3),
+            student_answer=dict(choice=i % 4),
+            review=None,
+            synced=True,
+            mark=0,
+            ug_reviews=[],
+        ) for i in range(QUEUE_LENGTH)],
+        sync_cursor=None,
+    )
+
+
+def main():
+    config = testing.setUp()
+    value = stage_response()
+
+    print("%-18s %12s %12s" % ('format', 'bytes', 'ms'))
+    for name, headers in FORMATS:
+        renderer = ColumnarRenderer({})
+        start = time.perf_counter()
+        for i in range(REQUESTS):
+            request = Request.blank('/', headers=headers)
+            request.registry = config.registry
+            body = renderer(value, dict(request=request))
+            if name == 'json+gzip':
+                # What we'd get if something in front of us compressed plain JSON
+                body = compress(body.encode('utf8'), 'gzip')
+        elapsed = (time.perf_counter() - start) / REQUESTS * 1000
+        print("%-18s %12d %12.1f" % (name, len(body), elapsed))
+    testing.tearDown()
+
+
+if __name__ == '__main__':
+    main()
@@ -59,9 +59,14 @@ setup(
         'console_scripts': [
             'syllabus_import=tutorweb_quizdb.syllabus.add:script',
             'student_results=tutorweb_quizdb.syllabus.results:script_syllabus_results',
+            'student_regrade=tutorweb_quizdb.syllabus.regrade:script_syllabus_regrade',
             'student_import=tutorweb_quizdb.student.create:script_student_import',
             'material_update=tutorweb_quizdb.material.update:script_material_update',
             'material_render=tutorweb_quizdb.material.render:script_material_render',
+            'answer_stats=tutorweb_quizdb.stage.answer_stats:script_answer_stats',
+            'stage_material_refresh=tutorweb_quizdb.material.stage_link:script_stage_material_refresh',
+            'exam_prepare=tutorweb_quizdb.stage.exam:script_exam_prepare',
+            'stage_settings_assign=tutorweb_quizdb.stage.setting:script_stage_settings_assign',
         ],
     },
 )
@@ -15,6 +15,12 @@ class RequiresPyramid():
         if hasattr(self, 'postgresql'):
             self.db_session = tutorweb_quizdb.initialize_dbsession(dict(url=self.postgresql.url()))
 
+            # A fresh database will re-use IDs, so forget anything cached against them
+            from tutorweb_quizdb.stage.setting import SETTINGS_CACHE
+            from tutorweb_quizdb.material.render import RENDER_CACHE
+            SETTINGS_CACHE.clear()
+            RENDER_CACHE.clear()
+
     def tearDown(self):
         if hasattr(self, 'db_session'):
             self.db_session.remove()
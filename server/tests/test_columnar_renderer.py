@@ -0,0 +1,85 @@
+import gzip
+import json
+import unittest
+import zlib
+
+from pyramid import testing
+from pyramid.request import Request
+
+from tutorweb_quizdb.columnar_renderer import ColumnarRenderer, pack_columns, COLUMNAR_CONTENT_TYPE
+
+
+class PackColumnsTest(unittest.TestCase):
+    def test_call(self):
+        # Lists of objects with the same keys get packed
+        self.assertEqual(pack_columns([
+            dict(a=1, b='x'),
+            dict(b='y', a=2),
+            dict(a=3, b=None),
+        ]), dict(
+            _columns=['a', 'b'],
+            _values=[[1, 2, 3], ['x', 'y', None]],
+        ))
+
+        # Anything else is left alone
+        self.assertEqual(pack_columns([]), [])
+        self.assertEqual(pack_columns([1, 2, 3]), [1, 2, 3])
+        self.assertEqual(pack_columns([{}, {}]), [{}, {}])
+        self.assertEqual(pack_columns([dict(a=1), dict(b=1)]), [dict(a=1), dict(b=1)])
+        self.assertEqual(pack_columns([dict(a=1), 2]), [dict(a=1), 2])
+        self.assertEqual(pack_columns('moo'), 'moo')
+
+        # Nested lists get packed too
+        self.assertEqual(pack_columns(dict(answerQueue=[
+            dict(uri='a', ug_reviews=[dict(mark=1), dict(mark=2)]),
+            dict(uri='b', ug_reviews=[]),
+        ], path='x.y')), dict(answerQueue=dict(
+            _columns=['uri', 'ug_reviews'],
+            _values=[['a', 'b'], [dict(_columns=['mark'], _values=[[1, 2]]), []]],
+        ), path='x.y'))
+
+
+class ColumnarRendererTest(unittest.TestCase):
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_call(self):
+        def render(value, **headers):
+            request = Request.blank('/', headers=headers)
+            request.registry = self.config.registry
+            return ColumnarRenderer({})(value, dict(request=request)), request.response
+
+        big = dict(answerQueue=[dict(uri='ut:question%d' % i, correct=i % 2 == 0) for i in range(100)])
+
+        # By default, we get JSON, no compression
+        body, response = render(big)
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(json.loads(body), big)
+        body, response = render(big, Accept='application/json, text/javascript, */*; q=0.01', **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_type, 'application/json')
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(json.loads(body), big)
+        self.assertIn('Accept', response.vary)
+
+        # Ask for columnar, get columnar but not compressed
+        body, response = render(big, Accept=COLUMNAR_CONTENT_TYPE + ', application/json; q=0.9')
+        self.assertEqual(response.content_type, COLUMNAR_CONTENT_TYPE)
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(json.loads(body.decode('utf8')), pack_columns(big))
+
+        # Also ask for compression, get it
+        body, response = render(big, Accept=COLUMNAR_CONTENT_TYPE, **{'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.content_encoding, 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(body).decode('utf8')), pack_columns(big))
+        body, response = render(big, Accept=COLUMNAR_CONTENT_TYPE, **{'Accept-Encoding': 'deflate, gzip;q=0.5'})
+        self.assertEqual(response.content_encoding, 'deflate')
+        self.assertEqual(json.loads(zlib.decompress(body).decode('utf8')), pack_columns(big))
+
+        # Small responses aren't worth compressing
+        body, response = render(dict(answerQueue=[]), Accept=COLUMNAR_CONTENT_TYPE, **{'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(json.loads(body.decode('utf8')), dict(answerQueue=[]))
@@ -1,10 +1,13 @@
+from decimal import Decimal
 import unittest
 import unittest.mock
 
+import transaction
+
 from .requires_postgresql import RequiresPostgresql
 from .requires_pyramid import RequiresPyramid
 
-from tutorweb_quizdb.lti import TwRequestValidator, view_tool_config
+from tutorweb_quizdb.lti import TwRequestValidator, lti_replace_grade, view_tool_config
 
 
 # NB: We RequiresPyramid to make sure DBSession is set up
@@ -73,6 +76,75 @@ class TwRequestValidatorTest(RequiresPyramid, RequiresPostgresql, unittest.TestC
             TwRequestValidator({v.dummy_client: "woo"})
 
 
+class LtiReplaceGradeTest(RequiresPyramid, RequiresPostgresql, unittest.TestCase):
+    @unittest.mock.patch('tutorweb_quizdb.lti.request_validator', TwRequestValidator(dict(k1="secret1")))
+    @unittest.mock.patch('tutorweb_quizdb.lti.OutcomeRequest')
+    def test_call(self, mock_outcome):
+        from tutorweb_quizdb import DBSession, Base
+        from tutorweb_quizdb.models import User
+
+        transaction.begin()  # NB: We're committing, so start from a clean transaction
+        stage_id = self.create_stages(1)[0].stage_id
+        user_ids = [u.user_id for u in self.create_students(2)]
+        DBSession.add(Base.classes.lti_sourcedid(
+            user_id=user_ids[0],
+            stage_id=stage_id,
+            client_key='k1',
+            lis_outcome_service_url='http://lti.example.com/outcome',
+            lis_result_sourcedid='sourcedid0',
+        ))
+        transaction.commit()
+        mock_post = mock_outcome.return_value.post_replace_result
+        mock_post.return_value.is_success.return_value = True
+
+        def replace_grade(user_id, grade):
+            # NB: Fetch objects each time, committing detaches them
+            lti_replace_grade(DBSession.query(Base.classes.stage).get(stage_id), DBSession.query(User).get(user_id), grade)
+
+        def last_reported():
+            return DBSession.execute("SELECT last_perc, last_error FROM lti_sourcedid WHERE stage_id = :stage_id", dict(
+                stage_id=stage_id,
+            )).fetchall()
+
+        # Nothing is sent until the transaction commits, students without an LTI are ignored
+        replace_grade(user_ids[0], 5.5)
+        replace_grade(user_ids[1], 5.5)
+        self.assertEqual(mock_post.call_count, 0)
+        transaction.commit()
+        self.assertEqual(mock_outcome.call_args_list, [unittest.mock.call(opts=dict(
+            consumer_key='k1',
+            consumer_secret='secret1',
+            lis_outcome_service_url='http://lti.example.com/outcome',
+            lis_result_sourcedid='sourcedid0',
+        ))])
+        self.assertEqual(mock_post.call_args_list, [unittest.mock.call(Decimal('0.5500'))])
+        self.assertEqual(last_reported(), [(Decimal('0.5500'), None)])
+
+        # Unchanged grades aren't sent again, nor is anything from an aborted transaction
+        replace_grade(user_ids[0], 5.5)
+        transaction.commit()
+        replace_grade(user_ids[0], 8)
+        transaction.abort()
+        self.assertEqual(mock_post.call_count, 1)
+
+        # Failures are recorded, last_perc is still what the consumer last accepted
+        mock_post.return_value.is_success.return_value = False
+        mock_post.return_value.description = 'Go away'
+        replace_grade(user_ids[0], 8)
+        transaction.commit()
+        self.assertEqual(mock_post.call_args_list[-1], unittest.mock.call(Decimal('0.8000')))
+        self.assertEqual(last_reported(), [(Decimal('0.5500'), 'Go away')])
+
+        # Errors talking to the consumer are logged & recorded too
+        mock_post.side_effect = ConnectionError("No route to host")
+        replace_grade(user_ids[0], 9)
+        with self.assertLogs('tutorweb_quizdb', level='WARNING') as logs:
+            transaction.commit()
+        self.assertIn('user %d, stage %d' % (user_ids[0], stage_id), logs.output[0])
+        self.assertEqual(last_reported(), [(Decimal('0.5500'), 'ConnectionError: No route to host')])
+        transaction.abort()
+
+
 class ViewToolConfigTest(RequiresPyramid, unittest.TestCase):
     def test_call(self):
         resp = view_tool_config(self.request())
@@ -1,4 +1,7 @@
+import json
+import types
 import unittest
+import unittest.mock
 
 from pyramid.httpexceptions import HTTPForbidden
 
@@ -6,7 +9,7 @@ from .requires_postgresql import RequiresPostgresql
 from .requires_pyramid import RequiresPyramid
 from .requires_materialbank import RequiresMaterialBank
 
-from tutorweb_quizdb.material.render import view_material_render
+from tutorweb_quizdb.material.render import view_material_render, material_render_many, material_render_cache_info, RENDER_CACHE, CONFIG
 
 
 class ViewMaterialRender(RequiresMaterialBank, RequiresPyramid, RequiresPostgresql, unittest.TestCase):
@@ -81,3 +84,164 @@ question <- function(permutation, data_frames) { return(list(content = '', corre
             correct=[],
             tags=['ex.12', 'type.question'],
         ))
+
+
+def fake_r_render(ms, permutation, student_dataframes={}, dataframe_digest=None):
+    if permutation == 9:
+        raise ValueError("Broken")
+    return dict(content='%s:%d:%s' % (ms.path, permutation, json.dumps(student_dataframes, sort_keys=True)), correct=[])
+
+
+class MaterialRenderManyTest(RequiresMaterialBank, RequiresPyramid, RequiresPostgresql, unittest.TestCase):
+    def tearDown(self):
+        CONFIG['persistent_cache'] = True
+        super(MaterialRenderManyTest, self).tearDown()
+
+    def mss(self, path):
+        from tutorweb_quizdb import DBSession, Base
+
+        return DBSession.query(Base.classes.material_source).filter_by(path=path, next_material_source_id=None).one()
+
+    def db_cache(self):
+        from tutorweb_quizdb import DBSession
+
+        return DBSession.execute("""
+            SELECT ms.path, c.permutation, c.dataframe_digest != ''
+              FROM material_render_cache c
+              JOIN material_source ms ON ms.material_source_id = c.material_source_id
+          ORDER BY ms.path, c.permutation, c.dataframe_digest
+        """).fetchall()
+
+    @unittest.mock.patch('tutorweb_quizdb.material.render.r_render', side_effect=fake_r_render)
+    def test_call(self, mock_render):
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=ex.12
+# TW:PERMUTATIONS=10
+        ''')
+        self.mb_write_file('example2.q.R', b'''
+# TW:TAGS=ex.12
+# TW:PERMUTATIONS=10
+# TW:DATAFRAMES=df/data_a.json
+        ''')
+        self.mb_write_file('example3.q.R', b'''
+# TW:TAGS=ex.12
+# TW:PERMUTATIONS=10
+# TW:RENDERCACHE=false
+        ''')
+        self.mb_update()
+        self.assertEqual([self.mss(p).render_cache for p in ['example1.q.R', 'example2.q.R', 'example3.q.R']], [True, True, False])
+        mock_render.reset_mock()
+        info = material_render_cache_info()
+
+        def items(df_a=dict(cow="moo")):
+            return [
+                (self.mss('example1.q.R'), 1, {}),
+                (self.mss('example1.q.R'), 2, {}),
+                (self.mss('example2.q.R'), 1, {'df/data_a.json': df_a, 'df/data_b.json': dict(pig="oink")}),
+                (self.mss('example3.q.R'), 1, {}),
+                (self.mss('example1.q.R'), 9, {}),
+            ]
+
+        # First time everything gets rendered, except errors & opted-out questions are stored
+        out = material_render_many(items())
+        self.assertEqual([x['content'] for x in out[:4]], [
+            'example1.q.R:1:{}',
+            'example1.q.R:2:{}',
+            'example2.q.R:1:{"df/data_a.json": {"cow": "moo"}, "df/data_b.json": {"pig": "oink"}}',
+            'example3.q.R:1:{}',
+        ])
+        self.assertEqual(out[4]['error'], 'ValueError')
+        self.assertEqual(mock_render.call_count, 5)
+        self.assertEqual(self.db_cache(), [
+            ('example1.q.R', 1, False),
+            ('example1.q.R', 2, False),
+            ('example2.q.R', 1, True),
+        ])
+
+        # Second time, the in-process cache is used
+        out[0]['content'] = 'altered'
+        out[0]['correct'].append('altered')
+        self.assertEqual(material_render_many(items())[:4], [
+            dict(content='example1.q.R:1:{}', correct=[], tags=['ex.12', 'type.question']),
+        ] + out[1:4])
+        self.assertEqual(mock_render.call_count, 7)
+
+        # Without it, we fetch from the DB
+        RENDER_CACHE.clear()
+        self.assertEqual(material_render_many(items())[1:4], out[1:4])
+        self.assertEqual(mock_render.call_count, 9)
+        self.assertEqual(material_render_cache_info()['db_hits'] - info['db_hits'], 3)
+
+        # Different data in dataframes the question uses means a fresh render
+        out = material_render_many(items(df_a=dict(cow="oink")))
+        self.assertEqual(out[2]['content'], 'example2.q.R:1:{"df/data_a.json": {"cow": "oink"}, "df/data_b.json": {"pig": "oink"}}')
+        self.assertEqual(mock_render.call_count, 12)
+        self.assertEqual(len(self.db_cache()), 4)
+
+        # Updating material forgets the old version
+        old_mss_id = self.mss('example1.q.R').material_source_id
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=ex.12
+# TW:PERMUTATIONS=20
+        ''')
+        self.mb_update()
+        self.assertEqual(self.db_cache(), [
+            ('example2.q.R', 1, True),
+            ('example2.q.R', 1, True),
+        ])
+        mock_render.reset_mock()
+        material_render_many(items()[:1])
+        self.assertEqual(mock_render.call_count, 1)
+        self.assertNotEqual(self.mss('example1.q.R').material_source_id, old_mss_id)
+
+        # Without the persistent cache, nothing gets stored
+        CONFIG['persistent_cache'] = False
+        material_render_many([(self.mss('example1.q.R'), 3, {})])
+        self.assertEqual(len(self.db_cache()), 3)
+
+    @unittest.mock.patch('tutorweb_quizdb.material.render.r_render', side_effect=fake_r_render)
+    def test_dataframe_digest(self, mock_render):
+        """Student dataframes are digested once per batch, the renderer gets all of them and a digest of all of them"""
+        from tutorweb_quizdb.material.render import dataframe_digest, student_dataframes_digest
+
+        self.mb_write_file('example2.q.R', b'''
+# TW:TAGS=ex.12
+# TW:PERMUTATIONS=10
+# TW:DATAFRAMES=df/data_a.json
+        ''')
+        self.mb_update()
+        mock_render.reset_mock()
+        sd = {'df/data_a.json': dict(cow="moo"), 'df/data_b.json': dict(pig="oink")}
+
+        with unittest.mock.patch('tutorweb_quizdb.material.render.dataframe_digest', wraps=dataframe_digest) as mock_digest:
+            with unittest.mock.patch('tutorweb_quizdb.material.render.student_dataframes_digest', wraps=student_dataframes_digest) as mock_all_digest:
+                material_render_many([(self.mss('example2.q.R'), p, sd) for p in range(1, 6)])
+        self.assertEqual(mock_digest.call_count, 1)
+        self.assertEqual(mock_all_digest.call_count, 1)
+        self.assertEqual([c[0][2] for c in mock_render.call_args_list], [sd] * 5)
+        self.assertEqual([c[0][3] for c in mock_render.call_args_list], [student_dataframes_digest(sd)] * 5)
+        self.assertNotEqual(student_dataframes_digest(sd), student_dataframes_digest({'df/data_a.json': dict(cow="moo")}))
+
+    @unittest.mock.patch('tutorweb_quizdb.material.render.r_render', side_effect=fake_r_render)
+    def test_threads(self, mock_render):
+        """With R workers, questions are rendered in other threads, which get a copy of the material source"""
+        from tutorweb_quizdb import Base
+
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=ex.12
+# TW:PERMUTATIONS=10
+        ''')
+        self.mb_update()
+        mock_render.reset_mock()
+
+        with unittest.mock.patch('tutorweb_quizdb.material.renderer.r.R_POOL', types.SimpleNamespace(processes=2)):
+            out = material_render_many([(self.mss('example1.q.R'), p, {}) for p in range(1, 4)])
+        self.assertEqual([x['content'] for x in out], [
+            'example1.q.R:1:{}',
+            'example1.q.R:2:{}',
+            'example1.q.R:3:{}',
+        ])
+        self.assertEqual(mock_render.call_count, 3)
+        for c in mock_render.call_args_list:
+            self.assertNotIsInstance(c[0][0], Base.classes.material_source)
+            self.assertEqual(c[0][0].material_source_id, self.mss('example1.q.R').material_source_id)
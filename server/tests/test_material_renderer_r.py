@@ -1,12 +1,14 @@
 import concurrent.futures
+import json
 import os
 import unittest
+import unittest.mock
 import time
 
 import rpy2.robjects as robjects
 
-from tutorweb_quizdb.material.render import material_render, MissingDataException
-from tutorweb_quizdb.material.renderer.r import rob_to_dict
+from tutorweb_quizdb.material.render import material_render, material_render_many, MissingDataException
+from tutorweb_quizdb.material.renderer.r import rob_to_dict, r_render_local, configure_pool, R_DATAFRAME_CACHE, r_render_info, RWorkerPool, CONFIG, BREAKER
 
 from .requires_materialbank import RequiresMaterialBank
 
@@ -45,6 +47,11 @@ class RobToDictTest(unittest.TestCase):
 
 
 class MaterialRenderTest(RequiresMaterialBank, unittest.TestCase):
+    def setUp(self):
+        super(MaterialRenderTest, self).setUp()
+        # Render in this process, so we can see what R is doing
+        configure_pool(processes=0)
+
     def test_material_render(self):
         """Make sure we can direct to the various renderers"""
         self.mb_write_file('example.q.R', b'''
@@ -128,6 +135,28 @@ question <- function(permutation, data_frames) {
             tags=['math099', 'Q-0990t0', 'lec050500', 'type.question'],
         ))
 
+    def test_dataframe_cache(self):
+        """Student dataframes are converted once, and questions can't alter the cached copy"""
+        self.mb_write_file('example.q.R', b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=100
+# TW:DATAFRAMES=agelength
+question <- function(permutation, data_frames) {
+    data_frames$agelength$data <- data_frames$agelength$data + permutation
+    return(list(content = paste(data_frames$agelength$data, collapse = ','), correct = list()))
+}
+        ''')
+        R_DATAFRAME_CACHE.clear()
+        sd = dict(agelength=dict(data=[1, 2, 3]))
+        self.assertEqual(material_render(self.mb_fake_ms('example.q.R'), 1, sd)['content'], '2,3,4')
+        self.assertEqual(material_render(self.mb_fake_ms('example.q.R'), 2, sd)['content'], '3,4,5')
+        self.assertEqual(material_render(self.mb_fake_ms('example.q.R'), 2, dict(agelength=dict(data=[1, 2, 3])))['content'], '3,4,5')
+        self.assertEqual((R_DATAFRAME_CACHE.info()['hits'], R_DATAFRAME_CACHE.info()['misses']), (2, 1))
+
+        # Different data is converted again
+        self.assertEqual(material_render(self.mb_fake_ms('example.q.R'), 1, dict(agelength=dict(data=[5])))['content'], '6')
+        self.assertEqual((R_DATAFRAME_CACHE.info()['hits'], R_DATAFRAME_CACHE.info()['misses']), (2, 2))
+
     def test_multithread_safe(self):
         """Make sure we can make multiple calls to the the render concurrently"""
         self.mb_write_file('example.q.R', b'''
@@ -159,3 +188,259 @@ question <- function(permutation, data_frames) {
 
         # Still in the right directory, not snuck into material bank
         self.assertEqual(orig_cwd, os.getcwd())
+
+    def test_question_env(self):
+        """Scripts are sourced once, and again when they change"""
+        script = b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=100
+tw_loads <- get0("tw_loads", envir = globalenv(), ifnotfound = 0) + 1
+assign("tw_loads", tw_loads, envir = globalenv())
+question <- function(permutation, data_frames) {
+    return(list(content = paste0('%s:', permutation, ':', tw_loads), correct = list()))
+}
+        '''
+        robjects.r('''tw_loads <- 0''')
+        self.mb_write_file('example.q.R', script % b'v1')
+        self.mb_write_file('other.q.R', script % b'other')
+        self.assertEqual(r_render_local(self.mb_fake_ms('example.q.R'), 1)['content'], 'v1:1:1')
+        self.assertEqual(r_render_local(self.mb_fake_ms('example.q.R'), 2)['content'], 'v1:2:1')
+        self.assertEqual(r_render_local(self.mb_fake_ms('other.q.R'), 1)['content'], 'other:1:2')
+        self.assertEqual(r_render_local(self.mb_fake_ms('example.q.R'), 3)['content'], 'v1:3:1')
+
+        # Definitions don't leak between scripts
+        with self.assertRaises(KeyError):
+            robjects.globalenv['question']
+
+        # Edited script gets sourced again
+        self.mb_write_file('example.q.R', script % b'v2')
+        self.assertEqual(r_render_local(self.mb_fake_ms('example.q.R'), 1)['content'], 'v2:1:3')
+
+        # Scripts have to define a question
+        self.mb_write_file('example.q.R', b'x <- 1')
+        with self.assertRaisesRegex(Exception, 'did not define a question'):
+            r_render_local(self.mb_fake_ms('example.q.R'), 1)
+
+    def test_question_env_isolated(self):
+        """Renders don't see what previous renders did to the script's variables"""
+        self.mb_write_file('example.q.R', b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=100
+counter <- 0
+bump <- function () counter <<- counter + 1
+question <- function(permutation, data_frames) {
+    counter <<- counter + 10
+    bump()
+    return(list(content = paste0(permutation, ':', counter), correct = list()))
+}
+        ''')
+        self.assertEqual(r_render_local(self.mb_fake_ms('example.q.R'), 1)['content'], '1:11')
+        self.assertEqual(r_render_local(self.mb_fake_ms('example.q.R'), 1)['content'], '1:11')
+        self.assertEqual(r_render_local(self.mb_fake_ms('example.q.R'), 2)['content'], '2:11')
+
+
+class UnpicklableException(Exception):
+    def __init__(self, a, b):
+        super().__init__("%s & %s" % (a, b))
+
+
+def fake_r_render(ms, permutation, student_dataframes={}, dataframe_digest=None):
+    if permutation == 99:
+        raise ValueError("Bad permutation")
+    if permutation == 98:
+        raise UnpicklableException("a", "b")
+    if permutation == 97:
+        os._exit(1)
+    if permutation == 96:
+        time.sleep(60)
+    if permutation == 95:
+        time.sleep(1)
+    time.sleep(0.1)
+    return dict(content='%s:%d' % (ms.path, permutation), pid=os.getpid())
+
+
+class RWorkerPoolTest(RequiresMaterialBank, unittest.TestCase):
+    def setUp(self):
+        super(RWorkerPoolTest, self).setUp()
+        self.mb_write_file('example.q.R', b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=100
+        ''')
+
+        self.mb_write_file('other.q.R', b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=100
+        ''')
+        self.orig_config = dict(CONFIG)
+        configure_pool(processes=0)
+
+    def tearDown(self):
+        # NB: Don't leave a pool behind for other tests
+        configure_pool(**dict(self.orig_config, processes=0))
+        BREAKER.clear()
+        super(RWorkerPoolTest, self).tearDown()
+
+    def test_render_identical(self):
+        """Output from R workers is identical to rendering in-process"""
+        self.mb_write_file('example.q.R', b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=100
+library(htmltools)
+question <- function(permutation, data_frames) {
+    if (permutation == 5) stop('Hammer time')
+    return(list(
+        content = withTags(p(class = "hello", "Question", b(permutation), ".")),
+        correct = list('choice_correct' = list(nonempty = TRUE, values = c(1.5, NA, permutation))),
+        tags = list(NULL)
+    ))
+}
+        ''')
+        items = [(self.mb_fake_ms('example.q.R'), i, {}) for i in range(1, 10)]
+        expected = [json.dumps(material_render(*item), sort_keys=True) for item in items]
+
+        configure_pool(processes=3, max_renders=2)
+        out = [json.dumps(x, sort_keys=True) for x in material_render_many(items)]
+        self.assertEqual(out, expected)
+
+    @unittest.mock.patch('tutorweb_quizdb.material.renderer.r.r_render_local', side_effect=fake_r_render)
+    def test_pool(self, mock_render):
+        ms = self.mb_fake_ms('example.q.R')
+        pool = RWorkerPool(3, max_renders=4)
+        try:
+            # Renders are spread across workers
+            with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+                out = list(executor.map(lambda p: pool.render(ms, p), range(6)))
+            self.assertEqual([x['content'] for x in out], ['example.q.R:%d' % p for p in range(6)])
+            self.assertEqual(len(set(x['pid'] for x in out)), 3)
+            self.assertNotIn(os.getpid(), set(x['pid'] for x in out))
+            self.assertEqual(mock_render.call_count, 0)
+
+            # Exceptions come back up, even if they can't be pickled
+            with self.assertRaisesRegex(ValueError, 'Bad permutation'):
+                pool.render(ms, 99)
+            with self.assertRaisesRegex(Exception, 'a & b') as cm:
+                pool.render(ms, 98)
+            self.assertEqual(cm.exception.__class__.__name__, 'UnpicklableException')
+
+            # Workers get replaced after max_renders
+            pids = [pool.render(ms, 1)['pid'] for i in range(12)]
+            self.assertEqual(sorted(pids.count(p) for p in set(pids)), [4, 4, 4])
+            self.assertTrue(set(pids).isdisjoint(x['pid'] for x in out))
+
+            # Workers that die get replaced
+            with self.assertRaises(EOFError):
+                pool.render(ms, 97)
+            self.assertEqual(
+                [pool.render(ms, 1)['content'] for i in range(6)],
+                ['example.q.R:1'] * 6,
+            )
+        finally:
+            pool.close()
+
+        # Workers are also replaced once they use too much memory
+        pool = RWorkerPool(1, max_memory=1)
+        try:
+            self.assertNotEqual(pool.render(ms, 1)['pid'], pool.render(ms, 1)['pid'])
+        finally:
+            pool.close()
+
+    @unittest.mock.patch('tutorweb_quizdb.material.renderer.r.r_render_local', side_effect=fake_r_render)
+    def test_material_render_many(self, mock_render):
+        items = [(self.mb_fake_ms('example.q.R'), p, {}) for p in [1, 2, 99, 3]]
+
+        # Without a pool, everything is rendered in-process
+        out = material_render_many(items)
+        self.assertEqual([x.get('pid') for x in out], [os.getpid(), os.getpid(), None, os.getpid()])
+        self.assertEqual(mock_render.call_count, 4)
+
+        # With a pool, output is the same but rendered in workers, errors reported the same way
+        configure_pool(processes=2)
+        pool_out = material_render_many(items)
+        self.assertEqual(mock_render.call_count, 4)
+        self.assertEqual(
+            [dict(x, pid=None) for x in pool_out],
+            [dict(x, pid=None) for x in out],
+        )
+        self.assertEqual(pool_out[2]['error'], 'ValueError')
+        self.assertEqual(len(set(x['pid'] for x in pool_out if 'pid' in x)), 2)
+
+    @unittest.mock.patch('tutorweb_quizdb.material.renderer.r.r_render_local', side_effect=fake_r_render)
+    def test_timeout(self, mock_render):
+        """Slow questions are killed, and eventually not tried"""
+        ms = self.mb_fake_ms('example.q.R')
+        other_ms = self.mb_fake_ms('other.q.R')
+        configure_pool(processes=2, timeout=0.5, breaker_failures=2, breaker_reset=1)
+        info = r_render_info()
+
+        def render(ms, permutation):
+            start = time.perf_counter()
+            out = material_render(ms, permutation)
+            return out.get('error', out['content']), time.perf_counter() - start
+
+        # Question times out, just that question gets an error
+        out, elapsed = render(ms, 96)
+        self.assertEqual(out, 'RenderTimeoutException')
+        self.assertTrue(0.5 <= elapsed < 5)
+        self.assertEqual(render(other_ms, 1)[0], 'other.q.R:1')
+
+        # After enough failures, we stop trying
+        self.assertEqual(render(ms, 96)[0], 'RenderTimeoutException')
+        out, elapsed = render(ms, 1)
+        self.assertEqual(out, 'RenderQuarantinedException')
+        self.assertTrue(elapsed < 0.5)
+        self.assertEqual(render(other_ms, 1)[0], 'other.q.R:1')
+        self.assertEqual(r_render_info()['breaker_open'], ['example.q.R'])
+
+        # After breaker_reset we try once more, if it fails we stop again
+        time.sleep(1)
+        self.assertEqual(render(ms, 96)[0], 'RenderTimeoutException')
+        self.assertEqual(render(ms, 1)[0], 'RenderQuarantinedException')
+
+        # If it works, the question is allowed again
+        time.sleep(1)
+        self.assertEqual(render(ms, 1)[0], 'example.q.R:1')
+        self.assertEqual(render(ms, 96)[0], 'RenderTimeoutException')
+        self.assertEqual(render(ms, 2)[0], 'example.q.R:2')
+        self.assertEqual(r_render_info()['breaker_open'], [])
+
+        # Changing the question's source resets the breaker
+        self.assertEqual(render(ms, 96)[0], 'RenderTimeoutException')
+        self.assertEqual(render(ms, 96)[0], 'RenderTimeoutException')
+        self.assertEqual(render(ms, 1)[0], 'RenderQuarantinedException')
+        ms.md5sum = 'fixed'
+        self.assertEqual(render(ms, 1)[0], 'example.q.R:1')
+
+        # Counters went up
+        new_info = r_render_info()
+        self.assertEqual(new_info['timeouts'] - info['timeouts'], 6)
+        self.assertEqual(new_info['quarantined'] - info['quarantined'], 3)
+        self.assertEqual(new_info['renders'] - info['renders'], 11)
+
+    @unittest.mock.patch('tutorweb_quizdb.material.renderer.r.r_render_local', side_effect=fake_r_render)
+    def test_busy(self, mock_render):
+        """If we wait too long for R, or too many are waiting, give up"""
+        ms = self.mb_fake_ms('example.q.R')
+        configure_pool(processes=1, timeout=5, queue_timeout=0.2, max_queue=1)
+        info = r_render_info()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            slow = executor.submit(material_render, ms, 95)
+            time.sleep(0.05)
+            waiting = executor.submit(material_render, ms, 1)
+            time.sleep(0.05)
+            refused = executor.submit(material_render, ms, 2)
+            self.assertEqual(refused.result()['error'], 'RenderBusyException')
+            self.assertEqual(waiting.result()['error'], 'RenderBusyException')
+            self.assertEqual(slow.result()['content'], 'example.q.R:95')
+
+        new_info = r_render_info()
+        self.assertEqual(new_info['busy'] - info['busy'], 2)
+        self.assertEqual(new_info['waiting'], 0)
+        self.assertTrue(new_info['max_waiting'] >= 1)
+        self.assertTrue(new_info['wait_time'] - info['wait_time'] >= 0.2)
+
+        # In-process renders can't be interrupted, so are never timed out or quarantined
+        configure_pool(processes=0, timeout=0.5, breaker_failures=1)
+        self.assertEqual(material_render(ms, 95)['content'], 'example.q.R:95')
+        self.assertEqual(material_render(ms, 1)['content'], 'example.q.R:1')
+        self.assertEqual(r_render_info()['timeouts'], new_info['timeouts'])
@@ -0,0 +1,106 @@
+import unittest
+
+from .requires_postgresql import RequiresPostgresql
+from .requires_pyramid import RequiresPyramid
+from .requires_materialbank import RequiresMaterialBank
+
+from tutorweb_quizdb.material.stage_link import refresh_stage_material, count_stage_material
+
+
+class RefreshStageMaterialTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
+    def links(self):
+        """Return set of (stage_id, path, revision) for everything in stage_material_sources"""
+        from tutorweb_quizdb import DBSession
+
+        return set(tuple(r) for r in DBSession.execute("""
+            SELECT sms.stage_id, ms.path, ms.revision
+              FROM stage_material_sources sms
+              JOIN material_source ms ON ms.material_source_id = sms.material_source_id
+        """))
+
+    def links_by_tags(self):
+        """What the links should be, comparing tags of every stage & material"""
+        from tutorweb_quizdb import DBSession
+
+        return set(tuple(r) for r in DBSession.execute("""
+            SELECT s.stage_id, ms.path, ms.revision
+              FROM stage s
+              JOIN material_source ms ON s.material_tags <@ ms.material_tags
+        """))
+
+    def test_call(self):
+        from tutorweb_quizdb import DBSession
+
+        self.mb_write_example('example1.q.R', ('math099', 'Q-0990t0', 'lec050500'), 3)
+        self.mb_write_example('example2.q.R', ('math099', 'Q-0990t0', 'lec050600'), 3)
+        self.mb_update()
+        db_stages = self.create_stages(2, material_tags_fn=lambda i: ['type.question', 'lec050%d00' % (i + 5)])
+        self.assertEqual(self.links(), set((
+            (db_stages[0].stage_id, 'example1.q.R', '(untracked)+1'),
+            (db_stages[1].stage_id, 'example2.q.R', '(untracked)+1'),
+        )))
+        self.assertEqual(self.links(), self.links_by_tags())
+
+        # New material, and new revisions of material get linked, old revisions stay linked
+        self.mb_write_example('example1.q.R', ('math099', 'Q-0990t0', 'lec050500', 'lec050600'), 3)
+        self.mb_write_example('example3.q.R', ('math099', 'Q-0990t0', 'lec050500'), 3)
+        self.mb_update()
+        self.assertEqual(self.links(), set((
+            (db_stages[0].stage_id, 'example1.q.R', '(untracked)+1'),
+            (db_stages[0].stage_id, 'example1.q.R', '(untracked)+2'),
+            (db_stages[1].stage_id, 'example1.q.R', '(untracked)+2'),
+            (db_stages[0].stage_id, 'example3.q.R', '(untracked)+1'),
+            (db_stages[1].stage_id, 'example2.q.R', '(untracked)+1'),
+        )))
+        self.assertEqual(self.links(), self.links_by_tags())
+        new_mss_ids = [r[0] for r in DBSession.execute(
+            "SELECT material_source_id FROM material_source WHERE revision = '(untracked)+2' OR path = 'example3.q.R'"
+        )]
+        self.assertEqual(count_stage_material(material_source_ids=new_mss_ids), dict(
+            stages=0,
+            material_sources=2,
+            added=3,
+        ))
+
+        # stage_material only has current material for current stages
+        new_stage = self.upgrade_stage(db_stages[1], dict(hist_sel=dict(value=0.5)))
+        self.assertEqual(set(tuple(r) for r in DBSession.execute("""
+            SELECT sm.stage_id, ms.path, COUNT(*)
+              FROM stage_material sm
+              JOIN material_source ms ON ms.material_source_id = sm.material_source_id
+          GROUP BY 1, 2
+        """)), set((
+            (db_stages[0].stage_id, 'example1.q.R', 3),
+            (db_stages[0].stage_id, 'example3.q.R', 3),
+            (new_stage.stage_id, 'example1.q.R', 3),
+            (new_stage.stage_id, 'example2.q.R', 3),
+        )))
+        self.assertEqual(self.links(), self.links_by_tags())
+        self.assertEqual(count_stage_material(stage_ids=[new_stage.stage_id]), dict(
+            stages=1,
+            material_sources=0,
+            added=2,
+        ))
+
+        # Stages / material added any other way get linked too
+        DBSession.execute(
+            "INSERT INTO material_source (bank, path, revision, permutation_count, material_tags)"
+            " VALUES ('/fake', 'example4.q.R', '1', 3, ARRAY['math099', 'Q-0990t0', 'lec050500', 'type.question'])"
+        )
+        self.assertIn((db_stages[0].stage_id, 'example4.q.R', '1'), self.links())
+        self.assertEqual(self.links(), self.links_by_tags())
+
+        # Refreshing when everything is correct does nothing
+        out = refresh_stage_material()
+        self.assertEqual((out['added'], out['removed']), (0, 0))
+
+        # A full refresh fixes anything that's gone wrong
+        DBSession.execute("DELETE FROM stage_material_source_link WHERE stage_id = :stage_id", dict(stage_id=db_stages[0].stage_id))
+        DBSession.execute(
+            "INSERT INTO stage_material_source_link (stage_id, material_source_id)"
+            " SELECT :stage_id, material_source_id FROM material_source WHERE path = 'example2.q.R'",
+            dict(stage_id=db_stages[0].stage_id),
+        )
+        out = refresh_stage_material()
+        self.assertEqual((out['added'], out['removed']), (4, 1))
+        self.assertEqual(self.links(), self.links_by_tags())
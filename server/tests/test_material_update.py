@@ -1,4 +1,5 @@
 import unittest
+import unittest.mock
 
 from .requires_postgresql import RequiresPostgresql
 from .requires_pyramid import RequiresPyramid
@@ -89,3 +90,69 @@ question <- function(permutation, data_frames) { return(list(content = '', corre
             'example.q.R': ('(untracked)+3', ['math099', 'Q-0990t0', 'lec050500', 'type.question']),
             'extra/another.q.R': ('(deleted)', ['deleted', 'type.question']),
         })
+
+
+def fake_r_render(ms, permutation, student_dataframes={}, dataframe_digest=None):
+    if permutation == 3:
+        raise ValueError("Broken")
+    return dict(content='%s:%d' % (ms.path, permutation))
+
+
+class PrewarmTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
+    def setUp(self):
+        from tutorweb_quizdb.material.renderer.r import configure_pool
+
+        super(PrewarmTest, self).setUp()
+        configure_pool(processes=0)
+
+    def tearDown(self):
+        from tutorweb_quizdb.material.renderer.r import configure_pool
+
+        configure_pool(processes=0)
+        super(PrewarmTest, self).tearDown()
+
+    @unittest.mock.patch('tutorweb_quizdb.material.renderer.r.r_render_local', side_effect=fake_r_render)
+    def test_prewarm(self, mock_render):
+        from tutorweb_quizdb import DBSession
+        from tutorweb_quizdb.material.render import material_render_many, RENDER_CACHE
+        from tutorweb_quizdb.material.renderer.r import configure_pool
+        from tutorweb_quizdb.material.update import update, prewarm
+
+        self.mb_write_file('example1.q.R', b'''
+# TW:PERMUTATIONS=5
+        ''')
+        self.mb_write_file('example2.q.R', b'''
+# TW:PERMUTATIONS=2
+# TW:DATAFRAMES=agelength
+        ''')
+        self.mb_write_file('example3.q.R', b'''
+# TW:PERMUTATIONS=2
+# TW:RENDERCACHE=false
+        ''')
+        new_mss = sorted(update(self.material_bank.name), key=lambda ms: ms.path)
+        self.assertEqual([ms.path for ms in new_mss], ['example1.q.R', 'example2.q.R', 'example3.q.R'])
+
+        # Every permutation gets rendered by R workers, failures are reported
+        configure_pool(processes=2)
+        out = list(prewarm(new_mss))
+        self.assertEqual([(x['path'], x['rendered'], x['failed'], x['skipped']) for x in out], [
+            ('example1.q.R', 4, [(3, 'ValueError')], None),
+            ('example2.q.R', 0, [], 'uses student dataframes'),
+            ('example3.q.R', 0, [], 'TW:RENDERCACHE=false'),
+        ])
+        self.assertIn(out[0]['slowest'][0], [1, 2, 3, 4, 5])
+        self.assertEqual(mock_render.call_count, 3)  # i.e. permutation 1 in update() only, the rest in workers
+        (cached,) = DBSession.execute(
+            "SELECT COUNT(*) FROM material_render_cache WHERE material_source_id = :mss_id",
+            dict(mss_id=new_mss[0].material_source_id),
+        ).fetchone()
+        self.assertEqual(cached, 4)
+
+        # Students get the prewarmed versions without rendering
+        configure_pool(processes=0)
+        RENDER_CACHE.clear()
+        out = material_render_many([(new_mss[0], p, {}) for p in range(1, 6)])
+        self.assertEqual([x['content'] for x in out if 'error' not in x], [
+            'example1.q.R:1', 'example1.q.R:2', 'example1.q.R:4', 'example1.q.R:5',
+        ])
+        self.assertEqual(mock_render.call_count, 4)  # i.e. just the failure
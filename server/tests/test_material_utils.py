@@ -74,6 +74,7 @@ class PathToMaterialSourceTest(RequiresMaterialBank, unittest.TestCase):
             dataframe_paths=[],
             initial_answered=0,
             initial_correct=0,
+            render_cache=True,
         ))
 
         # We combine existing tags with any derived ones
@@ -92,6 +93,7 @@ class PathToMaterialSourceTest(RequiresMaterialBank, unittest.TestCase):
             dataframe_paths=['agelength'],
             initial_answered=0,
             initial_correct=0,
+            render_cache=True,
         ))
 
         # We also understand examples
@@ -110,15 +112,17 @@ class PathToMaterialSourceTest(RequiresMaterialBank, unittest.TestCase):
             dataframe_paths=['agelength'],
             initial_answered=0,
             initial_correct=0,
+            render_cache=True,
         ))
 
-        # And initial values
+        # And initial values, and opting out of render caching
         self.mb_write_file('example.q.R', b'''
 # TW:TAGS=math099,Q-0990t0,lec050500,
 # TW:PERMUTATIONS=100
 # TW:DATAFRAMES=agelength
 # TW:TIMESANSWERED=22
 # TW:TIMESCORRECT=11
+# TW:RENDERCACHE=false
         ''')
         example_qn = path_to_materialsource(self.material_bank.name, 'example.q.R', '')
         self.assertEqual(example_qn, dict(
@@ -130,6 +134,7 @@ class PathToMaterialSourceTest(RequiresMaterialBank, unittest.TestCase):
             dataframe_paths=['agelength'],
             initial_answered=22,
             initial_correct=11,
+            render_cache=False,
         ))
 
     def test_templateqns(self):
@@ -145,6 +150,7 @@ class PathToMaterialSourceTest(RequiresMaterialBank, unittest.TestCase):
             material_tags=['math099', 'Q-0990t0', 'lec050500', 'type.template'],
             initial_answered=0,
             initial_correct=0,
+            render_cache=True,
             path='example.t.R',
             permutation_count=2,
             revision='(untracked)+1'
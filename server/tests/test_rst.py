@@ -1,6 +1,10 @@
 import unittest
 
-from tutorweb_quizdb.rst import to_rst
+from .requires_postgresql import RequiresPostgresql
+from .requires_pyramid import RequiresPyramid
+
+from tutorweb_quizdb import rst
+from tutorweb_quizdb.rst import to_rst, to_rst_many, to_rst_uncached, rst_cache_info, rst_render
 
 
 class ToRstTest(unittest.TestCase):
@@ -80,3 +84,63 @@ camel
 </div><p>Camel
 camel</p><div class="alert-message block-message system-message error"><p class="system-message-title admonition-title">System Message: ERROR/3</p><span class="literal">&amp;lt;string&amp;gt;</span>line 3 <p>Unexpected indentation.</p></div><blockquote><p>camel</p></blockquote>
         """.strip())
+
+
+class RstCacheTest(RequiresPyramid, RequiresPostgresql, unittest.TestCase):
+    def setUp(self):
+        super(RstCacheTest, self).setUp()
+        rst.RST_CACHE.clear()
+        rst.STATS.update(db_hits=0, renders=0, db_purged=False)
+
+    def tearDown(self):
+        rst.CONFIG['persistent_cache'] = False
+        super(RstCacheTest, self).tearDown()
+
+    def test_to_rst_many(self):
+        # Only unique fragments get rendered, same output as uncached
+        self.assertEqual(to_rst_many(['*a*', '*b*', '*a*']), [
+            to_rst_uncached('*a*'),
+            to_rst_uncached('*b*'),
+            to_rst_uncached('*a*'),
+        ])
+        self.assertEqual(rst_cache_info(), dict(hits=0, misses=3, size=2, maxsize=rst.RST_CACHE_SIZE, db_hits=0, renders=2))
+
+        # Second time around, all come from the cache
+        self.assertEqual(to_rst('*a*'), to_rst_uncached('*a*'))
+        self.assertEqual(to_rst_many(['*b*', '*a*']), [to_rst_uncached('*b*'), to_rst_uncached('*a*')])
+        self.assertEqual(rst_cache_info(), dict(hits=3, misses=3, size=2, maxsize=rst.RST_CACHE_SIZE, db_hits=0, renders=2))
+
+        # Can also use the view with a list
+        request = self.request(method='POST')
+        request.json_body = dict(data=['*a*', '*c*'])
+        request.body = b'(not empty)'
+        self.assertEqual(rst_render(request), dict(html=[
+            to_rst_uncached('*a*'),
+            to_rst_uncached('*c*'),
+        ]))
+        self.assertEqual(rst_cache_info()['renders'], 3)
+
+    def test_persistent_cache(self):
+        from tutorweb_quizdb import DBSession
+
+        rst.CONFIG['persistent_cache'] = True
+        DBSession.execute("INSERT INTO rst_render_cache (digest, version, html) VALUES ('x', 'old-version', 'old')")
+
+        # Rendered output gets stored, old versions get purged
+        self.assertEqual(to_rst_many(['*a*', '*b*']), [to_rst_uncached('*a*'), to_rst_uncached('*b*')])
+        self.assertEqual(rst_cache_info()['renders'], 2)
+        self.assertEqual(sorted(DBSession.execute("SELECT digest, version, html FROM rst_render_cache")), sorted([
+            (rst.render_digest('*a*'), rst.RENDER_VERSION, to_rst_uncached('*a*')),
+            (rst.render_digest('*b*'), rst.RENDER_VERSION, to_rst_uncached('*b*')),
+        ]))
+
+        # Another process (i.e. empty memory cache) gets them out of the DB
+        rst.RST_CACHE.clear()
+        self.assertEqual(to_rst_many(['*b*', '*c*', '*a*']), [
+            to_rst_uncached('*b*'),
+            to_rst_uncached('*c*'),
+            to_rst_uncached('*a*'),
+        ])
+        self.assertEqual(rst_cache_info()['db_hits'], 2)
+        self.assertEqual(rst_cache_info()['renders'], 3)
+        self.assertEqual(DBSession.execute("SELECT COUNT(*) FROM rst_render_cache").fetchone()[0], 3)
@@ -1,10 +1,12 @@
 import unittest
 
+import numpy as np
+
 from .requires_postgresql import RequiresPostgresql
 from .requires_pyramid import RequiresPyramid
 from .requires_materialbank import RequiresMaterialBank
 
-from tutorweb_quizdb.stage.allocation import get_allocation
+from tutorweb_quizdb.stage.allocation import get_allocation, get_cipher, difficulty_weights, weighted_sample, material_at_index
 
 
 class OriginalAllocationTest(unittest.TestCase):
@@ -42,6 +44,34 @@ class OriginalAllocationTest(unittest.TestCase):
             alloc_b.to_public_id(11, 34),
         )
 
+    def test_to_from_public_ids(self):
+        """Batch versions match one-at-a-time, and share ciphers between allocations"""
+        def alloc(key):
+            return get_allocation(dict(
+                allocation_method='original',
+                allocation_seed=44,
+                allocation_encryption_key=key,
+            ), 'fake_db_stage', 'fake_db_student')
+        alloc_a = alloc('toottoottoot')
+        items = [(11, 34), (33, 31), (11, -34), (11, 34)]
+
+        public_ids = alloc_a.to_public_ids(items)
+        self.assertEqual(public_ids, [alloc_a.to_public_id(*x) for x in items])
+        self.assertEqual(public_ids[0], public_ids[3])
+        self.assertNotEqual(public_ids[0], public_ids[2])
+        self.assertEqual(alloc_a.from_public_ids(public_ids), items)
+        self.assertEqual(alloc_a.to_public_ids(x for x in items), public_ids)
+        self.assertEqual(alloc_a.to_public_ids([]), [])
+
+        # A new allocation with the same key gets the same results, using the same cipher
+        self.assertEqual(alloc('toottoottoot').to_public_ids(items), public_ids)
+        self.assertIs(get_cipher('toottoottoot'), get_cipher('toottoottoot'))
+        self.assertNotEqual(alloc('parpparpparp').to_public_ids(items), public_ids)
+
+        # Garbage still fails
+        with self.assertRaises(Exception):
+            alloc_a.from_public_ids(['parp'])
+
     def test_should_refresh_questions(self):
         """Refresh based on refresh_interval"""
         alloc_a = get_allocation(dict(
@@ -51,12 +81,54 @@ class OriginalAllocationTest(unittest.TestCase):
             allocation_refresh_interval=10,
         ), 'fake_db_stage', 'fake_db_student')
 
-        self.assertFalse(alloc_a.should_refresh_questions([], 0))
-        self.assertFalse(alloc_a.should_refresh_questions([dict()] * 5, 1))
+        self.assertFalse(alloc_a.should_refresh_questions(0, 0))
+        self.assertFalse(alloc_a.should_refresh_questions(5, 1))
         # NB: additions are already included in the answer queue by this point
-        self.assertTrue(alloc_a.should_refresh_questions([dict()] * 10, 5))
-        self.assertTrue(alloc_a.should_refresh_questions([dict()] * 11, 2))
-        self.assertTrue(alloc_a.should_refresh_questions([dict()] * 22, 5))
+        self.assertTrue(alloc_a.should_refresh_questions(10, 5))
+        self.assertTrue(alloc_a.should_refresh_questions(11, 2))
+        self.assertTrue(alloc_a.should_refresh_questions(22, 5))
+
+    def test_difficulty_weights(self):
+        """Items near the student's grade are favoured"""
+        percentile = np.array([0, 0.25, 0.5, 0.75, 1])
+
+        w = difficulty_weights(percentile, 0)
+        self.assertEqual(list(np.argsort(-w)), [0, 1, 2, 3, 4])
+        w = difficulty_weights(percentile, 10)
+        self.assertEqual(list(np.argsort(-w)), [4, 3, 2, 1, 0])
+        w = difficulty_weights(percentile, 5)
+        self.assertEqual(np.argmax(w), 2)
+        self.assertAlmostEqual(w[1], w[3])
+        self.assertAlmostEqual(w[0], w[4])
+        self.assertTrue(w[2] > w[1] > w[0] > 0)
+
+    def test_material_at_index(self):
+        """Indexes into list of all permutations map to the right material"""
+        mss_ids = np.array([10, 11, 12, 13])
+        permutation_counts = np.array([3, 0, 1, 2])
+        everything = [(10, 1), (10, 2), (10, 3), (12, 1), (13, 1), (13, 2)]
+
+        self.assertEqual(material_at_index(mss_ids, permutation_counts, np.arange(6)), everything)
+        self.assertEqual(material_at_index(mss_ids, permutation_counts, np.array([5, 0, 3])), [
+            (13, 2), (10, 1), (12, 1),
+        ])
+        self.assertEqual(material_at_index(mss_ids, permutation_counts, np.array([], dtype=int)), [])
+
+    def test_weighted_sample(self):
+        """Samples without replacement, deterministic for a given rng"""
+        weights = np.concatenate([np.full(50000, 1.0), np.full(50000, 0.0001)])
+
+        out = weighted_sample(weights, 100, np.random.default_rng([44, 0]))
+        self.assertEqual(len(out), 100)
+        self.assertEqual(len(set(out)), 100)
+        self.assertTrue(sum(out < 50000) > 95)
+
+        # Same seed & epoch, same output. Different epoch, different output
+        self.assertEqual(list(weighted_sample(weights, 100, np.random.default_rng([44, 0]))), list(out))
+        self.assertNotEqual(list(weighted_sample(weights, 100, np.random.default_rng([44, 1]))), list(out))
+
+        # Can ask for everything
+        self.assertEqual(sorted(weighted_sample(np.ones(5), 5, np.random.default_rng(0))), [0, 1, 2, 3, 4])
 
 
 class OriginalAllocationDBTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
@@ -111,4 +183,220 @@ class OriginalAllocationDBTest(RequiresPyramid, RequiresMaterialBank, RequiresPo
             ('common2_question.q.R', 3),
         ]))
 
-        # TODO: Test capping / sampling
+        # With a cap, we get a uniform sample of the material, the same each time
+        alloc_a = get_allocation(dict(
+            allocation_method='original',
+            allocation_seed=44,
+            allocation_encryption_key='toottoottoot',
+        ), self.db_stages[0], self.db_studs[0])
+        all_material = set(alloc_a.get_material())
+        alloc_a.question_cap = 4
+        out = alloc_a.get_material()
+        self.assertEqual(len(set(out)), 4)
+        self.assertTrue(set(out) < all_material)
+        self.assertEqual(alloc_a.get_material(), out)
+        alloc_a.update_bank()  # NB: Nothing to store for uniform selection
+        self.assertEqual(alloc_a.get_material(), out)
+
+    def test_get_material_by_difficulty(self):
+        from tutorweb_quizdb import DBSession
+
+        self.mb_write_example('common1_question.q.R', ('all', 'common1',), 3)
+        self.mb_write_example('common2_question.q.R', ('all', 'common2',), 3)
+        self.mb_update()
+        self.db_stages = self.create_stages(1, lambda i: dict(), lambda i: ['type.question', 'all'])
+        self.db_studs = self.create_students(1)
+
+        def alloc(question_cap):
+            out = get_allocation(dict(
+                allocation_method='original',
+                allocation_bank_selection='difficulty',
+                allocation_seed=44,
+                allocation_encryption_key='toottoottoot',
+            ), self.db_stages[0], self.db_studs[0])
+            out.question_cap = question_cap
+            return out
+
+        def stored_banks():
+            return DBSession.execute("SELECT refresh_epoch, question_cap FROM user_stage_bank").fetchall()
+
+        # With a cap, we get a sample of the material, the same each time
+        all_material = set(alloc(100).get_material())
+        out = alloc(4).get_material()
+        self.assertEqual(len(set(out)), 4)
+        self.assertTrue(set(out) < all_material)
+        self.assertEqual(alloc(4).get_material(), out)
+
+        # Fetching material doesn't store anything, syncing does
+        self.assertEqual(stored_banks(), [])
+        alloc(4).update_bank()
+        self.assertEqual(stored_banks(), [(0, 4)])
+        self.assertEqual(alloc(4).get_material(), out)
+
+        # Once the student's answered enough to have a good grade, they get the hardest question
+        hardest = out[0]
+        DBSession.execute(
+            "UPDATE material_source SET initial_answered = 100, initial_correct = 100"
+            " WHERE material_source_id IN (SELECT material_source_id FROM stage_material WHERE stage_id = :stage_id)",
+            dict(stage_id=self.db_stages[0].stage_id),
+        )
+        # ...but not until the next refresh, the bank was snapshotted
+        self.assertEqual(alloc(4).get_material(), out)
+        alloc(4).update_bank()
+        self.assertEqual(alloc(4).get_material(), out)
+        DBSession.execute(
+            "INSERT INTO answer (stage_id, user_id, material_source_id, permutation, client_id, time_end, correct, grade)"
+            " SELECT :stage_id, :user_id, :mss_id, :permutation, '01', TO_TIMESTAMP(1000 + g), (g = 1), 9.5"
+            "   FROM GENERATE_SERIES(1, 20) g",
+            dict(stage_id=self.db_stages[0].stage_id, user_id=self.db_studs[0].user_id, mss_id=hardest[0], permutation=hardest[1]),
+        )
+        self.assertEqual(alloc(1).get_material(), [hardest])
+        alloc(1).update_bank()
+        self.assertEqual(stored_banks(), [(1, 1)])
+        self.assertEqual(alloc(1).get_material(), [hardest])
+
+        # If the material in the snapshot is superseded, it's not used
+        other_mss_id = next(mss_id for mss_id, _ in all_material if mss_id != hardest[0])
+        DBSession.execute(
+            "UPDATE material_source SET next_material_source_id = :other_mss_id WHERE material_source_id = :mss_id",
+            dict(mss_id=hardest[0], other_mss_id=other_mss_id),
+        )
+        self.assertEqual([mss_id for mss_id, _ in alloc(1).get_material()], [other_mss_id])
+        alloc(1).update_bank()
+        self.assertEqual([mss_id for mss_id, _ in alloc(1).get_material()], [other_mss_id])
+
+    def test_get_material_by_index(self):
+        from tutorweb_quizdb import DBSession
+
+        self.mb_write_example('common1_question.q.R', ('all', 'common1',), 3)
+        self.mb_write_example('common2_question.q.R', ('all', 'common2',), 5)
+        self.mb_update()
+        self.db_stages = self.create_stages(1, lambda i: dict(), lambda i: ['type.question', 'all'])
+        self.db_studs = self.create_students(1)
+
+        def alloc():
+            return get_allocation(dict(
+                allocation_method='original',
+                allocation_bank_selection='index',
+                allocation_seed=44,
+                allocation_encryption_key='toottoottoot',
+                allocation_refresh_interval=5,
+            ), self.db_stages[0], self.db_studs[0])
+
+        # Under the cap, get everything, in the same order as difficulty selection
+        all_material = alloc().get_material()
+        self.assertEqual([(self.mb_lookup_mss_id(x[0]).path, x[1]) for x in all_material], [
+            ('common1_question.q.R', 1),
+            ('common1_question.q.R', 2),
+            ('common1_question.q.R', 3),
+            ('common2_question.q.R', 1),
+            ('common2_question.q.R', 2),
+            ('common2_question.q.R', 3),
+            ('common2_question.q.R', 4),
+            ('common2_question.q.R', 5),
+        ])
+        alloc_diff = alloc()
+        alloc_diff.bank_selection = 'difficulty'
+        self.assertEqual(alloc_diff.get_material(), all_material)
+
+        # With a cap, a sample that stays the same until the refresh interval is passed
+        alloc_a = alloc()
+        alloc_a.question_cap = 4
+        out = alloc_a.get_material()
+        self.assertEqual(len(set(out)), 4)
+        self.assertTrue(set(out) < set(all_material))
+        self.assertEqual(alloc_a.get_material(), out)
+
+        def add_answers(start, count):
+            DBSession.execute(
+                "INSERT INTO answer (stage_id, user_id, material_source_id, permutation, client_id, time_end, correct, grade)"
+                " SELECT :stage_id, :user_id, :mss_id, 1, '01', TO_TIMESTAMP(1000 + g), true, 1"
+                "   FROM GENERATE_SERIES(:start, :end) g",
+                dict(
+                    stage_id=self.db_stages[0].stage_id,
+                    user_id=self.db_studs[0].user_id,
+                    mss_id=all_material[0][0],
+                    start=start,
+                    end=start + count - 1,
+                ),
+            )
+        add_answers(0, 4)
+        self.assertEqual(alloc_a.get_material(), out)
+        add_answers(4, 1)
+        self.assertNotEqual(alloc_a.get_material(), out)
+
+
+class PassThroughAllocationDBTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
+    def test_to_from_public_ids(self):
+        self.mb_write_example('common1_question.q.R', ('all', 'common1',), 3)
+        self.mb_write_example('common2_question.q.R', ('all', 'common2',), 3)
+        self.mb_update()
+        # Add a second version of common1_question
+        self.mb_write_example('common1_question.q.R', ('all', 'common1', 'v2'), 3)
+        self.mb_update()
+
+        self.db_stages = self.create_stages(1)
+        self.db_studs = self.create_students(1)
+        alloc = get_allocation(dict(
+            allocation_method='passthrough',
+            allocation_bank_name=self.material_bank.name,
+        ), self.db_stages[0], self.db_studs[0])
+
+        public_ids = ['common1_question.q.R:1:2', 'common2_question.q.R:1:3', 'common1_question.q.R:2:1', 'common1_question.q.R:1:-4']
+        items = alloc.from_public_ids(public_ids)
+        self.assertEqual(items, [alloc.from_public_id(x) for x in public_ids])
+        self.assertEqual(len(set(mss_id for mss_id, permutation in items)), 3)
+        self.assertEqual(alloc.to_public_ids(items), public_ids)
+        self.assertEqual(alloc.to_public_ids(items), [alloc.to_public_id(*x) for x in items])
+        self.assertEqual(alloc.to_public_ids([]), [])
+        self.assertEqual(alloc.from_public_ids([]), [])
+
+
+class ExamAllocationDBTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
+    def test_get_material(self):
+        from tutorweb_quizdb import DBSession
+
+        self.mb_write_example('common1_question.q.R', ('all', 'common1',), 3)
+        self.mb_write_example('common2_question.q.R', ('all', 'common2',), 3)
+        self.mb_update()
+        self.db_stages = self.create_stages(1, lambda i: dict(), lambda i: ['type.question', 'all'])
+        self.db_studs = self.create_students(2)
+
+        def alloc(db_stud, seed, question_cap=None):
+            return get_allocation(dict(
+                allocation_method='exam',
+                allocation_seed=seed,
+                allocation_encryption_key='toottoottoot',
+                question_cap=question_cap,
+            ), self.db_stages[0], db_stud)
+
+        # No sheet yet, so one gets made containing everything
+        out = alloc(self.db_studs[0], 44).get_material()
+        self.assertEqual(len(out), 6)
+        self.assertEqual(set(out), set(alloc(self.db_studs[0], 44).choose_sheet()))
+        self.assertEqual(out, alloc(self.db_studs[0], 44).choose_sheet())
+
+        # Once stored, the sheet doesn't change, even if settings do
+        self.assertEqual(alloc(self.db_studs[0], 99, question_cap=2).get_material(), out)
+        self.assertFalse(alloc(self.db_studs[0], 44).should_refresh_questions(20, 1))
+
+        # Other students get a different order, and question_cap questions
+        alloc_b = alloc(self.db_studs[1], 45, question_cap='4')
+        out_b = alloc_b.get_material()
+        self.assertEqual(len(out_b), 4)
+        self.assertTrue(set(out_b) < set(out))
+
+        # Nothing is rendered yet
+        self.assertEqual(alloc_b.get_rendered(out_b), {})
+        self.assertEqual(alloc_b.get_rendered([]), {})
+
+        # Rendered material is returned for this student only
+        DBSession.execute(
+            "UPDATE exam_sheet SET rendered = CAST(:rendered AS JSONB) WHERE user_id = :user_id AND position < 2",
+            dict(user_id=self.db_studs[1].user_id, rendered='{"content": "rendered"}'),
+        )
+        self.assertEqual(alloc_b.get_rendered(out_b), {
+            out_b[0]: dict(content='rendered'),
+            out_b[1]: dict(content='rendered'),
+        })
+        self.assertEqual(alloc(self.db_studs[0], 44).get_rendered(out), {})
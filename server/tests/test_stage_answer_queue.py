@@ -1,5 +1,6 @@
 from decimal import Decimal
 import unittest
+import unittest.mock
 
 from pyramid.httpexceptions import HTTPForbidden
 
@@ -9,7 +10,8 @@ from .requires_materialbank import RequiresMaterialBank
 
 from tutorweb_quizdb.stage.allocation import get_allocation
 from tutorweb_quizdb.stage.setting import getStudentSettings
-from tutorweb_quizdb.stage.answer_queue import sync_answer_queue, request_review
+from tutorweb_quizdb.stage.answer_queue import (
+    sync_answer_queue, sync_answer_queue_delta, request_review, incoming_to_db, insert_answers)
 from tutorweb_quizdb.stage.material import stage_material
 from tutorweb_quizdb.syllabus.results import result_summary, result_full, view_syllabus_results
 from tutorweb_quizdb.student import get_group
@@ -189,13 +191,13 @@ question <- function(permutation, data_frames) { return(list(content = '', corre
         ])
         self.assertEqual(additions, 0)
 
-        # Can add items with differing time_offsets
+        # Another client can add items with differing time_offsets
         (out, additions) = sync_answer_queue(alloc, [
-            dict(client_id='01', uri='example2.q.R:1:1', time_start=1000, time_end=1010, correct=True, grade_after=0.1, student_answer=dict(answer="late"), review=None),
+            dict(client_id='02', uri='example2.q.R:1:1', time_start=1000, time_end=1010, correct=True, grade_after=0.1, student_answer=dict(answer="late"), review=None),
         ], 300)
         self.assertEqual(out, [
             aq_dict(uri='example1.q.R:1:4', time_start=1000, time_end=1010, time_offset=0, correct=True, grade_after=0.1, student_answer=dict(answer="2"), review=dict(hard="yes")),
-            aq_dict(uri='example2.q.R:1:1', time_start=1000, time_end=1010, time_offset=300, correct=True, grade_after=0.1, student_answer=dict(answer="late")),
+            aq_dict(client_id='02', uri='example2.q.R:1:1', time_start=1000, time_end=1010, time_offset=300, correct=True, grade_after=0.1, student_answer=dict(answer="late")),
             aq_dict(uri='example1.q.R:1:5', time_start=1010, time_end=1020, time_offset=0, correct=True, grade_after=0.1, student_answer=dict(answer="2")),
         ])
         self.assertEqual(additions, 1)
@@ -210,7 +212,7 @@ question <- function(permutation, data_frames) { return(list(content = '', corre
         self.assertEqual(out, [
             aq_dict(uri='example1.q.R:1:6', time_start=1000, time_end=1005, time_offset=0, correct=True, grade_after=0.2, student_answer=dict(answer="3")),
             aq_dict(uri='example1.q.R:1:4', time_start=1000, time_end=1010, time_offset=0, correct=True, grade_after=0.1, student_answer=dict(answer="2"), review=dict(hard="yes")),
-            aq_dict(uri='example2.q.R:1:1', time_start=1000, time_end=1010, time_offset=300, correct=True, grade_after=0.1, student_answer=dict(answer="late")),
+            aq_dict(client_id='02', uri='example2.q.R:1:1', time_start=1000, time_end=1010, time_offset=300, correct=True, grade_after=0.1, student_answer=dict(answer="late")),
             aq_dict(uri='example1.q.R:1:7', time_start=1010, time_end=1015, time_offset=0, correct=True, grade_after=0.2, student_answer=dict(answer="3")),
             aq_dict(uri='example1.q.R:1:5', time_start=1010, time_end=1020, time_offset=0, correct=True, grade_after=0.1, student_answer=dict(answer="2")),
             aq_dict(uri='example1.q.R:1:8', time_start=1020, time_end=1025, time_offset=0, correct=True, grade_after=0.2, student_answer=dict(answer="3")),
@@ -488,7 +490,7 @@ question <- function(permutation, data_frames) { return(list(content = 'parp', c
         self.assertEqual(out, [
             aq_dict(uri='example1.q.R:1:6', time_start=1000, time_end=1005, time_offset=0, correct=True, grade_after=0.2, student_answer=dict(answer="3")),
             aq_dict(uri='example1.q.R:1:4', time_start=1000, time_end=1010, time_offset=0, correct=True, grade_after=0.1, student_answer=dict(answer="2"), review=dict(hard="yes")),
-            aq_dict(uri='example2.q.R:1:1', time_start=1000, time_end=1010, time_offset=300, correct=True, grade_after=0.1, student_answer=dict(answer="late")),
+            aq_dict(client_id='02', uri='example2.q.R:1:1', time_start=1000, time_end=1010, time_offset=300, correct=True, grade_after=0.1, student_answer=dict(answer="late")),
             aq_dict(uri='example1.q.R:1:7', time_start=1010, time_end=1015, time_offset=0, correct=True, grade_after=0.2, student_answer=dict(answer="3")),
             aq_dict(uri='example1.q.R:1:5', time_start=1010, time_end=1020, time_offset=0, correct=True, grade_after=0.1, student_answer=dict(answer="2")),
             aq_dict(uri='example1.q.R:1:8', time_start=1020, time_end=1025, time_offset=0, correct=True, grade_after=0.2, student_answer=dict(answer="3")),
@@ -591,7 +593,7 @@ question <- function(permutation, data_frames) { return(list(content = 'parp', c
 
         # Ace final stage in second lecture, get the full award
         (out, additions) = sync_answer_queue(get_alloc(self.db_other_stages[0], self.db_studs[0]), [
-            aq_dict(time_end=2013, uri='example1.q.R:1:1', grade_after=9.94),
+            aq_dict(time_end=2014, uri='example1.q.R:1:1', grade_after=9.94),
         ], 0)
         self.assertEqual(self.coins_awarded(self.db_studs[0]), 4 * (AWARD_STAGE_ANSWERED + AWARD_STAGE_ACED) + AWARD_TUTORIAL_ACED)
 
@@ -638,6 +640,19 @@ question <- function(permutation, data_frames) { return(list(content = 'parp', c
             }
         ])
 
+        # user_stage_progress agrees with the answers it summarises
+        self.assertEqual([tuple(r) for r in self.DBSession.execute("""
+            SELECT user_id, syllabus_id, stage_name, max_grade, answer_count, last_time_end
+              FROM user_stage_progress
+          ORDER BY user_id, syllabus_id, stage_name
+        """)], [tuple(r) for r in self.DBSession.execute("""
+            SELECT a.user_id, st.syllabus_id, st.stage_name, MAX(a.grade), COUNT(*), MAX(a.time_end)
+              FROM answer a, stage st
+             WHERE a.stage_id = st.stage_id
+          GROUP BY 1, 2, 3
+          ORDER BY 1, 2, 3
+        """)])
+
         # Check full results
         out = list(result_full())
         from tutorweb_quizdb.timestamp import timestamp_to_datetime
@@ -645,12 +660,12 @@ question <- function(permutation, data_frames) { return(list(content = 'parp', c
         # Check other stage first, depending on it's value it will either be at the beginning or the end of the list
         if str(self.db_other_stages[0].syllabus.path) < str(self.db_stages[0].syllabus.path):
             self.assertEqual(out[1:2], [
-                (str(self.db_other_stages[0].syllabus.path), 'stage0', 1, 'user0', True, Decimal('9.940'), timestamp_to_datetime(2013)),
+                (str(self.db_other_stages[0].syllabus.path), 'stage0', 1, 'user0', True, Decimal('9.940'), timestamp_to_datetime(2014)),
             ])
             del out[1]
         else:
             self.assertEqual(out[-1:], [
-                (str(self.db_other_stages[0].syllabus.path), 'stage0', 1, 'user0', True, Decimal('9.940'), timestamp_to_datetime(2013)),
+                (str(self.db_other_stages[0].syllabus.path), 'stage0', 1, 'user0', True, Decimal('9.940'), timestamp_to_datetime(2014)),
             ])
             del out[-1]
 
@@ -719,3 +734,265 @@ question <- function(permutation, data_frames) { return(list(content = 'parp', c
             user=self.db_studs[0],
             params=dict(path=str(self.db_other_stages[0].syllabus.path)),
         ))['results'], list(result_summary(str(self.db_other_stages[0].syllabus.path))))
+
+
+class SyncAnswerQueueDeltaTest(RequiresMaterialBank, RequiresPyramid, RequiresPostgresql, unittest.TestCase):
+    maxDiff = None
+
+    def test_call(self):
+        import transaction
+        from tutorweb_quizdb import DBSession, Base
+        from tutorweb_quizdb.models import User
+
+        def commit():
+            """Commit, so other syncs see our changes, as they would between requests"""
+            transaction.commit()
+        # Previous tests will leave a transaction open, start afresh
+        transaction.abort()
+
+        def alloc(stud_i):
+            """Fetch allocation for a student, DB objects don't survive a commit"""
+            return get_alloc(
+                DBSession.query(Base.classes.stage).get(stage_id),
+                DBSession.query(User).get(stud_ids[stud_i]),
+            )
+
+        db_stages = self.create_stages(1, lec_parent='ut.ans_queue_delta.0', stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+        ), material_tags_fn=lambda i: [
+            'type.template',
+            'lec050500',
+        ])
+        db_studs = self.create_students(2)
+        stage_id = db_stages[0].stage_id
+        stud_ids = [x.id for x in db_studs]
+        self.mb_write_file('template1.t.R', b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=1
+
+question <- function(permutation, data_frames) { return(list(content = '', correct = list())) }
+        ''')
+        self.mb_update()
+        commit()
+
+        # No cursor on an empty queue, get nothing back, and a cursor
+        (out, additions, aq_length, cursor_0) = sync_answer_queue_delta(alloc(0), [], 0, None)
+        self.assertEqual(out, [])
+        self.assertEqual((additions, aq_length), (0, 0))
+        self.assertRegex(cursor_0, r'^%d:\d+:0$' % stage_id)
+        commit()
+
+        # Add some entries, get them back
+        (out, additions, aq_length, cursor_1) = sync_answer_queue_delta(alloc(0), [
+            aq_dict(uri='template1.t.R:1:1', time_end=1010, correct=None, student_answer=dict(text="2")),
+            aq_dict(uri='template1.t.R:1:1', time_end=1020, correct=None, student_answer=dict(text="3")),
+        ], 0, cursor_0)
+        self.assertEqual(out, [
+            aq_dict(uri='template1.t.R:1:1', time_end=1010, correct=None, student_answer=dict(text="2")),
+            aq_dict(uri='template1.t.R:1:1', time_end=1020, correct=None, student_answer=dict(text="3")),
+        ])
+        self.assertEqual((additions, aq_length), (2, 2))
+        self.assertRegex(cursor_1, r':2$')
+        commit()
+
+        # The transaction that wrote them might not have been visible to the cursor, so they come back once more
+        (out, additions, aq_length, cursor_2) = sync_answer_queue_delta(alloc(0), [], 0, cursor_1)
+        self.assertEqual([x['time_end'] for x in out], [1010, 1020])
+        self.assertEqual((additions, aq_length), (0, 2))
+        commit()
+
+        # ...after that there's nothing to return
+        (out, additions, aq_length, cursor_3) = sync_answer_queue_delta(alloc(0), [], 0, cursor_2)
+        self.assertEqual(out, [])
+        self.assertEqual((additions, aq_length), (0, 2))
+        commit()
+
+        # Incomplete entries don't count as something to write
+        (out, additions, aq_length, cursor_3) = sync_answer_queue_delta(alloc(0), [
+            dict(client_id='01', uri='template1.t.R:1:1', time_start=1090),
+        ], 0, cursor_3)
+        self.assertEqual(out, [])
+        self.assertEqual((additions, aq_length), (0, 2))
+        commit()
+
+        # Student 1 reviews student 0's first question
+        (answer_id,) = DBSession.execute("SELECT MIN(answer_id) FROM answer WHERE user_id = :user_id", dict(
+            user_id=stud_ids[0],
+        )).fetchone()
+        (out, additions, aq_length, cursor_stud1) = sync_answer_queue_delta(alloc(1), [
+            aq_dict(uri='template1.t.R:1:-%d' % answer_id, time_end=1030, review=dict(content=12, presentation=12)),
+        ], 0, None)
+        self.assertEqual((additions, aq_length), (1, 1))
+        commit()
+
+        # Student 0 gets the reviewed entry, and the latest entry
+        (out, additions, aq_length, cursor_4) = sync_answer_queue_delta(alloc(0), [], 0, cursor_3)
+        self.assertEqual(out, [
+            aq_dict(uri='template1.t.R:1:1', time_end=1010, correct=True, mark=8, student_answer=dict(text="2"), ug_reviews=[
+                dict(content=12, presentation=12, mark=24),
+            ]),
+            aq_dict(uri='template1.t.R:1:1', time_end=1020, correct=None, student_answer=dict(text="3")),
+        ])
+        self.assertEqual((additions, aq_length), (0, 2))
+        commit()
+
+        # Student 1 didn't change anything of theirs, but their queue was written to last time
+        (out, additions, aq_length, cursor_stud1) = sync_answer_queue_delta(alloc(1), [], 0, cursor_stud1)
+        (out, additions, aq_length, cursor_stud1) = sync_answer_queue_delta(alloc(1), [], 0, cursor_stud1)
+        self.assertEqual(out, [])
+        self.assertEqual((additions, aq_length), (0, 1))
+
+        # A cursor for a previous version of the stage, or garbage, gets everything
+        for bad_cursor in ['%d:1:2' % (stage_id + 99), 'camels', '']:
+            (out, additions, aq_length, cursor) = sync_answer_queue_delta(alloc(0), [], 0, bad_cursor)
+            self.assertEqual([x['time_end'] for x in out], [1010, 1020])
+            self.assertEqual((additions, aq_length), (0, 2))
+
+
+class SyncAnswerQueueMarkingTest(RequiresMaterialBank, RequiresPyramid, RequiresPostgresql, unittest.TestCase):
+    def test_call(self):
+        from tutorweb_quizdb import DBSession
+
+        def stored_coins():
+            return [(r[0], r[1]) for r in DBSession.execute("""
+                SELECT EXTRACT(EPOCH FROM time_end)::INT, coins_awarded FROM answer WHERE user_id = :user_id ORDER BY time_end
+            """, dict(user_id=db_studs[0].id))]
+
+        db_stages = self.create_stages(1, stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+            award_stage_answered=dict(value=AWARD_STAGE_ANSWERED),
+        ), material_tags_fn=lambda i: ['type.question', 'lec050500'])
+        db_studs = self.create_students(1)
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=10
+
+question <- function(permutation, data_frames) { return(list(content = '', correct = list())) }
+        ''')
+        self.mb_update()
+
+        # Crossing 5 gets an award
+        (out, additions) = sync_answer_queue(get_alloc(db_stages[0], db_studs[0]), [
+            aq_dict(uri='example1.q.R:1:1', time_end=1010, grade_after=4.0),
+            aq_dict(uri='example1.q.R:1:2', time_end=1020, grade_after=6.0),
+        ], 0)
+        self.assertEqual(stored_coins(), [(1010, 0), (1020, AWARD_STAGE_ANSWERED)])
+
+        # Mess with the coins awarded, settled answers aren't re-marked so it stays
+        DBSession.execute("UPDATE answer SET coins_awarded = 99 WHERE user_id = :user_id", dict(user_id=db_studs[0].id))
+        (out, additions) = sync_answer_queue(get_alloc(db_stages[0], db_studs[0]), [
+            aq_dict(uri='example1.q.R:1:3', time_end=1030, grade_after=7.0),
+        ], 0)
+        self.assertEqual(stored_coins(), [(1010, 99), (1020, 99), (1030, 0)])
+
+        # An answer inserted earlier changes grade_hwm for everything after it, so they're re-marked
+        (out, additions) = sync_answer_queue(get_alloc(db_stages[0], db_studs[0]), [
+            aq_dict(uri='example1.q.R:1:4', time_end=1015, grade_after=5.5),
+        ], 0)
+        self.assertEqual(stored_coins(), [(1010, 99), (1015, AWARD_STAGE_ANSWERED), (1020, 0), (1030, 0)])
+
+        # Upgrading the stage doesn't re-mark settled answers, new answers get the new settings
+        db_stages[0] = self.upgrade_stage(db_stages[0], dict(
+            award_stage_answered=dict(value=AWARD_STAGE_ANSWERED * 2),
+        ))
+        with unittest.mock.patch('tutorweb_quizdb.stage.answer_queue.mark_aq_entry') as mock_mark:
+            (out, additions) = sync_answer_queue(get_alloc(db_stages[0], db_studs[0]), [], 0)
+        self.assertEqual(mock_mark.call_count, 0)
+        self.assertEqual(stored_coins(), [(1010, 99), (1015, AWARD_STAGE_ANSWERED), (1020, 0), (1030, 0)])
+
+        # New answers are marked against the stored highest grade, i.e. 7, so no award for crossing 5
+        (out, additions) = sync_answer_queue(get_alloc(db_stages[0], db_studs[0]), [
+            aq_dict(uri='example1.q.R:1:5', time_end=1040, grade_after=6.0),
+        ], 0)
+        self.assertEqual(stored_coins(), [(1010, 99), (1015, AWARD_STAGE_ANSWERED), (1020, 0), (1030, 0), (1040, 0)])
+
+        # An answer inserted earlier that doesn't change grade_hwm for anything after it doesn't re-mark them
+        DBSession.execute("UPDATE answer SET coins_awarded = 99 WHERE user_id = :user_id", dict(user_id=db_studs[0].id))
+        (out, additions) = sync_answer_queue(get_alloc(db_stages[0], db_studs[0]), [
+            aq_dict(uri='example1.q.R:1:6', time_end=1012, grade_after=3.0),
+        ], 0)
+        self.assertEqual(stored_coins(), [(1010, 99), (1012, 0), (1015, 99), (1020, 99), (1030, 99), (1040, 99)])
+
+
+class InsertAnswersTest(RequiresMaterialBank, RequiresPyramid, RequiresPostgresql, unittest.TestCase):
+    def test_call(self):
+        from tutorweb_quizdb import DBSession
+
+        def stored_answers():
+            return [(r[0], r[1]) for r in DBSession.execute("""
+                SELECT EXTRACT(EPOCH FROM time_end)::INT, coins_awarded FROM answer WHERE user_id = :user_id ORDER BY time_end
+            """, dict(user_id=db_studs[0].id))]
+
+        db_stages = self.create_stages(1, stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+            award_stage_answered=dict(value=AWARD_STAGE_ANSWERED),
+        ), material_tags_fn=lambda i: ['type.question', 'lec050500'])
+        db_studs = self.create_students(1)
+        self.mb_write_file('example1.q.R', b'''
+# TW:TAGS=math099,Q-0990t0,lec050500,
+# TW:PERMUTATIONS=10
+
+question <- function(permutation, data_frames) { return(list(content = '', correct = list())) }
+        ''')
+        self.mb_update()
+        alloc = get_alloc(db_stages[0], db_studs[0])
+
+        (out, additions) = sync_answer_queue(alloc, [
+            aq_dict(uri='example1.q.R:1:1', time_end=1010, grade_after=6.0),
+        ], 0)
+        self.assertEqual(additions, 1)
+        self.assertEqual(stored_answers(), [(1010, AWARD_STAGE_ANSWERED)])
+        answer_id = DBSession.execute("SELECT answer_id FROM answer WHERE user_id = :user_id", dict(
+            user_id=db_studs[0].id,
+        )).scalar()
+
+        # A concurrent sync that didn't see the first answer tries to insert it again, along with a new one
+        entries = [incoming_to_db(alloc, aq_dict(uri=uri, time_end=time_end, grade_after=6.0)) for uri, time_end in [
+            ('example1.q.R:1:1', 1010),
+            ('example1.q.R:1:2', 1020),
+        ]]
+        for e in entries:
+            e.time_offset = 0
+            e.coins_awarded = 55
+            e.mark_stamp = 'x'
+        conflicted = insert_answers(alloc, entries)
+
+        # Only the new answer was inserted, the conflicting entry now matches what's already there
+        self.assertEqual(conflicted, [entries[0]])
+        self.assertEqual(entries[0].answer_id, answer_id)
+        self.assertEqual(entries[0].coins_awarded, AWARD_STAGE_ANSWERED)
+        self.assertNotEqual(entries[1].answer_id, answer_id)
+        self.assertEqual(stored_answers(), [(1010, AWARD_STAGE_ANSWERED), (1020, 55)])
+
+        # A client retrying a sync gets the same answer queue back, nothing is added twice
+        (out_retry, additions) = sync_answer_queue(alloc, [
+            aq_dict(uri='example1.q.R:1:1', time_end=1010, grade_after=6.0),
+            aq_dict(uri='example1.q.R:1:2', time_end=1020, grade_after=6.0),
+        ], 0)
+        self.assertEqual(additions, 0)
+        self.assertEqual(len(out_retry), 2)
+        self.assertEqual(len(stored_answers()), 2)
+
+        # A retry after the client's clock moved, so time_offset differs, is still the same answer
+        (out_retry, additions) = sync_answer_queue(alloc, [
+            dict(client_id='01', uri='example1.q.R:1:3', time_start=1020, time_end=1030, correct=True, grade_after=6.0, student_answer={}),
+        ], 0)
+        self.assertEqual(additions, 1)
+        (out_retry, additions) = sync_answer_queue(alloc, [
+            dict(client_id='01', uri='example1.q.R:1:3', time_start=1020, time_end=1030, correct=True, grade_after=6.0, student_answer={}),
+        ], 300)
+        self.assertEqual(additions, 0)
+        self.assertEqual([(a['time_end'], a['time_offset']) for a in out_retry], [(1010, 0), (1020, 0), (1030, 0)])
+        self.assertEqual(len(stored_answers()), 3)
+
+        # So is a concurrent insert of it after the stage is upgraded
+        db_stages[0] = self.upgrade_stage(db_stages[0], dict(award_stage_answered=dict(value=AWARD_STAGE_ANSWERED * 2)))
+        alloc = get_alloc(db_stages[0], db_studs[0])
+        entries = [incoming_to_db(alloc, aq_dict(uri='example1.q.R:1:3', time_end=1030, grade_after=6.0))]
+        entries[0].time_offset = 600
+        self.assertEqual(insert_answers(alloc, entries), entries)
+        self.assertEqual(entries[0].time_offset, 0)
+        self.assertEqual(len(stored_answers()), 3)
@@ -0,0 +1,184 @@
+import unittest
+
+from .requires_postgresql import RequiresPostgresql
+from .requires_pyramid import RequiresPyramid
+from .requires_materialbank import RequiresMaterialBank
+
+from tutorweb_quizdb.stage.answer_stats import answer_stats_rebuild, answer_stats_check
+
+
+class AnswerStatsTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
+    def test_call(self):
+        from tutorweb_quizdb import DBSession
+
+        self.mb_write_example('example1.q.R', ('math099', 'Q-0990t0', 'lec050500'), 3)
+        self.mb_write_example('example2.q.R', ('math099', 'Q-0990t0', 'lec050500'), 3)
+        self.mb_update()
+        db_stages = self.create_stages(2, material_tags_fn=lambda i: ['type.question', 'lec050500'])
+        db_studs = self.create_students(2)
+        mss_ids = [DBSession.execute(
+            "SELECT material_source_id FROM material_source WHERE path = :path",
+            dict(path=p),
+        ).fetchone()[0] for p in ('example1.q.R', 'example2.q.R')]
+
+        def add_answers(*answers):
+            for i, (stage_i, stud_i, mss_i, permutation, correct) in enumerate(answers):
+                DBSession.execute(
+                    "INSERT INTO answer (stage_id, user_id, material_source_id, permutation, client_id, time_end, correct, grade)"
+                    " VALUES (:stage_id, :user_id, :mss_id, :permutation, '01', NOW() + :i * INTERVAL '1 second', :correct, 0)",
+                    dict(
+                        stage_id=db_stages[stage_i].stage_id,
+                        user_id=db_studs[stud_i].user_id,
+                        mss_id=mss_ids[mss_i] if mss_i is not None else None,
+                        permutation=permutation,
+                        correct=correct,
+                        i=i,
+                    ),
+                )
+
+        def stats():
+            return dict(
+                ((db_stages.index(next(s for s in db_stages if s.stage_id == r[0])), mss_ids.index(r[1]), r[2]), (r[3], r[4]))
+                for r in DBSession.execute("SELECT stage_id, material_source_id, permutation, answered, correct FROM answer_stats")
+                if r[3] != 0
+            )
+
+        # Inserts get counted, including more than one in a statement
+        add_answers((0, 0, 0, 1, True))
+        self.assertEqual(stats(), {
+            (0, 0, 1): (1, 1),
+        })
+        DBSession.execute(
+            "INSERT INTO answer (stage_id, user_id, material_source_id, permutation, client_id, time_end, correct, grade)"
+            " SELECT :stage_id, :user_id, :mss_id, 2, '01', NOW() - g * INTERVAL '1 second', g % 2 = 0, 0"
+            "   FROM GENERATE_SERIES(1, 5) g",
+            dict(stage_id=db_stages[0].stage_id, user_id=db_studs[1].user_id, mss_id=mss_ids[1]),
+        )
+        add_answers(
+            (0, 1, 0, 1, False),
+            (1, 1, 0, 1, None),
+            (1, 1, None, None, True),  # NB: Answers with no material aren't counted
+        )
+        self.assertEqual(stats(), {
+            (0, 0, 1): (2, 1),
+            (0, 1, 2): (5, 2),
+            (1, 0, 1): (1, 0),
+        })
+        self.assertEqual(answer_stats_check(), [])
+
+        # Updates move counts, updates to other columns don't change anything
+        DBSession.execute(
+            "UPDATE answer SET correct = true WHERE stage_id = :stage_id AND material_source_id = :mss_id",
+            dict(stage_id=db_stages[0].stage_id, mss_id=mss_ids[1]),
+        )
+        DBSession.execute(
+            "UPDATE answer SET permutation = 3 WHERE stage_id = :stage_id AND material_source_id = :mss_id AND NOT correct",
+            dict(stage_id=db_stages[0].stage_id, mss_id=mss_ids[0]),
+        )
+        DBSession.execute("UPDATE answer SET grade = 5")
+        self.assertEqual(stats(), {
+            (0, 0, 1): (1, 1),
+            (0, 0, 3): (1, 0),
+            (0, 1, 2): (5, 5),
+            (1, 0, 1): (1, 0),
+        })
+        self.assertEqual(answer_stats_check(), [])
+
+        # Deletes remove counts
+        DBSession.execute(
+            "DELETE FROM answer WHERE stage_id = :stage_id AND material_source_id = :mss_id",
+            dict(stage_id=db_stages[0].stage_id, mss_id=mss_ids[1]),
+        )
+        self.assertEqual(stats(), {
+            (0, 0, 1): (1, 1),
+            (0, 0, 3): (1, 0),
+            (1, 0, 1): (1, 0),
+        })
+        self.assertEqual(answer_stats_check(), [])
+
+        # Checker finds broken rows, rebuild fixes them
+        DBSession.execute("UPDATE answer_stats SET answered = 99 WHERE permutation = 3")
+        DBSession.execute(
+            "INSERT INTO answer_stats (stage_id, material_source_id, permutation, answered, correct) VALUES (:stage_id, :mss_id, 9, 1, 1)",
+            dict(stage_id=db_stages[1].stage_id, mss_id=mss_ids[1]),
+        )
+        self.assertEqual(answer_stats_check(), [
+            (db_stages[0].stage_id, mss_ids[0], 3, 1, 0, 99, 0),
+            (db_stages[1].stage_id, mss_ids[1], 9, 0, 0, 1, 1),
+        ])
+        self.assertEqual(answer_stats_rebuild(), 3)
+        self.assertEqual(answer_stats_check(), [])
+        self.assertEqual(stats(), {
+            (0, 0, 1): (1, 1),
+            (0, 0, 3): (1, 0),
+            (1, 0, 1): (1, 0),
+        })
+
+
+class UserStageProgressTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
+    def test_call(self):
+        from tutorweb_quizdb import DBSession
+
+        self.mb_write_example('example1.q.R', ('math099', 'Q-0990t0', 'lec050500'), 3)
+        self.mb_update()
+        db_stages = self.create_stages(2, material_tags_fn=lambda i: ['type.question', 'lec050500'])
+        db_studs = self.create_students(2)
+
+        def add_answers(stage_i, stud_i, grades, start=0):
+            DBSession.execute(
+                "INSERT INTO answer (stage_id, user_id, client_id, time_end, correct, grade)"
+                " SELECT :stage_id, :user_id, '01', TO_TIMESTAMP(1000 + :start + g.i), true, g.grade"
+                "   FROM UNNEST(CAST(:grades AS NUMERIC[])) WITH ORDINALITY g(grade, i)",
+                dict(stage_id=db_stages[stage_i].stage_id, user_id=db_studs[stud_i].user_id, grades=grades, start=start),
+            )
+
+        def progress():
+            return dict(
+                ((
+                    next(i for i, s in enumerate(db_studs) if s.user_id == r[0]),
+                    r[1],
+                ), (float(r[2]), float(r[3]), r[4]))
+                for r in DBSession.execute(
+                    "SELECT user_id, stage_name, latest_grade, max_grade, answer_count FROM user_stage_progress"
+                )
+            )
+
+        # Inserts are summarised, including more than one in a statement
+        add_answers(0, 0, [1, 5, 3])
+        add_answers(1, 0, [2], start=20)
+        add_answers(0, 1, [4])
+        self.assertEqual(progress(), {
+            (0, 'stage0'): (3, 5, 3),
+            (0, 'stage1'): (2, 2, 1),
+            (1, 'stage0'): (4, 4, 1),
+        })
+        add_answers(0, 0, [6, 0.5], start=10)
+        self.assertEqual(progress()[(0, 'stage0')], (0.5, 6, 5))
+
+        # Updating a mark that isn't the highest / latest doesn't change anything, regrading can lower the max
+        DBSession.execute("UPDATE answer SET correct = false, grade = 2 WHERE grade = 1")
+        self.assertEqual(progress()[(0, 'stage0')], (0.5, 6, 5))
+        DBSession.execute(
+            "UPDATE answer SET grade = grade - 0.5 WHERE stage_id = :stage_id",
+            dict(stage_id=db_stages[0].stage_id),
+        )
+        self.assertEqual(progress(), {
+            (0, 'stage0'): (0, 5.5, 5),
+            (0, 'stage1'): (2, 2, 1),
+            (1, 'stage0'): (3.5, 3.5, 1),
+        })
+
+        # Moving an answer to be the latest changes the latest grade
+        DBSession.execute("UPDATE answer SET time_end = TO_TIMESTAMP(2000) WHERE grade = 4.5")
+        self.assertEqual(progress()[(0, 'stage0')], (4.5, 5.5, 5))
+
+        # Deletes remove answers, and the row when there's nothing left
+        DBSession.execute("DELETE FROM answer WHERE grade = 5.5")
+        DBSession.execute(
+            "DELETE FROM answer WHERE user_id = :user_id",
+            dict(user_id=db_studs[1].user_id),
+        )
+        self.assertEqual(progress(), {
+            (0, 'stage0'): (4.5, 4.5, 4),
+            (0, 'stage1'): (2, 2, 1),
+        })
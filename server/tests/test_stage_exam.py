@@ -0,0 +1,135 @@
+import unittest
+import unittest.mock
+
+from .requires_postgresql import RequiresPostgresql
+from .requires_pyramid import RequiresPyramid
+from .requires_materialbank import RequiresMaterialBank
+
+from tutorweb_quizdb.stage.exam import exam_stages, exam_sheet_generate, exam_sheet_render
+from tutorweb_quizdb.stage.material import view_stage_material
+
+
+def fake_render(ms, permutation, student_dataframes={}, dataframe_digest=None):
+    if ms.path == 'example3.q.R':
+        return dict(error='ValueError', content='Broken')
+    return dict(content='%s:%d' % (ms.path, permutation), tags=ms.material_tags)
+
+
+class ExamPrepareTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
+    maxDiff = None
+
+    def sheets(self, db_stage):
+        """Return user_id -> list of (path, permutation, rendered content)"""
+        from tutorweb_quizdb import DBSession
+
+        out = {}
+        for user_id, path, permutation, rendered in DBSession.execute("""
+            SELECT es.user_id, ms.path, es.permutation, es.rendered
+              FROM exam_sheet es
+              JOIN material_source ms ON ms.material_source_id = es.material_source_id
+             WHERE es.stage_id = :stage_id
+          ORDER BY es.user_id, es.position
+        """, dict(stage_id=db_stage.stage_id)):
+            out.setdefault(user_id, []).append((path, permutation, rendered['content'] if rendered else None))
+        return out
+
+    def setUp(self):
+        super(ExamPrepareTest, self).setUp()
+        from tutorweb_quizdb.material.renderer.r import configure_pool
+        configure_pool(processes=0)
+
+    def tearDown(self):
+        from tutorweb_quizdb.material.renderer.r import configure_pool
+        configure_pool(processes=0)
+        super(ExamPrepareTest, self).tearDown()
+
+    def test_call(self):
+        from tutorweb_quizdb import DBSession
+        from tutorweb_quizdb.material.renderer.r import configure_pool
+
+        self.mb_write_example('example1.q.R', ('math099', 'Q-0990t0', 'lec050500'), 3)
+        self.mb_write_example('example2.q.R', ('math099', 'Q-0990t0', 'lec050500'), 3)
+        self.mb_write_example('example3.q.R', ('math099', 'Q-0990t0', 'lec050500'), 3)
+        self.mb_update()
+        db_stages = self.create_stages(2, lec_parent='ut.exam', material_tags_fn=lambda i: ['type.question', 'lec050500'], stage_setting_spec_fn=lambda i: [
+            dict(allocation_method=dict(value='exam'), question_cap=dict(value=4)),
+            dict(),
+        ][i])
+        db_other_stages = self.create_stages(1, lec_parent='ut.other', stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='exam'),
+        ))
+        db_studs = self.create_students(3)
+        for db_stud in db_studs[:2]:
+            DBSession.execute(
+                "INSERT INTO subscription (user_id, syllabus_id) SELECT :user_id, syllabus_id FROM syllabus WHERE path = 'ut.exam'",
+                dict(user_id=db_stud.user_id),
+            )
+
+        # Only exam stages are found
+        self.assertEqual([s.stage_id for s in exam_stages('ut.exam')], [db_stages[0].stage_id])
+        self.assertEqual([s.stage_id for s in exam_stages('ut')], [db_stages[0].stage_id, db_other_stages[0].stage_id])
+
+        # Subscribed students get sheets, checkpoint called after each batch
+        checkpoint = unittest.mock.Mock()
+        self.assertEqual(exam_sheet_generate(db_stages[0], checkpoint=checkpoint), 2)
+        self.assertEqual(checkpoint.call_count, 1)
+        sheets = self.sheets(db_stages[0])
+        self.assertEqual(sorted(sheets.keys()), [db_studs[0].user_id, db_studs[1].user_id])
+        self.assertEqual([len(s) for s in sheets.values()], [4, 4])
+        self.assertNotEqual(sheets[db_studs[0].user_id], sheets[db_studs[1].user_id])
+
+        # Settings were chosen & stored, so requests don't need to
+        (setting_count,) = DBSession.execute(
+            "SELECT COUNT(*) FROM user_stage_setting WHERE stage_id = :stage_id AND settings ? 'allocation_seed'",
+            dict(stage_id=db_stages[0].stage_id),
+        ).fetchone()
+        self.assertEqual(setting_count, 2)
+
+        # Running again does nothing, nor does a non-exam stage
+        self.assertEqual(exam_sheet_generate(db_stages[0]), 0)
+        self.assertEqual(self.sheets(db_stages[0]), sheets)
+        self.assertEqual(exam_sheet_generate(db_stages[1]), 0)
+        self.assertEqual(self.sheets(db_stages[1]), {})
+
+        # Render everything, each question rendered once, broken questions are left alone
+        with unittest.mock.patch('tutorweb_quizdb.material.render.material_render', side_effect=fake_render) as mock_render:
+            out = exam_sheet_render([db_stages[0].stage_id])
+        unique_questions = set((p, perm) for s in sheets.values() for p, perm, _ in s)
+        self.assertEqual(mock_render.call_count, len(unique_questions))
+        self.assertEqual(
+            (out['rendered'], out['failed']),
+            (len([q for q in unique_questions if q[0] != 'example3.q.R']), len([q for q in unique_questions if q[0] == 'example3.q.R'])),
+        )
+        for user_id, sheet in self.sheets(db_stages[0]).items():
+            self.assertEqual(sheet, [
+                (path, permutation, None if path == 'example3.q.R' else '%s:%d' % (path, permutation))
+                for path, permutation, _ in sheets[user_id]
+            ])
+
+        # Resuming only tries what's left
+        with unittest.mock.patch('tutorweb_quizdb.material.render.material_render', side_effect=fake_render) as mock_render:
+            out = exam_sheet_render([db_stages[0].stage_id])
+        self.assertEqual(mock_render.call_count, out['failed'])
+        self.assertEqual(out['rendered'], 0)
+
+        # Rendering also works with a pool of R workers
+        DBSession.execute(
+            "INSERT INTO subscription (user_id, syllabus_id) SELECT :user_id, syllabus_id FROM syllabus WHERE path = 'ut.other'",
+            dict(user_id=db_studs[2].user_id),
+        )
+        self.assertEqual(exam_sheet_generate(db_other_stages[0]), 1)
+        configure_pool(processes=2)
+        with unittest.mock.patch('tutorweb_quizdb.material.render.material_render', side_effect=fake_render):
+            out = exam_sheet_render([db_other_stages[0].stage_id])
+        configure_pool(processes=0)
+        other_sheet = self.sheets(db_other_stages[0])[db_studs[2].user_id]
+        self.assertEqual(out['rendered'] + out['failed'], len(other_sheet))
+        self.assertEqual(out['rendered'], len([x for x in other_sheet if x[2] is not None]))
+
+        # Pre-rendered material is served to the student, the rest is rendered on demand
+        with unittest.mock.patch('tutorweb_quizdb.material.render.material_render', side_effect=lambda ms, perm, sd, digest: dict(content='live')):
+            out = view_stage_material(self.request(user=db_studs[0], params=dict(path=db_stages[0])))
+        self.assertEqual([out['data'][s['uri']]['content'] for s in out['stats']], [
+            'live' if path == 'example3.q.R' else '%s:%d' % (path, permutation)
+            for path, permutation, _ in sheets[db_studs[0].user_id]
+        ])
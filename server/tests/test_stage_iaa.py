@@ -0,0 +1,451 @@
+import json
+import os.path
+import random
+import shutil
+import subprocess
+import unittest
+
+import numpy as np
+
+from .requires_postgresql import RequiresPostgresql
+from .requires_pyramid import RequiresPyramid
+from .requires_materialbank import RequiresMaterialBank
+
+from tutorweb_quizdb.stage.iaa import (
+    NoQuestionsException,
+    answer_queue_grades,
+    choose_question,
+    get_setting,
+    grade_weighting,
+    next_question,
+    qn_timeout,
+    question_bias,
+    question_distribution,
+)
+
+IAA_JS = os.path.join(os.path.dirname(__file__), '..', '..', 'client', 'lib', 'iaa.js')
+
+
+class FixedRandom():
+    """Stand-in for a numpy Generator, returning pre-determined numbers"""
+    def __init__(self, numbers):
+        self.numbers = list(numbers)
+
+    def random(self, size=None):
+        if size is None:
+            return self.numbers.pop(0)
+        out, self.numbers = self.numbers[:size], self.numbers[size:]
+        return np.array(out)
+
+
+def js_question_distribution(cases):
+    """Run questionDistribution & chooseQuestion from iaa.js for each case"""
+    script = """
+        var iaalib = new (require(%s))();
+        var cases = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+        console.log(JSON.stringify(cases.map(function (c) {
+            var dist, chosen;
+
+            Math.random = function () { return c.randoms.shift(); };
+            dist = iaalib.questionDistribution(c.questions, c.grade, c.answerQueue, [], 0, c.settings);
+            chosen = iaalib.chooseQuestion(dist);
+            return {
+                dist: dist.map(function (d) { return [d.qn.uri, d.probability]; }),
+                chosen: chosen.uri,
+            };
+        })));
+    """ % json.dumps(os.path.abspath(IAA_JS))
+    return json.loads(subprocess.run(
+        ['node', '-e', script],
+        input=json.dumps(cases).encode('utf8'),
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout.decode('utf8'))
+
+
+def js_grades(cases):
+    """Run gradeAllocation from iaa.js after each answer in each case, return grade_after for each"""
+    script = """
+        var iaalib = new (require(%s))();
+        var cases = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+        console.log(JSON.stringify(cases.map(function (c) {
+            return c.correct.map(function (x, i) {
+                var aq = c.correct.slice(0, i + 1).map(function (y) { return {correct: y, time_end: 1}; });
+                iaalib.gradeAllocation(c.settings, aq, {questions: new Array(c.question_count)});
+                return aq[aq.length - 1].grade_after;
+            });
+        })));
+    """ % json.dumps(os.path.abspath(IAA_JS))
+    return json.loads(subprocess.run(
+        ['node', '-e', script],
+        input=json.dumps(cases).encode('utf8'),
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout.decode('utf8'))
+
+
+def js_qn_timeouts(cases):
+    """Run qnTimeout from iaa.js for each (settings, grade) case"""
+    script = """
+        var iaalib = new (require(%s))();
+        var cases = JSON.parse(require('fs').readFileSync(0, 'utf8'));
+        console.log(JSON.stringify(cases.map(function (c) {
+            return iaalib.qnTimeout(c[0], c[1]);
+        })));
+    """ % json.dumps(os.path.abspath(IAA_JS))
+    return json.loads(subprocess.run(
+        ['node', '-e', script],
+        input=json.dumps(cases).encode('utf8'),
+        stdout=subprocess.PIPE,
+        check=True,
+    ).stdout.decode('utf8'))
+
+
+# Answer queues, with grade_after & allotted time for the next question after
+# each answer, as recorded from client/lib/iaa.js.
+# Answers are 1 (correct), 0 (incorrect) or - (ungraded). None means no timeout
+RECORDED_QUEUES = [
+    # Ungraded answers at the start, and following a graded answer
+    dict(settings={}, answers='--1-0', question_count=20,
+         grades=[0, 0, 3.5, 3.5, 0.75], timeouts=None),
+    # Either side of grade_nmin
+    dict(settings={}, answers='11111111', question_count=20,
+         grades=[3.5, 6, 7.75, 9, 9.75, 10, 10, 10], timeouts=None),
+    dict(settings={}, answers='111111111', question_count=20,
+         grades=[3.5, 6, 7.75, 9, 9.75, 10, 10, 10, 10], timeouts=None),
+    # Negative totals are clamped to 0
+    dict(settings={}, answers='000000', question_count=20,
+         grades=[0, 0, 0, 0, 0, 0], timeouts=None),
+    # Either side of grade_nmax, older answers drop out of the window
+    dict(settings={}, answers='1' * 30 + '0', question_count=20,
+         grades=[3.5, 6, 7.75, 9, 9.75] + [10] * 25 + [8.25], timeouts=None),
+    dict(settings={}, answers='0' * 30 + '11', question_count=20,
+         grades=[0] * 32, timeouts=None),
+    # grade_alpha large enough to be prepended
+    dict(settings=dict(grade_alpha='0.5', grade_s='2', grade_nmin='8', grade_nmax='30'), answers='1011-1', question_count=20,
+         grades=[5, 0, 5.5, 7, 7, 8.25], timeouts=None),
+    # grade_s=0, i.e. flat weighting
+    dict(settings=dict(grade_alpha='0.2', grade_s='0'), answers='11111110', question_count=20,
+         grades=[2, 3.25, 4.25, 5.5, 6.5, 7.75, 8.75, 7], timeouts=None),
+    # Non-integer grade_nmin / grade_nmax are rounded
+    dict(settings=dict(grade_nmin='8.4', grade_nmax='22.241'), answers='1101101101101101101101101', question_count=20, grades=[
+        3.5, 6, 2.5, 5.25, 7, 3, 5.25, 7, 3.25, 5, 6.5, 3.75, 5, 6, 4, 5, 6, 4.25, 5, 5.75, 4.25, 5, 5.75, 4.25, 5,
+    ], timeouts=None),
+    # A window smaller than the default grade_nmin
+    dict(settings=dict(grade_nmin='3', grade_nmax='3'), answers='1101', question_count=20,
+         grades=[8, 10, 0, 7], timeouts=None),
+    # scorrect / ratiocorrect aren't capped at 10, and ignore ungraded answers
+    dict(settings=dict(grade_algorithm='scorrect', grade_s='7'), answers='1-101111111', question_count=20,
+         grades=[1.43, 1.43, 2.86, 2.86, 4.29, 5.71, 7.14, 8.57, 10, 11.43, 12.86], timeouts=None),
+    dict(settings=dict(grade_algorithm='ratiocorrect'), answers='110-1', question_count=3,
+         grades=[3.33, 6.67, 6.67, 6.67, 10], timeouts=None),
+    # Timeouts are shortest around timeout_grade
+    dict(settings=dict(timeout_max='10', timeout_min='3'), answers='11111111111', question_count=20,
+         grades=[3.5, 6, 7.75, 9, 9.75, 10, 10, 10, 10, 10, 10],
+         timeouts=[283, 230, 437, 544, 575, 582, 582, 582, 582, 582, 582]),
+    dict(settings=dict(timeout_max='10', timeout_min='3', timeout_grade='8', timeout_std='1'), answers='1111111111', question_count=20,
+         grades=[3.5, 6, 7.75, 9, 9.75, 10, 10, 10, 10, 10],
+         timeouts=[600, 544, 193, 346, 510, 544, 544, 544, 544, 544]),
+    # No timeout_min, no timeout
+    dict(settings=dict(timeout_max='10', timeout_min='0'), answers='11', question_count=20,
+         grades=[3.5, 6], timeouts=None),
+    # Fractional minutes, timeouts following scorrect grades
+    dict(settings=dict(timeout_max='2.5', timeout_min='0.5', timeout_std='0.5', grade_algorithm='scorrect', grade_s='2'), answers='1-10', question_count=20,
+         grades=[5, 5, 10, 10], timeouts=[30, 30, 150, 150]),
+]
+
+
+class GetSettingTest(unittest.TestCase):
+    def test_call(self):
+        self.assertEqual(get_setting({}, 'x', 4), 4)
+        self.assertEqual(get_setting(dict(x='0.5'), 'x', 4), 0.5)
+        self.assertEqual(get_setting(dict(x='moo'), 'x', 4), 4)
+        self.assertEqual(get_setting(dict(x=None), 'x', 4), 4)
+        self.assertEqual(get_setting(dict(x='NaN'), 'x', 4), 4)
+        self.assertEqual(get_setting({}, 'x', 'adaptive'), 'adaptive')
+        self.assertEqual(get_setting(dict(x='exam'), 'x', 'adaptive'), 'exam')
+
+    def test_qn_timeout(self):
+        self.assertEqual(qn_timeout({}, 5), None)
+        self.assertEqual(qn_timeout(dict(timeout_max='10', timeout_min='3'), 5), 180)
+        self.assertEqual(qn_timeout(dict(timeout_max='10', timeout_min='3'), 0), 582)
+
+
+class QuestionDistributionTest(unittest.TestCase):
+    def test_call(self):
+        # Same as QuestionDistribution in client/tests/test_iaalib.js
+        chosen = [100] * 10
+        correct = [10, 20, 30, 40, 50, 60, 70, 80, 90, 99]
+        uris = [str(i) for i in range(10)]
+
+        def question_order(grade, answer_queue, settings={}):
+            indexes, probabilities = question_distribution(
+                chosen,
+                correct,
+                question_bias(uris, answer_queue),
+                grade,
+                settings,
+                FixedRandom([]),
+            )
+            self.assertTrue(np.all(np.diff(probabilities) >= 0))
+            self.assertAlmostEqual(probabilities.sum(), 1)
+            return [uris[i] for i in indexes[::-1]]
+
+        # Previous items get weighted down
+        self.assertEqual(question_order(3, []), ['7', '6', '8', '5', '4', '9', '3', '2', '1', '0'])
+        self.assertEqual(
+            question_order(3, [('6', True)]),
+            ['7', '8', '5', '4', '9', '3', '2', '1', '6', '0'],
+        )
+
+        # Old incorrect questions get boosted, a new answer overrides this
+        self.assertEqual(
+            question_order(3, [('3', False)] + [('0', True)] * 7),
+            ['3', '7', '6', '8', '5', '4', '9', '2', '1', '0'],
+        )
+        self.assertEqual(
+            question_order(3, [('3', False)] + [('0', True)] * 7 + [('3', True)]),
+            ['7', '6', '8', '5', '4', '9', '2', '1', '3', '0'],
+        )
+
+        # gpow has an effect on the distribution
+        self.assertEqual(
+            question_order(3, [], dict(iaa_adaptive_gpow='1.5')),
+            ['8', '9', '7', '6', '5', '4', '3', '2', '1', '0'],
+        )
+
+    def test_choose_question(self):
+        self.assertEqual(choose_question(np.array([]), 0.5), None)
+        self.assertEqual(choose_question(np.array([0.1, 0.2, 0.7]), 0.05), 0)
+        self.assertEqual(choose_question(np.array([0.1, 0.2, 0.7]), 0.1), 0)
+        self.assertEqual(choose_question(np.array([0.1, 0.2, 0.7]), 0.25), 1)
+        self.assertEqual(choose_question(np.array([0.1, 0.2, 0.7]), 0.99), 2)
+        self.assertEqual(choose_question(np.array([0.1, 0.2, 0.6999999]), 1), 2)
+
+    def test_js_parity(self):
+        """Compare results with client/lib/iaa.js on a selection of answer queues"""
+        if not shutil.which('node'):
+            self.skipTest("node not available")
+        r = random.Random(2023)
+
+        cases = []
+        for grade, qn_count, settings in [
+                (0, 1, {}),
+                (0, 10, {}),
+                (1.25, 50, {}),
+                (3.5, 50, dict(iaa_adaptive_gpow='0.5')),
+                (7.25, 100, {}),
+                (10, 100, dict(iaa_adaptive_gpow='1.5')),
+                (5, 300, {}),
+        ]:
+            questions = []
+            for i in range(qn_count):
+                qn_chosen = r.choice([0, 1, 3, 5, 6, 20, 100, 1000])
+                questions.append(dict(uri='q%d' % i, chosen=qn_chosen, correct=r.randint(0, qn_chosen)))
+            answer_queue = [
+                dict(uri=r.choice(questions)['uri'], correct=r.choice([True, False, None]))
+                for i in range(r.randint(0, 40))
+            ]
+            cases.append(dict(
+                questions=questions,
+                grade=grade,
+                answerQueue=answer_queue,
+                settings=settings,
+                randoms=[r.random() for q in questions if q['chosen'] <= 5] + [r.random()],
+            ))
+
+        for c, js_out in zip(cases, js_question_distribution(cases)):
+            rng = FixedRandom(c['randoms'])
+            indexes, probabilities = question_distribution(
+                [q['chosen'] for q in c['questions']],
+                [q['correct'] for q in c['questions']],
+                question_bias([q['uri'] for q in c['questions']], [(a['uri'], a['correct']) for a in c['answerQueue']]),
+                c['grade'],
+                c['settings'],
+                rng,
+            )
+            py_dist = dict((c['questions'][i]['uri'], p) for i, p in zip(indexes, probabilities))
+            self.assertEqual(set(py_dist.keys()), set(uri for uri, p in js_out['dist']))
+            for uri, p in js_out['dist']:
+                self.assertAlmostEqual(py_dist[uri], p, places=10)
+            self.assertEqual(
+                c['questions'][indexes[choose_question(probabilities, rng.random())]]['uri'],
+                js_out['chosen'],
+            )
+
+
+class AnswerQueueGradesTest(unittest.TestCase):
+    def test_grade_weighting(self):
+        # Same as Weighting in client/tests/test_iaalib.js
+        self.assertEqual([round(x, 4) for x in grade_weighting(1, 0.5, 2, 8, 30)], [
+            0.5, 0.175, 0.1286, 0.0893, 0.0571, 0.0321, 0.0143, 0.0036,
+        ])
+        self.assertEqual([round(x, 4) for x in grade_weighting(5, 0.3, 2, 8, 30)], [
+            0.35, 0.2571, 0.1786, 0.1143, 0.0643, 0.0286, 0.0071, 0.0,
+        ])
+        self.assertEqual([round(x, 4) for x in grade_weighting(5, 0.2, 0, 8, 30)], [
+            0.2, 0.1143, 0.1143, 0.1143, 0.1143, 0.1143, 0.1143, 0.1143,
+        ])
+        for i in range(1, 50):
+            self.assertEqual(len(grade_weighting(i, 0.5, 2, 8, 30)), min(max(i, 8), 30))
+            self.assertAlmostEqual(grade_weighting(i, 0.5, 2, 8, 30).sum(), 1)
+        self.assertEqual(len(grade_weighting(30, 0.5, 2, 8.4, 22.241)), 22)
+
+    def test_call(self):
+        nan = float('nan')
+        self.assertEqual(answer_queue_grades([], {}).tolist(), [])
+        self.assertEqual(answer_queue_grades([1, 1, 0, nan, 1], dict(grade_algorithm='scorrect', grade_s='3')).tolist(), [
+            3.33, 6.67, 6.67, 6.67, 10,
+        ])
+        self.assertEqual(answer_queue_grades([1, 0, 1], dict(grade_algorithm='ratiocorrect'), 4).tolist(), [
+            2.5, 2.5, 5,
+        ])
+        # Ungraded answers get the same grade as the answer before
+        grades = answer_queue_grades([1, 1, nan, 0, nan, 1], {}).tolist()
+        self.assertEqual(grades[1], grades[2])
+        self.assertEqual(grades[3], grades[4])
+        # Weighted grades are rounded to nearest .25
+        self.assertEqual([g * 4 for g in grades], [int(g * 4) for g in grades])
+        with self.assertRaisesRegex(ValueError, 'grade_algorithm'):
+            answer_queue_grades([1], dict(grade_algorithm='moo'))
+
+    def test_js_parity(self):
+        """Compare results with gradeAllocation in client/lib/iaa.js"""
+        if not shutil.which('node'):
+            self.skipTest("node not available")
+        r = random.Random(2023)
+
+        cases = []
+        for settings in [
+                {},
+                dict(grade_alpha='0.3', grade_s='1'),
+                dict(grade_alpha='0.2', grade_s='0'),
+                dict(grade_alpha='0.15', grade_s='4', grade_nmin='5', grade_nmax='50'),
+                dict(grade_nmin='12', grade_nmax='12'),
+                dict(grade_algorithm='scorrect', grade_s='7'),
+                dict(grade_algorithm='ratiocorrect'),
+        ]:
+            for p_correct in (0.2, 0.5, 0.8, 0.95):
+                cases.append(dict(
+                    settings=settings,
+                    correct=[r.random() < p_correct if r.random() > 0.1 else None for i in range(r.randint(1, 80))],
+                    question_count=r.randint(5, 100),
+                ))
+
+        for c, js_out in zip(cases, js_grades(cases)):
+            self.assertEqual(answer_queue_grades(
+                [float('nan') if x is None else float(x) for x in c['correct']],
+                c['settings'],
+                c['question_count'],
+            ).tolist(), js_out, c)
+
+    def test_recorded_queues(self):
+        """Grades & timeouts for answer queues recorded from client/lib/iaa.js"""
+        for c in RECORDED_QUEUES:
+            grades = answer_queue_grades(
+                [float('nan') if x == '-' else float(x) for x in c['answers']],
+                c['settings'],
+                c['question_count'],
+            ).tolist()
+            self.assertEqual(grades, c['grades'], c)
+            self.assertEqual(
+                [qn_timeout(c['settings'], g) for g in grades],
+                c['timeouts'] or [None] * len(grades),
+                c,
+            )
+
+        # Make sure the recordings still match iaa.js
+        if not shutil.which('node'):
+            self.skipTest("node not available")
+        self.assertEqual(js_grades([dict(
+            settings=c['settings'],
+            correct=[None if x == '-' else x == '1' for x in c['answers']],
+            question_count=c['question_count'],
+        ) for c in RECORDED_QUEUES]), [c['grades'] for c in RECORDED_QUEUES])
+        self.assertEqual(
+            js_qn_timeouts([(c['settings'], g) for c in RECORDED_QUEUES for g in c['grades']]),
+            [t for c in RECORDED_QUEUES for t in (c['timeouts'] or [None] * len(c['grades']))],
+        )
+
+
+class NextQuestionTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
+    def test_call(self):
+        from tutorweb_quizdb import DBSession
+        from tutorweb_quizdb.stage.allocation import get_allocation
+        from tutorweb_quizdb.stage.setting import getStudentSettings
+
+        self.mb_write_example('example1.q.R', ('math099', 'Q-0990t0', 'lec050500'), 3)
+        self.mb_write_example('example2.q.R', ('math099', 'Q-0990t0', 'lec050500'), 2)
+        self.mb_update()
+        db_stages = self.create_stages(3, material_tags_fn=lambda i: ['type.question', 'lec050500' if i < 2 else 'lec999'], stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+            iaa_type=dict(value='exam' if i == 1 else 'adaptive'),
+            timeout_max=dict(value=10),
+            timeout_min=dict(value=3),
+        ))
+        db_studs = self.create_students(2)
+
+        def alloc(db_stage, db_stud):
+            return get_allocation(getStudentSettings(db_stage, db_stud), db_stage, db_stud)
+
+        def add_answer(db_stage, db_stud, mss_id, permutation, correct, grade):
+            DBSession.execute(
+                "INSERT INTO answer (stage_id, user_id, material_source_id, permutation, client_id, time_end, correct, grade)"
+                " VALUES (:stage_id, :user_id, :mss_id, :permutation, '01',"
+                "         NOW() + (SELECT COUNT(*) FROM answer) * INTERVAL '1 second', :correct, :grade)",
+                dict(
+                    stage_id=db_stage.stage_id,
+                    user_id=db_stud.user_id,
+                    mss_id=mss_id,
+                    permutation=permutation,
+                    correct=correct,
+                    grade=grade,
+                ),
+            )
+
+        # No answers yet, get a question from the stage with grade 0
+        a = alloc(db_stages[0], db_studs[0])
+        material = a.get_material()
+        out = next_question(a, rng=np.random.default_rng(0))
+        self.assertIn((out['mss_id'], out['permutation']), material)
+        self.assertEqual(out['grade_before'], 0)
+        self.assertEqual(out['allotted_time'], 582)
+        self.assertEqual(out['student_answer'], {})
+        self.assertEqual(next_question(a, practice=True, rng=np.random.default_rng(0))['student_answer'], dict(practice=True))
+
+        # Each question eventually gets picked
+        self.assertEqual(
+            set((out['mss_id'], out['permutation']) for out in (next_question(a, rng=np.random.default_rng(i)) for i in range(200))),
+            set(tuple(m) for m in material),
+        )
+
+        # Answer everything but one correctly, that one's favoured & grade comes from the last answer
+        for m in material[1:]:
+            add_answer(db_stages[0], db_studs[0], m[0], m[1], True, 5.5)
+        out = next_question(a, rng=np.random.default_rng(0))
+        self.assertEqual(out['grade_before'], 5.5)
+        counts = {}
+        for i in range(200):
+            out = next_question(a, rng=np.random.default_rng(i))
+            counts[(out['mss_id'], out['permutation'])] = counts.get((out['mss_id'], out['permutation']), 0) + 1
+        self.assertEqual(max(counts, key=counts.get), tuple(material[0]))
+
+        # Answers from other students don't matter
+        self.assertEqual(next_question(alloc(db_stages[0], db_studs[1]), rng=np.random.default_rng(0))['grade_before'], 0)
+
+        # Exam mode goes through questions in order, then stops
+        a = alloc(db_stages[1], db_studs[0])
+        material = a.get_material()
+        for m in material:
+            out = next_question(a)
+            self.assertEqual((out['mss_id'], out['permutation']), tuple(m))
+            add_answer(db_stages[1], db_studs[0], m[0], m[1], False, 0)
+        with self.assertRaisesRegex(NoQuestionsException, 'answered all questions'):
+            next_question(a)
+        with self.assertRaisesRegex(ValueError, 'Practice during an exam'):
+            next_question(a, practice=True)
+
+        # No material, no questions
+        with self.assertRaisesRegex(NoQuestionsException, 'no questions'):
+            next_question(alloc(db_stages[2], db_studs[0]))
@@ -0,0 +1,123 @@
+import unittest
+import unittest.mock
+
+import transaction
+
+from .requires_postgresql import RequiresPostgresql
+from .requires_pyramid import RequiresPyramid
+from .requires_materialbank import RequiresMaterialBank
+
+from tutorweb_quizdb.lti import TwRequestValidator
+from tutorweb_quizdb.stage.index import stage_sync_many
+
+
+def aq_dict(**d):
+    """Fill in the boring bits of an answer queue entry"""
+    d['client_id'] = '01'
+    d['time_start'] = d['time_end'] - 10
+    d['correct'] = True
+    d['grade_after'] = 0.1
+    d['student_answer'] = {}
+    return d
+
+
+class StageSyncManyTest(RequiresMaterialBank, RequiresPyramid, RequiresPostgresql, unittest.TestCase):
+    def test_call(self):
+        from tutorweb_quizdb import DBSession
+        transaction.abort()  # Start with a fresh transaction, so savepoints are available
+
+        self.mb_write_example('example1.q.R', ('math099', 'Q-0990t0', 'lec050500'), 10)
+        self.mb_update()
+        db_stages = self.create_stages(3, stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+        ), material_tags_fn=lambda i: ['type.question', 'lec050500'])
+        db_studs = self.create_students(2)
+        paths = [self.request(params=dict(path=s)).params['path'] for s in db_stages]
+
+        def stored_answers(db_stage):
+            return [x[0] for x in DBSession.execute("""
+                SELECT EXTRACT(EPOCH FROM time_end)::INT FROM answer WHERE stage_id = :stage_id ORDER BY time_end
+            """, dict(stage_id=db_stage.stage_id))]
+
+        out = stage_sync_many(self.request(user=db_studs[0], method='POST', body=dict(stages=[
+            dict(path=paths[0], answerQueue=[aq_dict(uri='example1.q.R:1:1', time_end=1010)], sync_cursor=None),
+            dict(path='dept.tutorial.parp.stage0', answerQueue=[]),
+            dict(path=paths[1], answerQueue=[aq_dict(uri='parp:1:1', time_end=1010)]),
+            dict(path=paths[2], answerQueue=[
+                aq_dict(uri='example1.q.R:1:2', time_end=1020),
+                aq_dict(uri='example1.q.R:1:3', time_end=1030),
+            ]),
+        ])))
+
+        # Each stage got a response in order, failed stages have an error instead
+        self.assertEqual([x['path'] for x in out['stages']], [
+            paths[0],
+            'dept.tutorial.parp.stage0',
+            paths[1],
+            paths[2],
+        ])
+        self.assertEqual(out['stages'][1]['error']['type'], 'NoResultFound')
+        self.assertEqual(out['stages'][2]['error']['type'], 'ValueError')
+        self.assertIn('parp:1:1', out['stages'][2]['error']['message'])
+
+        # Working stages look like stage_index responses
+        self.assertEqual([a['uri'] for a in out['stages'][0]['answerQueue']], ['example1.q.R:1:1'])
+        self.assertIn('sync_cursor', out['stages'][0])
+        self.assertEqual([a['uri'] for a in out['stages'][3]['answerQueue']], ['example1.q.R:1:2', 'example1.q.R:1:3'])
+        self.assertNotIn('sync_cursor', out['stages'][3])
+        self.assertEqual(out['stages'][3]['user'], db_studs[0].username)
+        self.assertEqual(stored_answers(db_stages[0]), [1010])
+        self.assertEqual(stored_answers(db_stages[1]), [])
+        self.assertEqual(stored_answers(db_stages[2]), [1020, 1030])
+
+        # Drills for another user are rejected, leaving the rest alone
+        out = stage_sync_many(self.request(user=db_studs[1], method='POST', body=dict(stages=[
+            dict(path=paths[0], user=db_studs[0].username, answerQueue=[aq_dict(uri='example1.q.R:1:4', time_end=1040)]),
+            dict(path=paths[1], user=db_studs[1].username, answerQueue=[aq_dict(uri='example1.q.R:1:4', time_end=1040)]),
+        ])))
+        self.assertEqual(out['stages'][0]['error']['type'], 'IncorrectUserException')
+        self.assertEqual([a['uri'] for a in out['stages'][1]['answerQueue']], ['example1.q.R:1:4'])
+        self.assertEqual(stored_answers(db_stages[0]), [1010])
+        self.assertEqual(stored_answers(db_stages[1]), [1040])
+
+    @unittest.mock.patch('tutorweb_quizdb.lti.request_validator', TwRequestValidator(dict(k1="secret1")))
+    @unittest.mock.patch('tutorweb_quizdb.lti.OutcomeRequest')
+    def test_lti_passback(self, mock_outcome):
+        from tutorweb_quizdb import DBSession, Base
+        transaction.abort()  # Start with a fresh transaction, so savepoints are available
+
+        self.mb_write_example('example1.q.R', ('math099', 'Q-0990t0', 'lec050500'), 10)
+        self.mb_update()
+        db_stages = self.create_stages(2, stage_setting_spec_fn=lambda i: dict(
+            allocation_method=dict(value='passthrough'),
+            allocation_bank_name=dict(value=self.material_bank.name),
+        ), material_tags_fn=lambda i: ['type.question', 'lec050500'])
+        db_studs = self.create_students(1)
+        paths = [self.request(params=dict(path=s)).params['path'] for s in db_stages]
+        for db_stage in db_stages:
+            DBSession.add(Base.classes.lti_sourcedid(
+                user_id=db_studs[0].user_id,
+                stage_id=db_stage.stage_id,
+                client_key='k1',
+                lis_outcome_service_url='http://lti.example.com/outcome',
+                lis_result_sourcedid='sourcedid%d' % db_stage.stage_id,
+            ))
+        DBSession.flush()
+        mock_outcome.return_value.post_replace_result.return_value.is_success.return_value = True
+
+        # Second stage fails after syncing answers, so only the first stage's grade is sent
+        out = stage_sync_many(self.request(user=db_studs[0], method='POST', body=dict(stages=[
+            dict(path=paths[0], answerQueue=[aq_dict(uri='example1.q.R:1:1', time_end=1010)]),
+            dict(path=paths[1], answerQueue=[aq_dict(uri='example1.q.R:1:2', time_end=1020)], questions=[
+                dict(uri='parp:1:1', initial_answered=0, initial_correct=0),
+            ]),
+        ])))
+        self.assertNotIn('error', out['stages'][0])
+        self.assertIn('error', out['stages'][1])
+        stage_ids = [s.stage_id for s in db_stages]
+        transaction.commit()
+        self.assertEqual(
+            [c[1]['opts']['lis_result_sourcedid'] for c in mock_outcome.call_args_list],
+            ['sourcedid%d' % stage_ids[0]],
+        )
@@ -6,7 +6,7 @@ from sqlalchemy_utils import Ltree
 from .requires_postgresql import RequiresPostgresql
 from .requires_pyramid import RequiresPyramid
 
-from tutorweb_quizdb.stage.setting import SettingSpec, getStudentSettings, clientside_settings
+from tutorweb_quizdb.stage.setting import SettingSpec, getStudentSettings, assign_student_settings, assign_settings_within, clientside_settings
 
 
 LOTS_OF_TESTS = 100000
@@ -63,6 +63,41 @@ class SettingSpecTest(unittest.TestCase):
         for x in range(LOTS_OF_TESTS):
             self.assertIn(csv(key="grade_nmin", max=9), '0 1 2 3 4 5 6 7 8 9'.split())
 
+    def test_choose_values(self):
+        """choose_values generates many of the same values choose_value would"""
+        def cvs(count, **kwargs):
+            return SettingSpec(kwargs.get('key', 'x'), kwargs).choose_values(count)
+
+        # Fixed values return the value in question
+        self.assertEqual(cvs(3, value=4), ['4', '4', '4'])
+        self.assertEqual(cvs(0, max=4), [])
+
+        # Random values are all within bounds
+        out = [float(x) for x in cvs(LOTS_OF_TESTS, min=90, max=100)]
+        self.assertTrue(min(out) >= 90)
+        self.assertTrue(max(out) < 100)
+        self.assertEqual(len(set(out)), LOTS_OF_TESTS)
+
+        # Gamma values hit the mean, and get re-chosen if out of bounds
+        out = [float(x) for x in cvs(LOTS_OF_TESTS, value=1000000, shape=2)]
+        self.assertTrue(abs(sum(out) / LOTS_OF_TESTS - 2000000) < 50000)
+        out = [float(x) for x in cvs(LOTS_OF_TESTS, value=1000000, shape=2, min=100000, max=6000000)]
+        self.assertTrue(min(out) >= 100000)
+        self.assertTrue(max(out) < 6000000)
+        with self.assertRaisesRegex(ValueError, 'shape'):
+            cvs(10, value=1, shape=2, min=1000, max=1001)
+
+        # Strings can only be randstring
+        out = cvs(100, key="iaa_mode", randstring=10)
+        self.assertEqual(set(len(x) for x in out), set([10]))
+        self.assertEqual(len(set(out)), 100)
+        self.assertTrue(all(32 <= ord(c) <= 127 for x in out for c in x))
+        with self.assertRaisesRegex(ValueError, 'iaa_mode'):
+            cvs(10, key="iaa_mode", value="fun-size", max=4)
+
+        # Integer settings get rounded
+        self.assertEqual(set(cvs(LOTS_OF_TESTS, key="grade_nmin", max=9)), set('0 1 2 3 4 5 6 7 8 9'.split()))
+
     def test_equivalent(self):
         def equiv(d1, d2):
             return SettingSpec('x', d1).equivalent(SettingSpec('x', d2))
@@ -250,6 +285,160 @@ class GetStudentSettingsTest(RequiresPyramid, RequiresPostgresql, unittest.TestC
             allocation_seed=global_settings[0]['allocation_seed'],
         ))
 
+    def test_cache(self):
+        """Settings are fetched in one query, and once stored, cached"""
+        import transaction
+        from sqlalchemy import event
+        from tutorweb_quizdb import DBSession, Base
+        from tutorweb_quizdb.models import User
+        from tutorweb_quizdb.stage.setting import SETTINGS_CACHE
+
+        transaction.begin()  # NB: We're committing, so start from a clean transaction
+        stage_id = self.create_stages(1, stage_setting_spec_fn=lambda i: dict(
+            hist_sel=dict(value=0.5),
+            grade_s=dict(min=1, max=100),
+        ))[0].stage_id
+        user_ids = [u.user_id for u in self.create_students(2)]
+        transaction.commit()
+
+        statements = []
+
+        def count_statements(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        def student_settings(user_id):
+            # NB: Fetch objects each time, committing detaches them
+            db_stage = DBSession.query(Base.classes.stage).get(stage_id)
+            db_user = DBSession.query(User).get(user_id)
+            statements.clear()
+            return getStudentSettings(db_stage, db_user)
+
+        event.listen(DBSession.get_bind(), 'after_cursor_execute', count_statements)
+        try:
+            # First call chooses & stores settings: one query to fetch, one to store
+            out = student_settings(user_ids[0])
+            self.assertEqual(len(statements), 2)
+
+            # Nothing is cached until the transaction commits
+            self.assertEqual(len(SETTINGS_CACHE), 0)
+            transaction.commit()
+            self.assertEqual(len(SETTINGS_CACHE), 1)
+
+            # Next call is served from the cache
+            self.assertEqual(student_settings(user_ids[0]), out)
+            self.assertEqual(len(statements), 0)
+
+            # Modifying the output doesn't affect the cache
+            student_settings(user_ids[0])['hist_sel'] = '0.9'
+            self.assertEqual(student_settings(user_ids[0]), out)
+            self.assertEqual(len(statements), 0)
+
+            # Settings from an aborted transaction aren't cached, and get chosen again
+            student_settings(user_ids[1])
+            transaction.abort()
+            self.assertEqual(len(SETTINGS_CACHE), 1)
+            student_settings(user_ids[1])
+            self.assertEqual(len(statements), 2)
+            transaction.abort()
+        finally:
+            event.remove(DBSession.get_bind(), 'after_cursor_execute', count_statements)
+        db_stages = [DBSession.query(Base.classes.stage).get(stage_id)]
+        db_studs = [DBSession.query(User).get(user_id) for user_id in user_ids]
+
+        # A single row per student per stage
+        self.assertEqual([(r[0], r[1]) for r in DBSession.execute(
+            "SELECT user_id, settings FROM user_stage_setting WHERE stage_id = :stage_id",
+            dict(stage_id=db_stages[0].stage_id),
+        )], [(db_studs[0].user_id, dict(
+            allocation_encryption_key=out['allocation_encryption_key'],
+            allocation_seed=out['allocation_seed'],
+            grade_s=out['grade_s'],
+        ))])
+
+        # A new version of the stage isn't cached, and gets new settings
+        new_stage = self.upgrade_stage(db_stages[0], dict(hist_sel=dict(value=0.9)))
+        new_out = getStudentSettings(new_stage, db_studs[0])
+        self.assertEqual(new_out, dict(out, hist_sel='0.9'))
+
+        # If another request stored settings first, we use theirs
+        DBSession.execute(
+            "INSERT INTO user_stage_setting (stage_id, user_id, settings) VALUES (:stage_id, :user_id, CAST(:settings AS JSONB))",
+            dict(stage_id=db_stages[0].stage_id, user_id=db_studs[1].user_id, settings='{"grade_s": "42"}'),
+        )
+        out = getStudentSettings(db_stages[0], db_studs[1])
+        self.assertEqual(out['grade_s'], '42')
+
+    def test_assign_student_settings(self):
+        """Settings can be chosen for all students in advance"""
+        from tutorweb_quizdb import DBSession
+
+        db_stages = self.create_stages(2, lec_parent='ut.assign', stage_setting_spec_fn=lambda i: dict(
+            hist_sel=dict(value=0.5),
+            grade_s=dict(min=1, max=100),
+            grade_t=dict(value=10, shape=2),
+        ))
+        db_studs = self.create_students(4)
+        for db_stud in db_studs[:3]:
+            DBSession.execute(
+                "INSERT INTO subscription (user_id, syllabus_id) SELECT :user_id, syllabus_id FROM syllabus WHERE path = 'ut.assign'",
+                dict(user_id=db_stud.user_id),
+            )
+
+        def stored(db_stage):
+            return dict(DBSession.execute(
+                "SELECT user_id, settings FROM user_stage_setting WHERE stage_id = :stage_id",
+                dict(stage_id=db_stage.stage_id),
+            ).fetchall())
+
+        # Student 0 has already visited stage 0
+        visited = getStudentSettings(db_stages[0], db_studs[0])
+
+        # Subscribed students get settings, apart from ones that already have them
+        self.assertEqual(assign_student_settings(db_stages[0]), 2)
+        settings = stored(db_stages[0])
+        self.assertEqual(sorted(settings.keys()), [s.user_id for s in db_studs[:3]])
+        for db_stud in db_studs[:3]:
+            self.assertEqual(sorted(settings[db_stud.user_id].keys()), ['allocation_encryption_key', 'allocation_seed', 'grade_s', 'grade_t'])
+            self.assertTrue(1 <= float(settings[db_stud.user_id]['grade_s']) < 100)
+        self.assertEqual(len(set(s['grade_s'] for s in settings.values())), 3)
+        self.assertEqual(assign_student_settings(db_stages[0]), 0)
+
+        # getStudentSettings uses them, the student that visited didn't change
+        for db_stud in db_studs[:3]:
+            self.assertEqual(getStudentSettings(db_stages[0], db_stud), dict(settings[db_stud.user_id], hist_sel='0.5'))
+        self.assertEqual(getStudentSettings(db_stages[0], db_studs[0]), visited)
+        self.assertEqual(stored(db_stages[0]), settings)
+
+        # Can choose specific students, even if not subscribed
+        self.assertEqual(assign_student_settings(db_stages[1], user_ids=[db_studs[3].user_id]), 1)
+        self.assertEqual(list(stored(db_stages[1]).keys()), [db_studs[3].user_id])
+
+        # A new version of the stage carries over equivalent settings, chooses new values otherwise
+        new_stage = self.upgrade_stage(db_stages[0], dict(grade_t=dict(value=20, shape=2)))
+        self.assertEqual(assign_student_settings(new_stage), 3)
+        new_settings = stored(new_stage)
+        for db_stud in db_studs[:3]:
+            old, new = settings[db_stud.user_id], new_settings[db_stud.user_id]
+            self.assertEqual(new['allocation_seed'], old['allocation_seed'])
+            self.assertEqual(new['allocation_encryption_key'], old['allocation_encryption_key'])
+            self.assertEqual(new['grade_s'], old['grade_s'])
+            self.assertNotEqual(new['grade_t'], old['grade_t'])
+
+        # ...the same as getStudentSettings would have done
+        DBSession.execute("DELETE FROM user_stage_setting WHERE stage_id = :stage_id", dict(stage_id=new_stage.stage_id))
+        out = getStudentSettings(new_stage, db_studs[1])
+        self.assertEqual(
+            dict((k, v) for k, v in out.items() if k != 'grade_t'),
+            dict(((k, v) for k, v in new_settings[db_studs[1].user_id].items() if k != 'grade_t'), hist_sel='0.5'),
+        )
+
+        # Settings are assigned everywhere within a path
+        DBSession.execute("DELETE FROM user_stage_setting")
+        self.assertEqual(
+            [(s.stage_id, count) for s, count in assign_settings_within('ut.assign')],
+            [(new_stage.stage_id, 3), (db_stages[1].stage_id, 3)],
+        )
+
 
 class ClientsideSettingsTest(unittest.TestCase):
     def test_call(self):
@@ -180,3 +180,68 @@ class LecImportTest(RequiresPyramid, RequiresPostgresql, unittest.TestCase):
                 ['ut.lec_import.1.leca'],
                 ['ut.lec_import.1.lecb'],
             ]]]])
+
+    def test_stage_lineage(self):
+        from tutorweb_quizdb import DBSession
+
+        def import_stages(*setting_specs):
+            lec_import(dict(
+                path='ut.lec_import.0',
+                titles=['ut', 'lec_import', '0'],
+                requires_group=None,
+                lectures=[
+                    ['lec0', 'UT lec0'],
+                    ['lec1', 'UT lec1'],
+                ],
+                stage_template=[dict(
+                    name='stage%d' % i, version=0,
+                    title='UT stage %s' % i,
+                    material_tags=[],
+                    setting_spec=setting_spec,
+                ) for i, setting_spec in enumerate(setting_specs)],
+            ))
+
+        def lineage():
+            """(stage path, version, latest stage version) for each stage"""
+            return [tuple(r) for r in DBSession.execute("""
+                SELECT sy.path || st.stage_name, sl.version, lst.version
+                  FROM stage_lineage sl
+                  JOIN stage st ON st.stage_id = sl.stage_id
+                  JOIN syllabus sy ON sy.syllabus_id = st.syllabus_id
+                  JOIN stage lst ON lst.stage_id = sl.latest_stage_id
+                 ORDER BY 1, 2
+            """)]
+
+        import_stages({}, {})
+        self.assertEqual(lineage(), [
+            ('ut.lec_import.0.lec0.stage0', 1, 1),
+            ('ut.lec_import.0.lec0.stage1', 1, 1),
+            ('ut.lec_import.0.lec1.stage0', 1, 1),
+            ('ut.lec_import.0.lec1.stage1', 1, 1),
+        ])
+
+        # Changing stage0 adds a version, older versions point at the new one
+        import_stages(dict(hist_sel=dict(value=0.5)), {})
+        import_stages(dict(hist_sel=dict(value=0.8)), {})
+        self.assertEqual(lineage(), [
+            ('ut.lec_import.0.lec0.stage0', 1, 3),
+            ('ut.lec_import.0.lec0.stage0', 2, 3),
+            ('ut.lec_import.0.lec0.stage0', 3, 3),
+            ('ut.lec_import.0.lec0.stage1', 1, 1),
+            ('ut.lec_import.0.lec1.stage0', 1, 3),
+            ('ut.lec_import.0.lec1.stage0', 2, 3),
+            ('ut.lec_import.0.lec1.stage0', 3, 3),
+            ('ut.lec_import.0.lec1.stage1', 1, 1),
+        ])
+
+        # Matches walking the next_stage_id chain
+        self.assertEqual([tuple(r) for r in DBSession.execute("""
+            WITH RECURSIVE walk(v, stage_id, latest_stage_id) AS (
+                SELECT 0, stage_id, stage_id FROM stage WHERE next_stage_id IS NULL
+                 UNION ALL
+                SELECT walk.v + 1, stage.stage_id, walk.latest_stage_id FROM stage, walk WHERE stage.next_stage_id = walk.stage_id
+            )
+            SELECT stage_id, latest_stage_id, COUNT(*) OVER (PARTITION BY latest_stage_id)::INT - v FROM walk ORDER BY stage_id
+        """)], [tuple(r) for r in DBSession.execute("""
+            SELECT stage_id, latest_stage_id, version FROM stage_lineage ORDER BY stage_id
+        """)])
@@ -0,0 +1,122 @@
+import unittest
+
+from .requires_postgresql import RequiresPostgresql
+from .requires_pyramid import RequiresPyramid
+from .requires_materialbank import RequiresMaterialBank
+
+from tutorweb_quizdb.stage.iaa import answer_queue_grades
+from tutorweb_quizdb.syllabus.regrade import regrade
+
+
+class RegradeTest(RequiresPyramid, RequiresMaterialBank, RequiresPostgresql, unittest.TestCase):
+    def test_call(self):
+        from tutorweb_quizdb import DBSession
+        from tutorweb_quizdb.stage.setting import getStudentSettings
+
+        self.mb_write_example('example1.q.R', ('math099', 'Q-0990t0', 'lec050500'), 3)
+        self.mb_write_example('example2.q.R', ('math099', 'Q-0990t0', 'lec050500'), 2)
+        self.mb_update()
+        db_stages = self.create_stages(3, lec_parent='ut.regrade', material_tags_fn=lambda i: ['type.question', 'lec050500'], stage_setting_spec_fn=lambda i: [
+            dict(grade_s=dict(min=1, max=4)),
+            dict(grade_algorithm=dict(value='scorrect'), grade_s=dict(value=3)),
+            dict(grade_algorithm=dict(value='ratiocorrect')),
+        ][i])
+        db_other_stages = self.create_stages(1, lec_parent='ut.other')
+        db_studs = self.create_students(2)
+        for db_stud, grade_s in zip(db_studs, ['1', '4']):
+            DBSession.execute(
+                "INSERT INTO user_stage_setting (stage_id, user_id, settings) VALUES (:stage_id, :user_id, CAST(:settings AS JSONB))",
+                dict(stage_id=db_stages[0].stage_id, user_id=db_stud.user_id, settings='{"grade_s": "%s"}' % grade_s),
+            )
+        user_settings = dict(((st.stage_id, stud.user_id), getStudentSettings(st, stud)) for st in db_stages for stud in db_studs)
+        (mss_id,) = DBSession.execute("SELECT material_source_id FROM material_source WHERE path = 'example1.q.R'").fetchone()
+
+        def add_answers(db_stage, db_stud, correct, grades=None, settings=None):
+            if grades is None:
+                grades = answer_queue_grades(
+                    [float('nan') if c is None else float(c) for c in correct],
+                    settings or user_settings[(db_stage.stage_id, db_stud.user_id)],
+                    5,
+                ).tolist()
+            for c, g in zip(correct, grades):
+                DBSession.execute(
+                    "INSERT INTO answer (stage_id, user_id, material_source_id, permutation, client_id, time_end, correct, grade)"
+                    " VALUES (:stage_id, :user_id, :mss_id, 1, '01',"
+                    "         NOW() + (SELECT COUNT(*) FROM answer) * INTERVAL '1 second', :correct, :grade)",
+                    dict(stage_id=db_stage.stage_id, user_id=db_stud.user_id, mss_id=mss_id, correct=c, grade=g),
+                )
+            return grades
+
+        def stored_grades(db_stage, db_stud):
+            return [float(r[0]) for r in DBSession.execute(
+                "SELECT grade FROM answer WHERE stage_id = :stage_id AND user_id = :user_id ORDER BY time_end",
+                dict(stage_id=db_stage.stage_id, user_id=db_stud.user_id),
+            )]
+
+        def progress(db_stage, db_stud):
+            return tuple(float(x) for x in DBSession.execute(
+                "SELECT usp.latest_grade, usp.max_grade FROM user_stage_progress usp, stage st"
+                " WHERE usp.syllabus_id = st.syllabus_id AND usp.stage_name = st.stage_name"
+                "   AND st.stage_id = :stage_id AND usp.user_id = :user_id",
+                dict(stage_id=db_stage.stage_id, user_id=db_stud.user_id),
+            ).fetchone())
+
+        # Correct grades, with settings the students were given
+        queue = [True, True, False, None, True, False, True, True, True, False, True]
+        good_grades = {}
+        for db_stage in db_stages:
+            for db_stud in db_studs:
+                good_grades[(db_stage.stage_id, db_stud.user_id)] = add_answers(db_stage, db_stud, queue)
+        add_answers(db_other_stages[0], db_studs[0], [True, True], [9, 9])
+        summary = {}
+        self.assertEqual(list(regrade('ut.regrade', summary=summary)), [])
+        self.assertEqual((summary['answers'], summary['queues'], summary['discrepancies']), (66, 6, 0))
+
+        # Students have different weightings, so different grades
+        self.assertNotEqual(
+            good_grades[(db_stages[0].stage_id, db_studs[0].user_id)],
+            good_grades[(db_stages[0].stage_id, db_studs[1].user_id)],
+        )
+
+        # Corrupt some grades, we find them
+        DBSession.execute(
+            "UPDATE answer SET grade = 9.5 WHERE stage_id = :stage_id AND user_id = :user_id AND time_end = ("
+            " SELECT MAX(time_end) FROM answer WHERE stage_id = :stage_id AND user_id = :user_id)",
+            dict(stage_id=db_stages[0].stage_id, user_id=db_studs[1].user_id),
+        )
+        DBSession.execute(
+            "UPDATE user_stage_progress SET latest_grade = 9.5, max_grade = 9.5"
+            " WHERE user_id = :user_id AND syllabus_id = :syllabus_id AND stage_name = 'stage0'",
+            dict(syllabus_id=db_stages[0].syllabus_id, user_id=db_studs[1].user_id),
+        )
+        DBSession.execute(
+            "UPDATE answer SET grade = 0 WHERE stage_id = :stage_id AND user_id = :user_id",
+            dict(stage_id=db_stages[1].stage_id, user_id=db_studs[0].user_id),
+        )
+        out = list(regrade('ut.regrade'))
+        expected = [(str(db_stages[1].syllabus.path), 'stage1', db_studs[0].user_name, 0.0, g) for g in good_grades[(db_stages[1].stage_id, db_studs[0].user_id)] if g > 0]
+        expected.append((str(db_stages[0].syllabus.path), 'stage0', db_studs[1].user_name, 9.5, good_grades[(db_stages[0].stage_id, db_studs[1].user_id)][-1]))
+        self.assertEqual([(r[1], r[2], r[3], r[5], r[6]) for r in out], expected)
+        self.assertEqual([(r[1], r[2], r[3], r[5], r[6]) for r in regrade('ut.other')], [
+            (str(db_other_stages[0].syllabus.path), 'stage0', db_studs[0].user_name, 9.0, g)
+            for g in answer_queue_grades([1, 1], {}).tolist()
+        ])
+
+        # Update them, grades & user_stage_progress get fixed
+        self.assertEqual(progress(db_stages[0], db_studs[1]), (9.5, 9.5))
+        self.assertEqual(len(list(regrade('ut.regrade', update=True))), len(out))
+        self.assertEqual(list(regrade('ut.regrade')), [])
+        self.assertEqual(stored_grades(db_stages[0], db_studs[1]), good_grades[(db_stages[0].stage_id, db_studs[1].user_id)])
+        self.assertEqual(stored_grades(db_stages[1], db_studs[0]), good_grades[(db_stages[1].stage_id, db_studs[0].user_id)])
+        self.assertEqual(progress(db_stages[0], db_studs[1]), (
+            good_grades[(db_stages[0].stage_id, db_studs[1].user_id)][-1],
+            max(good_grades[(db_stages[0].stage_id, db_studs[1].user_id)]),
+        ))
+
+        # Answers in a new version of a stage are graded with it's settings, but the whole queue is considered
+        new_stage = self.upgrade_stage(db_stages[1], dict(grade_s=dict(value=10)))
+        add_answers(new_stage, db_studs[0], [True], [8.0])
+        add_answers(new_stage, db_studs[1], [True], [0.1])
+        self.assertEqual([(r[3], r[5], r[6]) for r in regrade('ut.regrade')], [
+            (db_studs[1].user_name, 0.1, 8.0),  # i.e. (7 + 1) / 10
+        ])
@@ -86,6 +86,7 @@ def main(global_config, **settings):
         config.include('tutorweb_quizdb.lti')
     with config.route_prefix_context('api'):
         config.include('tutorweb_quizdb.coin')
+        config.include('tutorweb_quizdb.columnar_renderer')
         config.include('tutorweb_quizdb.csv_renderer')
         config.include('tutorweb_quizdb.logerror')
         config.include('tutorweb_quizdb.material')
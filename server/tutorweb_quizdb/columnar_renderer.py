@@ -0,0 +1,90 @@
+import gzip
+import zlib
+
+from pyramid.interfaces import IRendererFactory
+from pyramid.renderers import JSON
+
+# Clients that want lists of objects packed into columns should put this in their Accept header
+COLUMNAR_CONTENT_TYPE = 'application/vnd.tutorweb.columnar+json'
+
+# Don't bother compressing anything smaller than this
+COMPRESS_MIN_SIZE = 1024
+
+CONTAINERS = (dict, list, tuple)
+
+
+def pack_columns(value):
+    """
+    Pack any list of objects that all have the same keys into columns, i.e.
+    [{a: 1, b: 2}, {a: 3, b: 4}] becomes {_columns: [a, b], _values: [[1, 3], [2, 4]]}
+    """
+    if isinstance(value, dict):
+        return {k: pack_columns(v) if isinstance(v, CONTAINERS) else v for k, v in value.items()}
+    if not isinstance(value, (list, tuple)):
+        return value
+
+    if len(value) == 0 or not isinstance(value[0], dict) or len(value[0]) == 0:
+        return [pack_columns(x) if isinstance(x, CONTAINERS) else x for x in value]
+    keys = value[0].keys()
+    if any(not isinstance(x, dict) or x.keys() != keys for x in value):
+        return [pack_columns(x) if isinstance(x, CONTAINERS) else x for x in value]
+    columns = list(keys)
+    return dict(
+        _columns=columns,
+        _values=[[
+            pack_columns(x[k]) if isinstance(x[k], CONTAINERS) else x[k] for x in value
+        ] for k in columns],
+    )
+
+
+def compress(body, encoding):
+    """Compress (body) with Content-Encoding (encoding)"""
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    if encoding == 'deflate':
+        return zlib.compress(body, 6)
+    raise ValueError("Unknown encoding %s" % encoding)
+
+
+class ColumnarRenderer(object):
+    """
+    JSON renderer that, if the client asks for COLUMNAR_CONTENT_TYPE, packs
+    lists of objects with pack_columns and compresses the result according to
+    Accept-Encoding. Otherwise output is the same as the json renderer.
+    """
+    def __init__(self, info):
+        self.info = info
+
+    def __call__(self, value, system):
+        request = system.get('request')
+        json_renderer = self.json_renderer(request)
+
+        if request is None:
+            return json_renderer(value, system)
+        response = request.response
+        response.vary = tuple(response.vary or ()) + ('Accept', 'Accept-Encoding')
+
+        offers = request.accept.acceptable_offers(['application/json', COLUMNAR_CONTENT_TYPE])
+        if len(offers) == 0 or offers[0][0] != COLUMNAR_CONTENT_TYPE:
+            return json_renderer(value, system)
+
+        body = json_renderer(pack_columns(value), system).encode('utf8')
+        response.content_type = COLUMNAR_CONTENT_TYPE
+        if len(body) >= COMPRESS_MIN_SIZE and request.headers.get('Accept-Encoding', None):
+            # NB: No Accept-Encoding header technically means anything goes, but don't take it literally
+            offers = request.accept_encoding.acceptable_offers(['gzip', 'deflate'])
+            if len(offers) > 0:
+                body = compress(body, offers[0][0])
+                response.content_encoding = offers[0][0]
+        return body
+
+    def json_renderer(self, request):
+        """Use the app's json renderer if we can, so we get all it's adapters"""
+        factory = None
+        if request is not None:
+            factory = request.registry.queryUtility(IRendererFactory, name='json')
+        return (factory or JSON())(self.info)
+
+
+def includeme(config):
+    config.add_renderer('columnar', 'tutorweb_quizdb.columnar_renderer.ColumnarRenderer')
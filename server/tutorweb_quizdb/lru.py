@@ -0,0 +1,47 @@
+import collections
+import threading
+
+
+class LRUCache():
+    """
+    Thread-safe dict-like cache that forgets the least-recently used entries
+    once it has more than (maxsize), counting hits & misses as it goes.
+
+    Unlike functools.lru_cache, entries can be looked up without computing
+    them, so callers can fetch everything that's missing in one go.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        """Return dict of counters, for logging / monitoring"""
+        return dict(hits=self.hits, misses=self.misses, size=len(self._data), maxsize=self.maxsize)
@@ -2,6 +2,7 @@ import decimal
 import logging
 import time
 
+import transaction
 from lti import ToolConfig, ToolProvider, OutcomeRequest
 from oauthlib.oauth1 import RequestValidator
 from pyramid.httpexceptions import HTTPForbidden, HTTPFound
@@ -134,7 +135,11 @@ def sso(request):
 
 
 def lti_replace_grade(stage, user, grade):
-    """For given stage/user combo, try and update their grade in any LTI"""
+    """
+    For given stage/user combo, try and update their grade in any LTI, once
+    the current transaction commits. The consumer may be slow to respond,
+    and we shouldn't hold any locks (e.g. on answer_stats rows) whilst we wait
+    """
     # Find any associated LTI with this stage/student
     sourcedid = DBSession.query(Base.classes.lti_sourcedid).filter_by(
         stage=stage,
@@ -146,23 +151,51 @@ def lti_replace_grade(stage, user, grade):
     if sourcedid.last_perc is not None and grade_perc == sourcedid.last_perc:
         return  # Hasn't changed since last time
 
-    # Post data to consumer
-    outcome_resp = OutcomeRequest(opts=dict(
-        consumer_key=sourcedid.client_key,
-        consumer_secret=request_validator.get_client_secret(sourcedid.client_key, None),
-        lis_outcome_service_url=sourcedid.lis_outcome_service_url,
-        lis_result_sourcedid=sourcedid.lis_result_sourcedid,
-    )).post_replace_result(grade_perc)
+    transaction.get().addAfterCommitHook(lti_post_grade, kws=dict(
+        bind=DBSession.get_bind(),
+        user_id=sourcedid.user_id,
+        stage_id=sourcedid.stage_id,
+        opts=dict(
+            consumer_key=sourcedid.client_key,
+            consumer_secret=request_validator.get_client_secret(sourcedid.client_key, None),
+            lis_outcome_service_url=sourcedid.lis_outcome_service_url,
+            lis_result_sourcedid=sourcedid.lis_result_sourcedid,
+        ),
+        grade_perc=grade_perc,
+    ))
+
+
+def lti_post_grade(success, bind, user_id, stage_id, opts, grade_perc):
+    """
+    After-commit hook for lti_replace_grade, post data to consumer & record
+    the outcome. Nothing is retried here, but last_perc is only updated once
+    the consumer accepts a grade, so an unposted grade is sent again the next
+    time the student syncs the stage
+    """
+    if not success:
+        return
+    try:
+        outcome_resp = OutcomeRequest(opts=opts).post_replace_result(grade_perc)
+        # NB: outcome_resp.description is a lxml.objectify.StringElement, which sqlalchemy can't encode
+        error = None if outcome_resp.is_success() else str(outcome_resp.description)
+    except Exception as e:
+        error = "%s: %s" % (e.__class__.__name__, e)
 
     # Report success / failure
-    if outcome_resp.is_success():
-        sourcedid.last_perc = grade_perc
-        sourcedid.last_error = None
+    if error is None:
+        values = dict(last_perc=grade_perc, last_error=None)
     else:
-        logger.warning("Couldn't write back results to LTI: %s" % outcome_resp.description)
-        # NB: outcome_resp.description is a lxml.objectify.StringElement, which sqlalchemy can't encode
-        sourcedid.last_error = str(outcome_resp.description)
-    DBSession.flush()
+        logger.warning("Couldn't write back grade %s for user %d, stage %d to LTI: %s" % (grade_perc, user_id, stage_id, error))
+        values = dict(last_error=error)
+    # NB: Our transaction has finished, so record it in one of our own
+    lti_sourcedid = Base.classes.lti_sourcedid.__table__
+    try:
+        with bind.begin() as conn:
+            conn.execute(lti_sourcedid.update().where(
+                (lti_sourcedid.c.user_id == user_id) & (lti_sourcedid.c.stage_id == stage_id)
+            ).values(**values))
+    except Exception:
+        logger.exception("Couldn't record LTI outcome for user %d, stage %d (grade %s, error %s)" % (user_id, stage_id, grade_perc, error))
 
 
 def view_tool_config(request):
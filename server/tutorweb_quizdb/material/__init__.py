@@ -1,3 +1,4 @@
 def includeme(config):
     config.include('tutorweb_quizdb.material.render')
+    config.include('tutorweb_quizdb.material.renderer.r')
     config.include('tutorweb_quizdb.material.update')
@@ -1,18 +1,37 @@
+import concurrent.futures
+import copy
+import hashlib
 import html
 import logging
 import json
+import types
 
 from pyramid.httpexceptions import HTTPForbidden
+from pyramid.settings import asbool
+from zope.sqlalchemy import mark_changed
 
+from tutorweb_quizdb.lru import LRUCache
 from tutorweb_quizdb.student import get_group
 from tutorweb_quizdb import DBSession, Base
 from .renderer.usergenerated import ug_render
+from .renderer import r as r_renderer
 from .renderer.r import r_render
 from .utils import material_bank_open
 
 
 logger = logging.getLogger(__package__)
 
+RENDER_CACHE_SIZE = 4096
+RENDER_CACHE = LRUCache(RENDER_CACHE_SIZE)
+
+CONFIG = dict(
+    persistent_cache=True,  # Also store rendered output in material_render_cache
+)
+STATS = dict(
+    db_hits=0,
+    renders=0,
+)
+
 
 class MissingDataException(Exception):
     status_code = 400
@@ -30,9 +49,9 @@ def dataframe_template(material_bank, path):
         return json.load(f)
 
 
-def material_render(ms, permutation, student_dataframes={}):
+def material_render(ms, permutation, student_dataframes={}, dataframe_digest=None):
     """
-    Render a question
+    Render a question. (dataframe_digest) is student_dataframes_digest(student_dataframes), if already known
     """
     # If we don't have everything we need, bleat.
     missing = [x for x in ms.dataframe_paths if x not in student_dataframes]
@@ -52,7 +71,7 @@ def material_render(ms, permutation, student_dataframes={}):
             # For templates, permutations < 0 are user-generated material
             out = ug_render(ms, permutation, student_dataframes)
         elif ms.path.endswith('.R'):
-            out = r_render(ms, permutation, student_dataframes)
+            out = r_render(ms, permutation, student_dataframes, dataframe_digest)
         else:
             raise ValueError("Don't know how to render %s" % ms.path)
     except Exception as e:
@@ -72,6 +91,196 @@ def material_render(ms, permutation, student_dataframes={}):
     return out
 
 
+def dataframe_digest(ms, student_dataframes):
+    """Digest of the student dataframes (ms) uses, '' if it doesn't use any"""
+    if len(ms.dataframe_paths) == 0:
+        return ''
+    return hashlib.sha256(json.dumps(
+        [student_dataframes[x] for x in ms.dataframe_paths],
+        sort_keys=True,
+    ).encode('utf8')).hexdigest()
+
+
+def student_dataframes_digest(student_dataframes):
+    """Digest of all of (student_dataframes), i.e. everything R questions are given"""
+    return hashlib.sha256(json.dumps(student_dataframes, sort_keys=True).encode('utf8')).hexdigest()
+
+
+def render_cache_key(ms, permutation, student_dataframes={}, digest=None):
+    """
+    Key for caching material_render output for (ms), or None if it shouldn't be.
+    Output depends on the material source, permutation and the student
+    dataframes the material uses, so they make up the key. (digest) is
+    dataframe_digest(ms, student_dataframes), if already known
+    """
+    if not getattr(ms, 'material_source_id', None) or not getattr(ms, 'render_cache', True):
+        # Not a material source from the DB, or it's opted out with TW:RENDERCACHE=false
+        return None
+    if permutation < 0 or any(x not in student_dataframes for x in ms.dataframe_paths):
+        # User-generated material comes from the DB, or we're about to raise MissingDataException
+        return None
+    return (ms.material_source_id, permutation, dataframe_digest(ms, student_dataframes) if digest is None else digest)
+
+
+def dataframe_digests(items):
+    """
+    dataframe_digest for each of a list of (ms, permutation, student_dataframes),
+    or None if dataframes are missing. Items in a batch generally share the
+    same student dataframes, so each is only digested once
+    """
+    digests = {}
+    out = []
+    for ms, permutation, student_dataframes in items:
+        if any(x not in student_dataframes for x in ms.dataframe_paths):
+            out.append(None)
+            continue
+        key = (id(student_dataframes), tuple(ms.dataframe_paths))
+        if key not in digests:
+            digests[key] = dataframe_digest(ms, student_dataframes)
+        out.append(digests[key])
+    return out
+
+
+def material_render_many(items):
+    """
+    Render a list of (ms, permutation, student_dataframes) tuples, returning
+    a list of material_render output.
+
+    Anything not in the in-process cache is fetched from material_render_cache
+    (if enabled) in one query, anything not there is rendered and stored in
+    one query. If we have R worker processes, R questions are rendered
+    concurrently, spread across them.
+    """
+    digests = dataframe_digests(items)
+    keys = [render_cache_key(*item, digest=digest) for item, digest in zip(items, digests)]
+    out = [None] * len(items)
+    for i, key in enumerate(keys):
+        if key is not None:
+            out[i] = RENDER_CACHE.get(key)
+
+    missing = set(key for key, o in zip(keys, out) if key is not None and o is None)
+    if CONFIG['persistent_cache'] and len(missing) > 0:
+        for mss_id, permutation, digest, cached in DBSession.execute("""
+            SELECT c.material_source_id, c.permutation, c.dataframe_digest, c.rendered
+              FROM material_render_cache c
+              JOIN UNNEST(CAST(:mss_ids AS INTEGER[]), CAST(:permutations AS INTEGER[]), CAST(:digests AS TEXT[]))
+                   k(material_source_id, permutation, dataframe_digest)
+                   USING (material_source_id, permutation, dataframe_digest)
+        """, dict(
+            mss_ids=[k[0] for k in missing],
+            permutations=[k[1] for k in missing],
+            digests=[k[2] for k in missing],
+        )):
+            RENDER_CACHE.put((mss_id, permutation, digest), cached)
+            STATS['db_hits'] += 1
+        for i, key in enumerate(keys):
+            if key in missing:
+                out[i] = RENDER_CACHE.get(key)
+
+    to_render = [i for i, o in enumerate(out) if o is None]
+    fresh = set(to_render)
+    # NB: Renderers get all of a student's dataframes, so need a digest of all of them, not just what ms uses
+    all_digests = {}
+    for i in to_render:
+        if id(items[i][2]) not in all_digests:
+            all_digests[id(items[i][2])] = student_dataframes_digest(items[i][2])
+    for i, o in zip(to_render, _material_render_many([items[i] + (all_digests[id(items[i][2])],) for i in to_render])):
+        out[i] = o
+        STATS['renders'] += 1
+    material_render_cache_put((keys[i], out[i]) for i in to_render)
+
+    # NB: Copy anything that came from the cache, so callers can't alter cached output
+    return [o if i in fresh else copy.deepcopy(o) for i, o in enumerate(out)]
+
+
+def material_render_cache_put(outputs):
+    """
+    Store list of (render_cache_key, material_render output) in the cache,
+    ignoring anything that shouldn't be cached
+    """
+    rendered = {}
+    for key, o in outputs:
+        if key is None or 'error' in o:
+            continue
+        try:
+            rendered[key] = json.dumps(o, allow_nan=False)
+        except ValueError:
+            continue  # NaN / Infinity can't be stored as JSONB, so don't cache it either
+        RENDER_CACHE.put(key, copy.deepcopy(o))
+
+    if CONFIG['persistent_cache'] and len(rendered) > 0:
+        DBSession.execute("""
+            INSERT INTO material_render_cache (material_source_id, permutation, dataframe_digest, rendered)
+                 SELECT UNNEST(CAST(:mss_ids AS INTEGER[])), UNNEST(CAST(:permutations AS INTEGER[])),
+                        UNNEST(CAST(:digests AS TEXT[])), CAST(UNNEST(CAST(:rendered AS TEXT[])) AS JSONB)
+            ON CONFLICT DO NOTHING
+        """, dict(
+            mss_ids=[k[0] for k in rendered.keys()],
+            permutations=[k[1] for k in rendered.keys()],
+            digests=[k[2] for k in rendered.keys()],
+            rendered=list(rendered.values()),
+        ))
+        mark_changed(DBSession())
+    return len(rendered)
+
+
+def material_render_cache_invalidate(material_source_ids):
+    """Forget cached output for (material_source_ids), e.g. since they have been superseded"""
+    if len(material_source_ids) == 0:
+        return
+    DBSession.execute(
+        "DELETE FROM material_render_cache WHERE material_source_id = ANY(:mss_ids)",
+        dict(mss_ids=list(material_source_ids)),
+    )
+    mark_changed(DBSession())
+    # NB: Superseded material sources won't be asked for again, so can age out of RENDER_CACHE
+
+
+def material_render_cache_info():
+    """Return dict of cache counters, for logging / monitoring"""
+    out = RENDER_CACHE.info()
+    out['db_hits'] = STATS['db_hits']
+    out['renders'] = STATS['renders']
+    return out
+
+
+def detached_ms(ms):
+    """
+    Copy of everything material_render needs from (ms), for rendering in
+    another thread. ORM objects belong to our thread's session, so other
+    threads shouldn't touch them
+    """
+    return types.SimpleNamespace(
+        material_source_id=getattr(ms, 'material_source_id', None),
+        bank=ms.bank,
+        path=ms.path,
+        md5sum=getattr(ms, 'md5sum', None),
+        permutation_count=ms.permutation_count,
+        material_tags=list(ms.material_tags),
+        dataframe_paths=list(ms.dataframe_paths),
+        render_cache=getattr(ms, 'render_cache', True),
+    )
+
+
+def _material_render_many(items):
+    """material_render a list of (ms, permutation, student_dataframes, dataframe_digest), spreading R questions across R workers"""
+    pool = r_renderer.R_POOL
+    concurrent_i = [i for i, (ms, permutation, _, _) in enumerate(items) if ms.path.endswith('.R') and permutation >= 0]
+    if pool is None or len(concurrent_i) < 2:
+        return [material_render(*item) for item in items]
+
+    out = [None] * len(items)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(pool.processes, len(concurrent_i))) as executor:
+        futures = dict((i, executor.submit(material_render, detached_ms(items[i][0]), *items[i][1:])) for i in concurrent_i)
+        # NB: Render anything else in this thread, e.g. ug_render needs our DB session
+        for i, item in enumerate(items):
+            if i not in futures:
+                out[i] = material_render(*item)
+        for i, f in futures.items():
+            out[i] = f.result()
+    return out
+
+
 def view_material_render(request):
     from tutorweb_quizdb.material.utils import file_md5sum, path_to_materialsource
     import os.path
@@ -109,6 +318,7 @@ def view_material_render(request):
 
 
 def includeme(config):
+    CONFIG['persistent_cache'] = asbool(config.registry.settings.get('tutorweb.material.render_persistent_cache', True))
     config.add_view(view_material_render, route_name='view_material_render', renderer='json')
     config.add_route('view_material_render', '/material/render')
 
@@ -1,6 +1,13 @@
+import hashlib
 import json
+import multiprocessing
 import os
+import pickle
+import queue
+import resource
 import threading
+import time
+import types
 import warnings
 
 import rpy2.rinterface
@@ -8,9 +15,58 @@ import rpy2.robjects as robjects
 from rpy2.rinterface import RRuntimeWarning
 from rpy2.robjects.packages import importr
 
-R_INTERPRETER_LOCK = threading.Lock()
+from tutorweb_quizdb.lru import LRUCache
+from tutorweb_quizdb.material.utils import file_md5sum
+
+R_INTERPRETER_LOCK = threading.RLock()
 jsonlite = importr("jsonlite")
 
+# R environments with question scripts sourced into them, see question_env
+R_ENV_CACHE_SIZE = 256
+R_ENV_CACHE = LRUCache(R_ENV_CACHE_SIZE)
+R_SOURCE_QUESTION = None
+R_COPY_ENV = None
+
+# Student dataframes converted into R objects, see r_dataframes
+R_DATAFRAME_CACHE_SIZE = 64
+R_DATAFRAME_CACHE = LRUCache(R_DATAFRAME_CACHE_SIZE)
+
+CONFIG = dict(
+    processes=os.cpu_count() or 1,  # Number of R worker processes to render with, 0 renders in this process without any timeout
+    max_renders=1000,  # Restart a worker after it has rendered this many questions
+    max_memory=0,  # Restart a worker once it's peak RSS reaches this many MiB, 0 for no limit
+    timeout=30.0,  # Seconds a render can take before it's worker is killed
+    queue_timeout=0.0,  # Seconds to wait for R to be free before giving up, 0 to wait forever
+    max_queue=0,  # Renders that can be waiting for R before we start refusing, 0 for no limit
+    breaker_failures=3,  # Timeouts in a row before we stop trying to render a question
+    breaker_reset=600.0,  # Seconds to stop trying for, before we try once again
+)
+STATS = dict(
+    renders=0,
+    render_time=0.0,
+    timeouts=0,
+    busy=0,  # Renders refused because R was busy
+    quarantined=0,  # Renders refused by the circuit breaker
+    waiting=0,  # Renders currently waiting for R
+    max_waiting=0,
+    wait_time=0.0,
+)
+STATS_LOCK = threading.Lock()
+BREAKER = {}  # (bank, path, md5sum) -> (timeouts in a row, time to try again)
+R_POOL = None
+
+
+class RenderTimeoutException(Exception):
+    pass
+
+
+class RenderBusyException(Exception):
+    pass
+
+
+class RenderQuarantinedException(Exception):
+    pass
+
 
 def rob_to_dict(a):
     """
@@ -37,20 +93,76 @@ def rob_to_dict(a):
             for x in a]
 
 
-def r_render(ms, permutation, student_dataframes={}):
-    """Execute R script to generate content"""
-    # TODO: Caching of question objects?
+def question_env(ms):
+    """
+    Return an R environment with the script for (ms) sourced into it. Sourced
+    scripts are kept in R_ENV_CACHE, keyed by path & md5sum, so repeat renders
+    don't need to read, parse & run the script again. Each call gets a fresh
+    copy, so anything a render changes (e.g. with <<-) doesn't affect the next.
+    Call with R_INTERPRETER_LOCK held, and the working directory set to the script's
+    """
+    global R_SOURCE_QUESTION, R_COPY_ENV
+
+    path = os.path.join(ms.bank, ms.path)
+    key = (path, getattr(ms, 'md5sum', None) or file_md5sum(path))
+    env = R_ENV_CACHE.get(key)
+    if env is None:
+        if R_SOURCE_QUESTION is None:
+            R_SOURCE_QUESTION = robjects.r('''function (path) {
+                env <- new.env(parent = globalenv())
+                assign("question", function () stop("R question script did not define a question function"), envir = env)
+                source(path, local = env)
+                env
+            }''')
+        env = R_SOURCE_QUESTION(path)
+        R_ENV_CACHE.put(key, env)
+
+    if R_COPY_ENV is None:
+        # NB: A child environment isn't enough, <<- would still find & alter the parent's variables
+        R_COPY_ENV = robjects.r('''function (env) {
+            out <- new.env(parent = parent.env(env))
+            for (n in ls(env, all.names = TRUE)) {
+                val <- get(n, envir = env)
+                if (is.function(val) && identical(environment(val), env)) {
+                    # Functions the script defined should see the copy, not the original
+                    environment(val) <- out
+                }
+                assign(n, val, envir = out)
+            }
+            out
+        }''')
+    return R_COPY_ENV(env)
+
+
+def r_dataframes(student_dataframes, digest=None):
+    """
+    Convert (student_dataframes) into an R list. Every question in a student's
+    batch gets the same dataframes, so conversions are kept in
+    R_DATAFRAME_CACHE, keyed by (digest) of the dataframes.
+    material_render_many works out the digest once per batch, if not
+    supplied we work it out. Call with R_INTERPRETER_LOCK held
+    """
+    if digest is None:
+        # NB: Same as student_dataframes_digest in tutorweb_quizdb.material.render
+        digest = hashlib.sha256(json.dumps(student_dataframes, sort_keys=True).encode('utf8')).hexdigest()
+    key = digest
+    out = R_DATAFRAME_CACHE.get(key)
+    if out is None:
+        out = jsonlite.fromJSON(json.dumps(student_dataframes))
+        R_DATAFRAME_CACHE.put(key, out)
+    return out
+
+
+def r_render_local(ms, permutation, student_dataframes={}, dataframe_digest=None):
+    """Execute R script to generate content, in this process"""
     with R_INTERPRETER_LOCK:
         try:
             old_wd = os.getcwd()
-            robjects.r('''question <- function () stop("R question script did not define a question function")''')
             robjects.r('''setwd''')(os.path.dirname(os.path.join(ms.bank, ms.path)))
-            robjects.r('''source''')(os.path.join(ms.bank, ms.path))
-            r_student_dataframes = jsonlite.fromJSON(
-                json.dumps(student_dataframes),
-            )
+            env = question_env(ms)
+            r_student_dataframes = r_dataframes(student_dataframes, dataframe_digest)
             warnings.filterwarnings("ignore", category=RRuntimeWarning)
-            rob = robjects.globalenv['question'](permutation, r_student_dataframes)
+            rob = env['question'](permutation, r_student_dataframes)
             # TODO: Stacktraces?
             try:
                 rv = rob_to_dict(rob)
@@ -63,3 +175,264 @@ def r_render(ms, permutation, student_dataframes={}):
             return rv
         finally:
             os.chdir(old_wd)
+
+
+def _worker_main(conn):
+    """Main loop of an R worker process, render each request that arrives on (conn)"""
+    global R_INTERPRETER_LOCK
+
+    # We were forked whilst our parent held the lock, we need our own
+    R_INTERPRETER_LOCK = threading.Lock()
+    while True:
+        try:
+            ms, permutation, student_dataframes, dataframe_digest = conn.recv()
+        except EOFError:
+            return
+        try:
+            out = ('ok', r_render_local(ms, permutation, student_dataframes, dataframe_digest))
+        except Exception as e:
+            try:
+                # Make sure the exception will survive the trip to the parent
+                pickle.loads(pickle.dumps(e))
+                out = ('error', e)
+            except Exception:
+                out = ('error_str', (e.__class__.__name__, str(e)))
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        try:
+            conn.send(out + (max_rss,))
+        except Exception:
+            conn.send(('error_str', ('ValueError', "R question output not picklable %s" % ms.path), max_rss))
+
+
+class RWorker():
+    """A separate process with it's own R interpreter, rendering questions sent to it"""
+    def __init__(self):
+        # NB: Don't fork whilst this process is half-way through rendering, or
+        #     whilst another worker's end of the pipe is open, or it wont notice the worker die
+        with R_INTERPRETER_LOCK:
+            self.conn, child_conn = multiprocessing.Pipe()
+            self.process = multiprocessing.Process(target=_worker_main, args=(child_conn,), daemon=True)
+            self.process.start()
+            child_conn.close()
+        self.renders = 0
+        self.max_rss = 0
+
+    def render(self, ms, permutation, student_dataframes, dataframe_digest=None, timeout=None):
+        """
+        Render question in worker, raising any exception it raised. If it
+        takes longer than (timeout) seconds, kill the worker
+        """
+        self.conn.send((
+            # NB: Only send what rendering needs, not the DB object
+            types.SimpleNamespace(bank=ms.bank, path=ms.path, md5sum=getattr(ms, 'md5sum', None)),
+            permutation,
+            student_dataframes,
+            dataframe_digest,
+        ))
+        start = time.perf_counter()
+        try:
+            if timeout and not self.conn.poll(timeout):
+                self.close(kill=True)
+                raise RenderTimeoutException("R question %s took longer than %gs" % (ms.path, timeout))
+            status, out, self.max_rss = self.conn.recv()
+        finally:
+            count_render(start)
+        self.renders += 1
+        if status == 'error':
+            raise out
+        if status == 'error_str':
+            # Recreate an exception with the same name, so material_render reports it the same way
+            raise type(out[0], (Exception,), {})(out[1])
+        return out
+
+    def close(self, kill=False):
+        self.conn.close()
+        if not kill:
+            self.process.join(1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+
+
+class RWorkerPool():
+    """
+    Pool of (processes) RWorkers, started as they are needed. Each render
+    uses the next idle worker, waiting for one if all are busy, so renders
+    from separate threads happen concurrently.
+
+    Workers are restarted after (max_renders) renders, or when their peak
+    RSS reaches (max_memory) MiB, to stop R leaking memory indefinitely.
+    Workers taking longer than (timeout) seconds to render are killed.
+    """
+    def __init__(self, processes, max_renders=CONFIG['max_renders'], max_memory=CONFIG['max_memory'], timeout=CONFIG['timeout']):
+        self.processes = processes
+        self.max_renders = max_renders
+        self.max_memory = max_memory
+        self.timeout = timeout
+        self.idle = queue.LifoQueue()
+        for i in range(processes):
+            self.idle.put(None)  # i.e. a worker that hasn't been started yet
+
+    def render(self, ms, permutation, student_dataframes={}, dataframe_digest=None):
+        with wait_for_r(ms):
+            worker = self.idle.get(timeout=CONFIG['queue_timeout'] or None)
+        try:
+            if worker is None or not worker.process.is_alive():
+                worker = RWorker()
+            return worker.render(ms, permutation, student_dataframes, dataframe_digest, timeout=self.timeout)
+        except (RenderTimeoutException, EOFError, OSError):
+            # Worker killed / died, start another next time
+            if worker is not None:
+                worker.close(kill=True)
+            worker = None
+            raise
+        finally:
+            if worker is not None and self.should_recycle(worker):
+                worker.close()
+                worker = None
+            self.idle.put(worker)
+
+    def should_recycle(self, worker):
+        """Has (worker) done enough work to be restarted?"""
+        if worker.renders >= self.max_renders:
+            return True
+        return bool(self.max_memory) and worker.max_rss >= self.max_memory * 1024 * 1024
+
+    def close(self):
+        """Stop all workers"""
+        for i in range(self.processes):
+            worker = self.idle.get()
+            if worker is not None:
+                worker.close()
+
+
+class wait_for_r():
+    """
+    Context manager to wrap waiting for R to be free, refusing if too many
+    are already waiting, and counting how many wait & how long for.
+    queue.Empty (i.e. we waited too long) is turned into RenderBusyException
+    """
+    def __init__(self, ms):
+        self.ms = ms
+
+    def __enter__(self):
+        with STATS_LOCK:
+            if CONFIG['max_queue'] and STATS['waiting'] >= CONFIG['max_queue']:
+                STATS['busy'] += 1
+                raise RenderBusyException("Too many questions waiting to render, try again later")
+            STATS['waiting'] += 1
+            STATS['max_waiting'] = max(STATS['max_waiting'], STATS['waiting'])
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with STATS_LOCK:
+            STATS['waiting'] -= 1
+            STATS['wait_time'] += time.perf_counter() - self.start
+            if exc_type is queue.Empty:
+                STATS['busy'] += 1
+        if exc_type is queue.Empty:
+            raise RenderBusyException("Timed out waiting to render %s, try again later" % self.ms.path)
+
+
+def breaker_check(key):
+    """Raise RenderQuarantinedException if (key) has timed out too often recently"""
+    timeouts, retry_at = BREAKER.get(key, (0, 0))
+    if timeouts >= CONFIG['breaker_failures'] and time.time() < retry_at:
+        with STATS_LOCK:
+            STATS['quarantined'] += 1
+        raise RenderQuarantinedException("R question %s keeps timing out, not rendering until %s" % (
+            key[1],
+            time.strftime('%H:%M:%S', time.localtime(retry_at)),
+        ))
+
+
+def breaker_record(key, timed_out):
+    """Record a render of (key), if it (timed_out) enough times, quarantine it"""
+    if not timed_out:
+        BREAKER.pop(key, None)
+        return
+    with STATS_LOCK:
+        STATS['timeouts'] += 1
+        timeouts = BREAKER.get(key, (0, 0))[0] + 1
+        # NB: Once we have enough failures, one more failure will quarantine again
+        BREAKER[key] = (timeouts, time.time() + CONFIG['breaker_reset'])
+
+
+def r_render_info():
+    """Return dict of render counters, for logging / monitoring"""
+    with STATS_LOCK:
+        out = dict(STATS)
+    out['breaker_open'] = sorted(
+        path for (bank, path, md5sum), (timeouts, retry_at) in list(BREAKER.items())
+        if timeouts >= CONFIG['breaker_failures'] and time.time() < retry_at
+    )
+    return out
+
+
+def configure_pool(**kwargs):
+    """Update CONFIG, (re)create R_POOL to match, or render in-process if processes is 0"""
+    global R_POOL
+
+    for k, v in kwargs.items():
+        if v is not None:
+            CONFIG[k] = type(CONFIG[k])(v)
+    if R_POOL is not None:
+        R_POOL.close()
+    R_POOL = RWorkerPool(
+        CONFIG['processes'],
+        max_renders=CONFIG['max_renders'],
+        max_memory=CONFIG['max_memory'],
+        timeout=CONFIG['timeout'],
+    ) if CONFIG['processes'] > 0 else None
+    return R_POOL
+
+
+def count_render(start):
+    """Count a render that started at (start)"""
+    with STATS_LOCK:
+        STATS['renders'] += 1
+        STATS['render_time'] += time.perf_counter() - start
+
+
+def r_render(ms, permutation, student_dataframes={}, dataframe_digest=None):
+    """
+    Execute R script to generate content, using an R worker if configured.
+    Questions that keep timing out aren't tried again for a while, or until
+    their source changes.
+
+    The question gets all of the student's dataframes, (dataframe_digest) is
+    a digest of them from tutorweb_quizdb.material.render.student_dataframes_digest,
+    if known.
+
+    Without R workers, renders happen in this process. R can't be interrupted
+    there, so there is no timeout, only use this for development / testing
+    """
+    key = (ms.bank, ms.path, getattr(ms, 'md5sum', None))
+    breaker_check(key)
+
+    if R_POOL is None:
+        with wait_for_r(ms):
+            if not R_INTERPRETER_LOCK.acquire(timeout=CONFIG['queue_timeout'] or -1):
+                raise queue.Empty()
+        try:
+            start = time.perf_counter()
+            return r_render_local(ms, permutation, student_dataframes, dataframe_digest)
+        finally:
+            R_INTERPRETER_LOCK.release()
+            count_render(start)
+
+    try:
+        out = R_POOL.render(ms, permutation, student_dataframes, dataframe_digest)
+    except RenderTimeoutException:
+        breaker_record(key, timed_out=True)
+        raise
+    breaker_record(key, timed_out=False)
+    return out
+
+
+def includeme(config):
+    settings = config.registry.settings
+    configure_pool(**dict(
+        (k, settings.get('tutorweb.r_render.%s' % k, None))
+        for k in CONFIG.keys()
+    ))
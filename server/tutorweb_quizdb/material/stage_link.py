@@ -0,0 +1,69 @@
+import time
+
+from zope.sqlalchemy import mark_changed
+
+from tutorweb_quizdb import DBSession
+
+
+def refresh_stage_material():
+    """
+    Compare every stage against every material source, fixing anything in
+    stage_material_source_link (and so stage_material & stage_material_sources)
+    that doesn't match. Triggers on stage & material_source add links for
+    anything new, so this should only be needed if something's gone wrong.
+
+    Returns dict of row counts & time taken.
+    """
+    start = time.perf_counter()
+    out = dict(added=0, removed=0)
+
+    out['removed'] = DBSession.execute("""
+        DELETE FROM stage_material_source_link sml
+         USING stage s, material_source ms
+         WHERE s.stage_id = sml.stage_id
+           AND ms.material_source_id = sml.material_source_id
+           AND NOT (s.material_tags <@ ms.material_tags)
+    """).rowcount
+    out['added'] = DBSession.execute("""
+        INSERT INTO stage_material_source_link (stage_id, material_source_id)
+             SELECT s.stage_id, ms.material_source_id
+               FROM stage s
+               JOIN material_source ms
+                 ON s.material_tags <@ ms.material_tags
+        ON CONFLICT DO NOTHING
+    """).rowcount
+    out['stages'] = DBSession.execute("SELECT COUNT(*) FROM stage").scalar()
+    out['material_sources'] = DBSession.execute("SELECT COUNT(*) FROM material_source").scalar()
+    mark_changed(DBSession())
+
+    out['elapsed'] = time.perf_counter() - start
+    return out
+
+
+def count_stage_material(stage_ids=(), material_source_ids=()):
+    """
+    Count the stage_material_source_link rows triggers added for new stages
+    (stage_ids) & material sources (material_source_ids), so scripts can
+    report on them. Returns dict of row counts, as refresh_stage_material does.
+    """
+    return dict(
+        stages=len(stage_ids),
+        material_sources=len(material_source_ids),
+        added=DBSession.execute("""
+            SELECT COUNT(*)
+              FROM stage_material_source_link
+             WHERE stage_id = ANY(:stage_ids)
+                OR material_source_id = ANY(:material_source_ids)
+        """, dict(stage_ids=list(stage_ids), material_source_ids=list(material_source_ids))).scalar(),
+    )
+
+
+def script_stage_material_refresh():
+    from tutorweb_quizdb import setup_script
+
+    argparse_arguments = [
+        dict(description='Check every stage against all material, fixing stage_material'),
+    ]
+
+    with setup_script(argparse_arguments):
+        print("stage_material: %(stages)d stages, %(material_sources)d material sources, %(added)d links added, %(removed)d removed in %(elapsed).3fs" % refresh_stage_material())
@@ -1,8 +1,12 @@
+import concurrent.futures
 import os
+import time
 
 from tutorweb_quizdb import DBSession, Base
 
-from tutorweb_quizdb.material.render import material_render
+from tutorweb_quizdb.material.render import material_render, material_render_cache_invalidate, material_render_cache_put, render_cache_key, detached_ms
+from tutorweb_quizdb.material.renderer import r as r_renderer
+from tutorweb_quizdb.material.stage_link import count_stage_material
 from tutorweb_quizdb.material.utils import path_tags, file_md5sum, path_to_materialsource
 
 
@@ -19,6 +23,9 @@ def update(material_bank):
             if len(path_tags(f)) > 0:  # i.e. This file has a recognisable type, not just something to ignore
                 material_paths[os.path.normpath(os.path.join(os.path.relpath(root, material_bank), f))] = file_md5sum(os.path.join(root, f))
 
+    new_mss = []
+    superseded_ids = []
+
     # For all paths in the database...
     for m in DBSession.query(Base.classes.material_source).filter_by(bank=material_bank, next_material_source_id=None):
         if material_paths.get(m.path, None) != m.md5sum:
@@ -26,7 +33,9 @@ def update(material_bank):
             new_m = Base.classes.material_source(**path_to_materialsource(material_bank, m.path, m.revision), md5sum=material_paths.get(m.path, None))
             DBSession.add(new_m)
             DBSession.flush()
+            new_mss.append(new_m)
             m.next_material_source_id = new_m.material_source_id
+            superseded_ids.append(m.material_source_id)
             # Make sure this new item renders before we carry on
             if new_m.permutation_count > 0:
                 fake_data = dict((k, None) for k in new_m.dataframe_paths)
@@ -42,15 +51,63 @@ def update(material_bank):
     for path, md5sum in material_paths.items():
         new_m = Base.classes.material_source(**path_to_materialsource(material_bank, path, None), md5sum=md5sum)
         DBSession.add(new_m)
+        new_mss.append(new_m)
         # Make sure this new item renders before we carry on
         if new_m.permutation_count > 0:
             fake_data = dict((k, None) for k in new_m.dataframe_paths)
             print("%s: %s" % (new_m.path, material_render(new_m, 1, fake_data)))
     DBSession.flush()
 
+    # Output from old versions of material isn't needed any more
+    material_render_cache_invalidate(superseded_ids)
+    return new_mss
+
+
+def _timed_render(item):
+    start = time.perf_counter()
+    out = material_render(*item)
+    return out, time.perf_counter() - start
+
+
+def prewarm(mss):
+    """
+    Render every permutation of material sources (mss) and store them in the
+    render cache, so students don't wait for them. Renders are spread
+    across R workers, if configured. Material using student dataframes can't
+    be rendered ahead of time, and is skipped.
+
+    Yields a dict for each material source, with the number of permutations
+    rendered, failures & timings
+    """
+    workers = r_renderer.R_POOL.processes if r_renderer.R_POOL is not None else 1
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for ms in mss:
+            out = dict(path=ms.path, rendered=0, failed=[], elapsed=0.0, slowest=(None, 0.0), skipped=None)
+            if len(ms.dataframe_paths) > 0:
+                out['skipped'] = "uses student dataframes"
+            elif not ms.render_cache:
+                out['skipped'] = "TW:RENDERCACHE=false"
+            if out['skipped'] or ms.permutation_count < 1:
+                yield out
+                continue
+
+            # NB: Rendered in other threads, so give them a copy of ms rather than the ORM object
+            plain_ms = detached_ms(ms)
+            items = [(plain_ms, permutation, {}) for permutation in range(1, ms.permutation_count + 1)]
+            start = time.perf_counter()
+            rendered = list(executor.map(_timed_render, items))
+            out['elapsed'] = time.perf_counter() - start
+            for (_, permutation, _), (r, elapsed) in zip(items, rendered):
+                if 'error' in r:
+                    out['failed'].append((permutation, r['error']))
+                if elapsed > out['slowest'][1]:
+                    out['slowest'] = (permutation, elapsed)
+            out['rendered'] = material_render_cache_put((render_cache_key(*item), r) for item, (r, _) in zip(items, rendered))
+            yield out
+
 
 def view_material_update(request):
-    return update(
+    update(
         material_bank=request.registry.settings['tutorweb.material_bank.default'],
     )
 
@@ -64,9 +121,48 @@ def script_material_update():
 
     argparse_arguments = [
         dict(description='Update material bank database from file-system'),
+        dict(
+            name='--prewarm',
+            help='Render every permutation of new / changed material, storing it in the render cache',
+            action='store_true',
+            default=False,
+        ),
+        dict(
+            name='--processes',
+            help='Number of R processes to prewarm with, default one per CPU',
+            type=int,
+            default=None,
+        ),
     ]
 
     with setup_script(argparse_arguments) as env:
-        return update(
+        start = time.perf_counter()
+        new_mss = update(
             material_bank=env['request'].registry.settings['tutorweb.material_bank.default'],
         )
+        out = count_stage_material(material_source_ids=[m.material_source_id for m in new_mss])
+        out['elapsed'] = time.perf_counter() - start
+        print("material_update: %(material_sources)d new material sources, %(added)d stage_material links added in %(elapsed).3fs" % out)
+        if not env['args'].prewarm:
+            return
+
+        r_renderer.configure_pool(processes=env['args'].processes or os.cpu_count())
+        tm = env['request'].tm
+        try:
+            for out in prewarm(new_mss):
+                if out['skipped']:
+                    print("%s: Skipped, %s" % (out['path'], out['skipped']))
+                    continue
+                print("%s: %d permutations cached in %.2fs, slowest #%s in %.2fs%s" % (
+                    out['path'],
+                    out['rendered'],
+                    out['elapsed'],
+                    out['slowest'][0],
+                    out['slowest'][1],
+                    "".join(", #%d failed (%s)" % f for f in out['failed']),
+                ))
+                # Commit as we go, so an interruption doesn't lose everything
+                tm.commit()
+                tm.begin()
+        finally:
+            r_renderer.configure_pool(processes=0)
@@ -113,4 +113,5 @@ def path_to_materialsource(material_bank, path, prev_revision):
         dataframe_paths=list(parse_list(file_metadata.get('DATAFRAMES', ''))),
         initial_answered=int(file_metadata.get('TIMESANSWERED', 0)),
         initial_correct=int(file_metadata.get('TIMESCORRECT', 0)),
+        render_cache=file_metadata.get('RENDERCACHE', 'true').strip().lower() not in ('false', 'no', 'off', '0'),
     )
@@ -1,15 +1,110 @@
+import hashlib
 import html
 import io
 import re
+try:
+    import importlib.metadata as importlib_metadata
+except ImportError:  # Python < 3.8
+    import importlib_metadata
 
+import docutils
 from html5css3 import Writer as Html5Writer
 from docutils.core import publish_string
+from pyramid.settings import asbool
+from zope.sqlalchemy import mark_changed
+
+from tutorweb_quizdb import DBSession
+from tutorweb_quizdb.lru import LRUCache
 
 
 MESSAGE_TEMPLATE = '<div class="system-message %s"><div class="system-message-title">System message:</div>%s</div>'
 
+# Bump if to_rst_uncached output changes, so cached output isn't used
+RENDER_VERSION = '1:%s:%s' % (docutils.__version__, importlib_metadata.version('rst2html5-tools'))
+
+RST_CACHE_SIZE = 4096
+RST_CACHE = LRUCache(RST_CACHE_SIZE)
+
+CONFIG = dict(
+    persistent_cache=False,  # Also store rendered output in rst_render_cache
+)
+STATS = dict(
+    db_hits=0,
+    renders=0,
+    db_purged=False,
+)
+
 
 def to_rst(incoming):
+    """Convert RST -> HTML, using cached output if we can"""
+    return to_rst_many([incoming])[0]
+
+
+def to_rst_many(incomings):
+    """
+    Convert list of RST -> list of HTML. Anything not in the in-process cache
+    is fetched from rst_render_cache (if enabled) in one query, anything not
+    there is rendered and stored in one query.
+    """
+    out = {}
+    for incoming in incomings:
+        if incoming not in out:
+            cached = RST_CACHE.get(incoming)
+            if cached is not None:
+                out[incoming] = cached
+
+    missing = {render_digest(x): x for x in incomings if x not in out}
+    if len(missing) == 0:
+        return [out[x] for x in incomings]
+
+    if CONFIG['persistent_cache']:
+        if not STATS['db_purged']:
+            # First time we've looked, remove anything from previous renderer versions
+            DBSession.execute("DELETE FROM rst_render_cache WHERE version != :version", dict(version=RENDER_VERSION))
+            STATS['db_purged'] = True
+        for digest, cached in DBSession.execute(
+            "SELECT digest, html FROM rst_render_cache WHERE digest = ANY(:digests)",
+            dict(digests=list(missing.keys())),
+        ):
+            out[missing[digest]] = cached
+            STATS['db_hits'] += 1
+
+    rendered = {}
+    for digest, incoming in missing.items():
+        if incoming not in out:
+            out[incoming] = rendered[digest] = to_rst_uncached(incoming)
+            STATS['renders'] += 1
+    if CONFIG['persistent_cache'] and len(rendered) > 0:
+        DBSession.execute("""
+            INSERT INTO rst_render_cache (digest, version, html)
+                 SELECT UNNEST(:digests), :version, UNNEST(:htmls)
+            ON CONFLICT DO NOTHING
+        """, dict(
+            digests=list(rendered.keys()),
+            version=RENDER_VERSION,
+            htmls=list(rendered.values()),
+        ))
+        mark_changed(DBSession())
+
+    for incoming in missing.values():
+        RST_CACHE.put(incoming, out[incoming])
+    return [out[x] for x in incomings]
+
+
+def render_digest(incoming):
+    """Key for (incoming) in rst_render_cache"""
+    return hashlib.sha256((RENDER_VERSION + '\0' + incoming).encode('utf8')).hexdigest()
+
+
+def rst_cache_info():
+    """Return dict of cache counters, for logging / monitoring"""
+    out = RST_CACHE.info()
+    out['db_hits'] = STATS['db_hits']
+    out['renders'] = STATS['renders']
+    return out
+
+
+def to_rst_uncached(incoming):
     """Convert RST -> HTML"""
     warnings = io.StringIO()
     try:
@@ -36,14 +131,15 @@ def to_rst(incoming):
 
 
 def rst_render(request):
-    """Convert 'data' in request body to HTML fragment"""
+    """Convert 'data' in request body to HTML fragment, or a list of fragments if 'data' is a list"""
     incoming = request.json_body['data'] if request.body else ""
 
     return dict(
-        html=to_rst(incoming),
+        html=to_rst_many(incoming) if isinstance(incoming, list) else to_rst(incoming),
     )
 
 
 def includeme(config):
+    CONFIG['persistent_cache'] = asbool(config.registry.settings.get('tutorweb.rst.persistent_cache', False))
     config.add_view(rst_render, route_name='rst_render', renderer='json')
     config.add_route('rst_render', '/rst/render')
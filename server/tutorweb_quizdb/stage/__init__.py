@@ -1,5 +1,6 @@
 def includeme(config):
     config.include('tutorweb_quizdb.stage.dataframe')
+    config.include('tutorweb_quizdb.stage.iaa')
     config.include('tutorweb_quizdb.stage.index')
     config.include('tutorweb_quizdb.stage.material')
     config.include('tutorweb_quizdb.stage.ug_extensions')
@@ -1,13 +1,23 @@
 import base64
+import functools
 import random
 import struct
 
+import numpy as np
 from sqlalchemy import column, select, table, tuple_
+from zope.sqlalchemy import mark_changed
 
 import skippy
 
 from tutorweb_quizdb import DBSession
 
+# Bounds for the process-wide caches of ciphers (one per encryption key, i.e. student/stage) and public IDs
+CIPHER_CACHE_SIZE = 1024
+PUBLIC_ID_CACHE_SIZE = 65536
+
+# Spread of difficulty percentiles around the student's grade that OriginalAllocation favours
+DIFFICULTY_SPREAD = 0.2
+
 
 def get_allocation(settings, *args, **kwargs):
     name = settings.get('allocation_method', 'original')
@@ -21,6 +31,74 @@ def get_allocation(settings, *args, **kwargs):
         raise ValueError("Unknown allocation module %s" % name)
 
 
+@functools.lru_cache(maxsize=CIPHER_CACHE_SIZE)
+def get_cipher(encryption_key):
+    """Return a cipher for (encryption_key), shared between requests to avoid re-computing key schedules"""
+    return skippy.Skippy(encryption_key.encode('ascii'))
+
+
+@functools.lru_cache(maxsize=PUBLIC_ID_CACHE_SIZE)
+def encrypt_public_id(encryption_key, mss_id, permutation):
+    """Public ID for OriginalAllocation, see to_public_id"""
+    cipher = get_cipher(encryption_key)
+    return base64.b64encode(struct.pack(
+        'cII',
+        b'B' if permutation < 0 else b'A',
+        cipher.encrypt(mss_id),
+        cipher.encrypt(abs(permutation)),
+    )).decode('ascii')
+
+
+@functools.lru_cache(maxsize=PUBLIC_ID_CACHE_SIZE)
+def decrypt_public_id(encryption_key, public_id):
+    """Reverse of encrypt_public_id, see from_public_id"""
+    cipher = get_cipher(encryption_key)
+    public_id = base64.b64decode(public_id)
+    if len(public_id) < 9:
+        # Pre-version-char format
+        version_char = b'A'
+        mss_id, permutation = struct.unpack('II', public_id)
+    else:
+        version_char, mss_id, permutation = struct.unpack('cII', public_id)
+    mss_id = cipher.decrypt(mss_id)
+    permutation = cipher.decrypt(permutation)
+    if version_char == b'B':
+        permutation = 0 - permutation
+    return mss_id, permutation
+
+
+def difficulty_weights(percentile, grade):
+    """
+    Given an array of each item's difficulty percentile (0 = easiest,
+    1 = hardest), and a grade between 0 and 10, return an array of weights
+    that favour items whose difficulty is near the grade.
+    """
+    return np.exp(-((percentile - grade / 10) ** 2) / (2 * DIFFICULTY_SPREAD ** 2))
+
+
+def weighted_sample(weights, size, rng):
+    """
+    Return indices of (size) items, chosen without replacement with
+    probability proportional to (weights), using random numbers from (rng)
+    """
+    # Efraimidis & Spirakis: Choose items with the largest u^(1/w), i.e. log(u)/w
+    keys = np.log(rng.random(len(weights))) / weights
+    chosen = np.argpartition(keys, -size)[-size:]
+    return chosen[np.argsort(-keys[chosen], kind='stable')]
+
+
+def material_at_index(mss_ids, permutation_counts, indexes):
+    """
+    Given arrays of material source IDs and their permutation counts, return
+    the (mss_id, permutation) tuples at (indexes) within the list of all
+    permutations of all material, without generating that list
+    """
+    ends = np.cumsum(permutation_counts)
+    i = np.searchsorted(ends, indexes, side='right')
+    permutations = indexes - (ends[i] - permutation_counts[i]) + 1
+    return [(int(m), int(p)) for m, p in zip(mss_ids[i], permutations)]
+
+
 class BaseAllocation():
     def __init__(self, settings, db_stage, db_student):
         self.settings = settings
@@ -39,6 +117,13 @@ class BaseAllocation():
 
         return DBSession.execute(q).fetchall()
 
+    def update_bank(self):
+        """
+        Called after syncing the student's answer queue, store anything
+        get_material needs to return the same material until the next refresh
+        """
+        pass
+
     def to_public_id(self, mss_id, permutation):
         """
         Turn (mss_id, permutation) into a public question ID
@@ -51,6 +136,18 @@ class BaseAllocation():
         """
         return tuple(int(x) for x in public_id.split(":", 1))
 
+    def to_public_ids(self, items):
+        """
+        Turn a list of (mss_id, permutation) into a list of public question IDs
+        """
+        return [self.to_public_id(mss_id, permutation) for mss_id, permutation in items]
+
+    def from_public_ids(self, public_ids):
+        """
+        Turn a list of public IDs back into a list of (mss_id, permutation) tuples
+        """
+        return [self.from_public_id(x) for x in public_ids]
+
     def get_stats(self, public_ids):
         """
         Fetch the updated answered/correct stats for given public IDs
@@ -65,87 +162,253 @@ class BaseAllocation():
         q = q.where(tuple_(
             column('material_source_id'),
             column('permutation')
-        ).in_(self.from_public_id(x) for x in public_ids))
+        ).in_(self.from_public_ids(public_ids)))
 
         # Return stats, sorted by incoming public_ids
         stats = {}
-        for mss_id, permutation, answered, correct in DBSession.execute(q):
-            stats[self.to_public_id(mss_id, permutation)] = dict(
+        rows = DBSession.execute(q).fetchall()
+        for public_id, (mss_id, permutation, answered, correct) in zip(self.to_public_ids((r[0], r[1]) for r in rows), rows):
+            stats[public_id] = dict(
                 stage_answered=answered,
                 stage_correct=correct,
             )
         return [stats.get(x, dict(stage_answered=0, stage_correct=0)) for x in public_ids]
 
-    def should_refresh_questions(self, aq, old_aq):
+    def get_rendered(self, items):
+        """
+        Return a dict of (mss_id, permutation) -> material_render output for
+        any of (items) that have already been rendered for this student
+        """
+        return {}
+
+    def should_refresh_questions(self, aq_length, additions):
         """
         Has enough time passed between 2 answer queues that we should refresh
         the student's question bank?
+        - aq_length: Length of the answer queue, after additions
+        - additions: Number of entries just added
         """
         return False
 
 
 class OriginalAllocation(BaseAllocation):
-    def _aq_length(self):
-        # Get length of answerQueue
-        return DBSession.execute(
-            'SELECT COUNT(*)'
-            ' FROM answer'
-            ' WHERE stage_id = :stage_id'
-            '   AND user_id = :user_id'
+    # Maximum number of questions to give a student at once
+    question_cap = 100
+
+    def _aq_grade(self, aq_length):
+        # Get grade after the (aq_length)th answer, for all versions of this stage
+        if aq_length < 1:
+            return 0
+        row = DBSession.execute(
+            'SELECT a.grade'
+            ' FROM answer a'
+            ' WHERE a.stage_id IN ('
+            '     SELECT other.stage_id'
+            '       FROM stage st'
+            '       JOIN stage other'
+            '         ON other.syllabus_id = st.syllabus_id'
+            '        AND other.stage_name = st.stage_name'
+            '      WHERE st.stage_id = :stage_id'
+            ' )'
+            '   AND a.user_id = :user_id'
+            ' ORDER BY a.time_end, a.time_offset'
+            ' OFFSET :offset LIMIT 1'
+            '',
+            dict(
+                stage_id=self.db_stage.stage_id,
+                user_id=self.db_student.user_id,
+                offset=aq_length - 1,
+            )
+        ).fetchone()
+        return float(row[0]) if row else 0
+
+    def _aq_length_stored(self):
+        # Get length of answerQueue, for all versions of this stage, from user_stage_progress
+        row = DBSession.execute(
+            'SELECT usp.answer_count'
+            ' FROM stage st'
+            ' JOIN user_stage_progress usp'
+            '   ON usp.syllabus_id = st.syllabus_id'
+            '  AND usp.stage_name = st.stage_name'
+            ' WHERE st.stage_id = :stage_id'
+            '   AND usp.user_id = :user_id'
             '',
             dict(
                 stage_id=self.db_stage.stage_id,
                 user_id=self.db_student.user_id,
             )
-        ).fetchone()[0]
+        ).fetchone()
+        return row[0] if row else 0
 
     def __init__(self, settings, db_stage, db_student):
         super(OriginalAllocation, self).__init__(settings, db_stage, db_student)
         self.seed = int(settings['allocation_seed'])
-        self.cipher = skippy.Skippy(settings['allocation_encryption_key'].encode('ascii'))
+        self.encryption_key = settings['allocation_encryption_key']
         self.refresh_int = int(self.settings.get('allocation_refresh_interval', 20))
-        self.question_cap = 100
+        self.bank_selection = self.settings.get('allocation_bank_selection', None) or 'uniform'
 
     def to_public_id(self, mss_id, permutation):
-        return base64.b64encode(struct.pack(
-            'cII',
-            b'B' if permutation < 0 else b'A',
-            self.cipher.encrypt(mss_id),
-            self.cipher.encrypt(abs(permutation)),
-        )).decode('ascii')
+        return encrypt_public_id(self.encryption_key, mss_id, permutation)
 
     def from_public_id(self, public_id):
-        public_id = base64.b64decode(public_id)
-        if len(public_id) < 9:
-            # Pre-version-char format
-            version_char = b'A'
-            mss_id, permutation = struct.unpack('II', public_id)
-        else:
-            version_char, mss_id, permutation = struct.unpack('cII', public_id)
-        mss_id = self.cipher.decrypt(mss_id)
-        permutation = self.cipher.decrypt(permutation)
-        if version_char == b'B':
-            permutation = 0 - permutation
-        return mss_id, permutation
+        return decrypt_public_id(self.encryption_key, public_id)
 
-    def get_material(self):
-        material = super(OriginalAllocation, self).get_material()
+    def to_public_ids(self, items):
+        return [encrypt_public_id(self.encryption_key, mss_id, permutation) for mss_id, permutation in items]
+
+    def from_public_ids(self, public_ids):
+        return [decrypt_public_id(self.encryption_key, x) for x in public_ids]
 
+    def get_material(self):
+        if self.bank_selection == 'index':
+            return self._get_material_by_index()
+        if self.bank_selection == 'difficulty':
+            refresh_epoch = self._aq_length_stored() // self.refresh_int
+            material = self._stored_bank(refresh_epoch)
+            if material is None:
+                # Not synced since the last refresh / material changed, choose without storing
+                material = self._get_material_by_difficulty(refresh_epoch)
+            return material
+        if self.bank_selection != 'uniform':
+            raise ValueError("Unknown allocation_bank_selection %s" % self.bank_selection)
+
+        material = [(mss_id, permutation) for mss_id, permutation in super(OriginalAllocation, self).get_material()]
         # If there are enough, sample based on our seed & how many questions student has answered
         if self.question_cap < len(material):
-            # TODO: We should be choosing based on difficulty, but to do that we need
-            # updated stats, and the current grade
             local_random = random.Random()
-            local_random.seed(self.seed + (self._aq_length() // self.refresh_int))
+            local_random.seed(self.seed + (self._aq_length_stored() // self.refresh_int))
             material = local_random.sample(material, self.question_cap)
         return material
 
-    def should_refresh_questions(self, aq, additions):
+    def update_bank(self):
+        if self.bank_selection != 'difficulty':
+            return
+
+        # If we already chose a bank this refresh epoch, keep that. Difficulties
+        # change with every answer, so choosing again would give a different bank
+        refresh_epoch = self._aq_length_stored() // self.refresh_int
+        if self._stored_bank(refresh_epoch) is not None:
+            return
+        material = self._get_material_by_difficulty(refresh_epoch)
+
+        # Snapshot the bank until the next refresh
+        DBSession.execute(
+            'INSERT INTO user_stage_bank (stage_id, user_id, refresh_epoch, question_cap, material_source_ids, permutations)'
+            ' VALUES (:stage_id, :user_id, :refresh_epoch, :question_cap, :mss_ids, :permutations)'
+            ' ON CONFLICT (stage_id, user_id) DO UPDATE'
+            ' SET refresh_epoch = EXCLUDED.refresh_epoch'
+            '   , question_cap = EXCLUDED.question_cap'
+            '   , material_source_ids = EXCLUDED.material_source_ids'
+            '   , permutations = EXCLUDED.permutations'
+            '',
+            dict(
+                stage_id=self.db_stage.stage_id,
+                user_id=self.db_student.user_id,
+                refresh_epoch=refresh_epoch,
+                question_cap=self.question_cap,
+                mss_ids=[m[0] for m in material],
+                permutations=[m[1] for m in material],
+            )
+        )
+        mark_changed(DBSession())
+
+    def _stored_bank(self, refresh_epoch):
+        """
+        Return the bank snapshotted by update_bank for (refresh_epoch), or None
+        if there isn't one, or any of its material has since been superseded
+        """
+        row = DBSession.execute(
+            'SELECT b.material_source_ids, b.permutations'
+            ' FROM user_stage_bank b'
+            ' WHERE b.stage_id = :stage_id'
+            '   AND b.user_id = :user_id'
+            '   AND b.refresh_epoch = :refresh_epoch'
+            '   AND b.question_cap = :question_cap'
+            '   AND NOT EXISTS ('
+            '       SELECT 1'
+            '         FROM material_source ms'
+            '        WHERE ms.material_source_id = ANY(b.material_source_ids)'
+            '          AND ms.next_material_source_id IS NOT NULL'
+            '   )'
+            '',
+            dict(
+                stage_id=self.db_stage.stage_id,
+                user_id=self.db_student.user_id,
+                refresh_epoch=refresh_epoch,
+                question_cap=self.question_cap,
+            )
+        ).fetchone()
+        return list(zip(row[0], row[1])) if row else None
+
+    def _get_material_by_difficulty(self, refresh_epoch):
+        """
+        Sample material around the student's grade at the start of
+        (refresh_epoch), favouring questions of similar difficulty
+        """
+        # Fetch material, with difficulty from our answers and initial answers combined
+        material = DBSession.execute(
+            'SELECT sm.material_source_id, sm.permutation'
+            '     , PERCENT_RANK() OVER (ORDER BY'
+            '           (sm.initial_correct + COALESCE(ast.correct, 0) + 1)::FLOAT'
+            '           / (sm.initial_answered + COALESCE(ast.answered, 0) + 2) DESC'
+            '       ) difficulty'
+            ' FROM stage_material sm'
+            ' LEFT JOIN answer_stats ast'
+            '   ON ast.stage_id = sm.stage_id'
+            '  AND ast.material_source_id = sm.material_source_id'
+            '  AND ast.permutation = sm.permutation'
+            ' WHERE sm.stage_id = :stage_id'
+            ' ORDER BY sm.material_source_id, sm.permutation'
+            '',
+            dict(stage_id=self.db_stage.stage_id),
+        ).fetchall()
+        if self.question_cap >= len(material):
+            return [(mss_id, permutation) for mss_id, permutation, _ in material]
+
+        # Sample around the student's grade, based on our seed & how many questions student has answered
+        # NB: Use the grade from when the bank was last refreshed, so it's the same until the next refresh
+        grade = self._aq_grade(refresh_epoch * self.refresh_int)
+        chosen = weighted_sample(
+            difficulty_weights(np.fromiter((m[2] for m in material), float, len(material)), grade),
+            self.question_cap,
+            np.random.default_rng([self.seed, refresh_epoch]),
+        )
+        return [(int(material[i][0]), int(material[i][1])) for i in chosen]
+
+    def _get_material_by_index(self):
+        """
+        Uniformly sample material by index into the list of all permutations,
+        only fetching the permutation count for each material source
+        """
+        counts = DBSession.execute(
+            'SELECT ms.material_source_id, ms.permutation_count'
+            ' FROM stage s'
+            ' JOIN stage_material_source_link sml ON sml.stage_id = s.stage_id'
+            ' JOIN material_source ms ON ms.material_source_id = sml.material_source_id'
+            ' WHERE s.stage_id = :stage_id'
+            '   AND s.next_stage_id IS NULL'
+            '   AND ms.next_material_source_id IS NULL'
+            ' ORDER BY ms.material_source_id'
+            '',
+            dict(stage_id=self.db_stage.stage_id),
+        ).fetchall()
+        mss_ids = np.array([c[0] for c in counts], dtype=int)
+        permutation_counts = np.array([c[1] for c in counts], dtype=int)
+        total = int(permutation_counts.sum())
+
+        if self.question_cap < total:
+            refresh_epoch = self._aq_length_stored() // self.refresh_int
+            indexes = np.random.default_rng([self.seed, refresh_epoch]).choice(total, size=self.question_cap, replace=False)
+        else:
+            indexes = np.arange(total)
+        return material_at_index(mss_ids, permutation_counts, indexes)
+
+    def should_refresh_questions(self, aq_length, additions):
         """
         Has enough time passed between 2 answer queues that we should refresh
         the student's question bank?
         """
-        return len(aq) // self.refresh_int != (len(aq) - additions) // self.refresh_int
+        return aq_length // self.refresh_int != (aq_length - additions) // self.refresh_int
 
 
 class PassThroughAllocation(BaseAllocation):
@@ -201,7 +464,137 @@ class PassThroughAllocation(BaseAllocation):
 
         return (mss_ids[int(version) - 1][0], int(permutation),)
 
+    def to_public_ids(self, items):
+        """
+        Turn a list of (mss_id, permutation) into public question IDs, with one query
+        """
+        items = list(items)
+        if len(items) == 0:
+            return []
+        mss_paths = dict((mss_id, (mss_path, version)) for mss_id, mss_path, version in DBSession.execute("""
+            SELECT material_source_id, path, version FROM (
+                SELECT material_source_id
+                     , path
+                     , ROW_NUMBER() OVER (PARTITION BY path ORDER BY material_source_id) AS version
+                  FROM material_source
+                 WHERE path IN (SELECT path FROM material_source WHERE material_source_id = ANY(:mss_ids))
+            ) mss
+             WHERE material_source_id = ANY(:mss_ids)
+        """, dict(
+            mss_ids=list(set(mss_id for mss_id, permutation in items)),
+        )))
+
+        return ['%s:%d:%d' % (mss_paths[mss_id] + (permutation,)) for mss_id, permutation in items]
+
+    def from_public_ids(self, public_ids):
+        """
+        Turn a list of public IDs back into (mss_id, permutation) tuples, with one query
+        """
+        parsed = [public_id.split(":", 2) for public_id in public_ids]
+        if len(parsed) == 0:
+            return []
+        mss_ids = {}
+        for mss_id, mss_path in DBSession.execute("""
+            SELECT material_source_id, path
+              FROM material_source
+             WHERE path = ANY(:mss_paths)
+          ORDER BY material_source_id
+        """, dict(
+            mss_paths=list(set(mss_path for mss_path, version, permutation in parsed)),
+        )):
+            mss_ids.setdefault(mss_path, []).append(mss_id)
+
+        return [
+            (mss_ids.get(mss_path, [])[int(version) - 1], int(permutation),)
+            for mss_path, version, permutation in parsed
+        ]
 
-class ExamAllocation(BaseAllocation):
-    # TODO:
-    pass
+
+class ExamAllocation(OriginalAllocation):
+    """
+    Every student gets a fixed sheet of questions, in a fixed order. Sheets
+    are generated & rendered ahead of time by exam_prepare (see
+    tutorweb_quizdb.stage.exam), so when everyone starts the exam at once
+    we only need to read exam_sheet. Students without a sheet get one
+    generated on demand.
+
+    Set question_cap to the number of questions in the exam, by default
+    all material in the stage. NB: This is stored as sheet_length, the
+    question_cap attribute is OriginalAllocation's question bank size,
+    which exams don't use.
+    """
+    def __init__(self, settings, db_stage, db_student):
+        super(ExamAllocation, self).__init__(settings, db_stage, db_student)
+        self.sheet_length = int(settings.get('question_cap', None) or 0)
+
+    def choose_sheet(self):
+        """Choose list of (mss_id, permutation) for this student's exam"""
+        material = DBSession.execute(
+            'SELECT material_source_id, permutation'
+            ' FROM stage_material'
+            ' WHERE stage_id = :stage_id'
+            ' ORDER BY material_source_id, permutation'
+            '',
+            dict(stage_id=self.db_stage.stage_id),
+        ).fetchall()
+        count = min(self.sheet_length or len(material), len(material))
+        chosen = np.random.default_rng(self.seed).choice(len(material), size=count, replace=False)
+        return [(material[i][0], material[i][1]) for i in chosen]
+
+    def write_sheet(self, items):
+        """Store (items) as this student's sheet, unless they already have one"""
+        if len(items) == 0:
+            return
+        DBSession.execute(
+            'INSERT INTO exam_sheet (stage_id, user_id, position, material_source_id, permutation)'
+            ' SELECT :stage_id, :user_id, u.position - 1, u.material_source_id, u.permutation'
+            '   FROM UNNEST(CAST(:mss_ids AS INTEGER[]), CAST(:permutations AS INTEGER[]))'
+            '        WITH ORDINALITY u(material_source_id, permutation, position)'
+            ' ON CONFLICT DO NOTHING'
+            '',
+            dict(
+                stage_id=self.db_stage.stage_id,
+                user_id=self.db_student.user_id,
+                mss_ids=[mss_id for mss_id, permutation in items],
+                permutations=[permutation for mss_id, permutation in items],
+            ),
+        )
+        mark_changed(DBSession())
+
+    def get_material(self):
+        q = ('SELECT material_source_id, permutation'
+             ' FROM exam_sheet'
+             ' WHERE stage_id = :stage_id'
+             '   AND user_id = :user_id'
+             ' ORDER BY position')
+        params = dict(stage_id=self.db_stage.stage_id, user_id=self.db_student.user_id)
+        material = DBSession.execute(q, params).fetchall()
+        if len(material) == 0:
+            # Not prepared in advance, make one now. NB: A concurrent request may have beaten us to it
+            self.write_sheet(self.choose_sheet())
+            material = DBSession.execute(q, params).fetchall()
+        return [(mss_id, permutation) for mss_id, permutation in material]
+
+    def get_rendered(self, items):
+        items = list(items)
+        if len(items) == 0:
+            return {}
+        return dict(((mss_id, permutation), rendered) for mss_id, permutation, rendered in DBSession.execute(
+            'SELECT material_source_id, permutation, rendered'
+            ' FROM exam_sheet'
+            ' WHERE stage_id = :stage_id'
+            '   AND user_id = :user_id'
+            '   AND rendered IS NOT NULL'
+            '   AND (material_source_id, permutation) IN (SELECT * FROM UNNEST(CAST(:mss_ids AS INTEGER[]), CAST(:permutations AS INTEGER[])))'
+            '',
+            dict(
+                stage_id=self.db_stage.stage_id,
+                user_id=self.db_student.user_id,
+                mss_ids=[mss_id for mss_id, permutation in items],
+                permutations=[permutation for mss_id, permutation in items],
+            ),
+        ))
+
+    def should_refresh_questions(self, aq_length, additions):
+        """The sheet never changes"""
+        return False
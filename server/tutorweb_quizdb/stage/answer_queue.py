@@ -1,15 +1,28 @@
+import hashlib
+import json
 import logging
+from types import SimpleNamespace
 
-from sqlalchemy.orm.exc import NoResultFound
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import select
+from zope.sqlalchemy import mark_changed
 
 from tutorweb_quizdb import DBSession, Base
-from tutorweb_quizdb.rst import to_rst
+from tutorweb_quizdb.rst import to_rst, to_rst_many
 from tutorweb_quizdb.student import student_is_vetted
 from tutorweb_quizdb.syllabus import path_to_ltree
 from tutorweb_quizdb.timestamp import timestamp_to_datetime, datetime_to_timestamp
 
 log = logging.getLogger(__name__)
 
+# Columns we set when inserting new answers
+INSERT_COLUMNS = (
+    'stage_id', 'user_id',
+    'material_source_id', 'permutation', 'client_id', 'time_start', 'time_end', 'time_offset',
+    'correct', 'grade', 'coins_awarded', 'mark', 'mark_stamp',
+    'student_answer', 'review',
+)
+
 
 def mark_aq_entry(db_a, alloc, grade_hwm):
     """
@@ -29,17 +42,16 @@ def mark_aq_entry(db_a, alloc, grade_hwm):
         """Return the high-water-mark for every other stage in the tutorial"""
         return DBSession.execute("""
             SELECT st.stage_id
-                 , (SELECT COALESCE(MAX(a.grade), 0)
-                      FROM answer a, all_stage_versions asv
-                     WHERE a.stage_id = asv.stage_id
-                       AND asv.latest_stage_id = st.stage_id -- i.e we want answer items for all versions of this stage
-                       AND a.user_id = :user_id) grade_hwm
-              FROM stage st, syllabus sy
-             WHERE sy.syllabus_id = st.syllabus_id
-               AND sy.path <@ :tut_path
+                 , COALESCE(usp.max_grade, 0) grade_hwm  -- NB: usp covers all versions of this stage
+              FROM stage st
+              JOIN syllabus sy ON sy.syllabus_id = st.syllabus_id
+         LEFT JOIN user_stage_progress usp
+                ON usp.user_id = :user_id
+               AND usp.syllabus_id = st.syllabus_id
+               AND usp.stage_name = st.stage_name
+             WHERE sy.path <@ :tut_path
                AND st.stage_id != :stage_id
                AND st.next_stage_id IS NULL
-            GROUP BY st.stage_id
         """, dict(
             user_id=db_a.user_id,
             stage_id=db_a.stage_id,
@@ -51,6 +63,7 @@ def mark_aq_entry(db_a, alloc, grade_hwm):
         mark_aq_entry_usergenerated(db_a, alloc, db_a.ug_reviews)
     else:
         # No UG review, consider as a regular question
+        db_a.mark = 0
         db_a.coins_awarded = 0
         if crossed_grade_boundary(5.000):
             db_a.coins_awarded += get_award_setting('stage_answered')
@@ -65,12 +78,11 @@ def mark_aq_entry(db_a, alloc, grade_hwm):
                 db_a.coins_awarded += get_award_setting('tutorial_aced')
 
 
-def mark_aq_entry_usergenerated(db_a, alloc, ug_reviews):
-    """For a list of UG reviews, return a mark"""
-    def get_award_setting(award_type):
-        return round(float(alloc.settings.get('award_' + award_type, 0)))
-
-    # Count / tally all review sections
+def tally_ug_reviews(ug_reviews):
+    """
+    Count / tally all review sections, setting the mark for each review
+    Returns (total of all marks, count of reviews, vetted_accepted)
+    """
     out_count = 0
     out_total = 0
     vetted_accepted = False
@@ -91,7 +103,15 @@ def mark_aq_entry_usergenerated(db_a, alloc, ug_reviews):
         review['mark'] = review_total
         out_total += review_total
         out_count += 1
+    return (out_total, out_count, vetted_accepted)
+
+
+def mark_aq_entry_usergenerated(db_a, alloc, ug_reviews):
+    """For a list of UG reviews, return a mark"""
+    def get_award_setting(award_type):
+        return round(float(alloc.settings.get('award_' + award_type, 0)))
 
+    (out_total, out_count, vetted_accepted) = tally_ug_reviews(ug_reviews)
     if out_count > 0:
         # Mark should be mean of all reviews
         db_a.mark = int(out_total / max(int(alloc.settings.get('ugreview_minreviews', 3)), out_count))
@@ -118,8 +138,8 @@ def mark_aq_entry_usergenerated(db_a, alloc, ug_reviews):
         db_a.coins_awarded += get_award_setting('ugmaterial_accepted')
 
 
-def db_to_incoming(alloc, db_a):
-    """Turn db entry back to wire-format"""
+def db_to_incoming(alloc, db_a, uri=None):
+    """Turn db entry back to wire-format, (uri) is the public ID if already known"""
     def format_review(reviewer_user_id, review):
         """Format incoming review object from stage_ugmaterial for client"""
         if not review:
@@ -131,7 +151,7 @@ def db_to_incoming(alloc, db_a):
         return review
 
     return dict(
-        uri=alloc.to_public_id(db_a.material_source_id, db_a.permutation),
+        uri=uri or alloc.to_public_id(db_a.material_source_id, db_a.permutation),
         client_id=db_a.client_id,
         time_start=datetime_to_timestamp(db_a.time_start),
         time_end=datetime_to_timestamp(db_a.time_end),
@@ -144,7 +164,7 @@ def db_to_incoming(alloc, db_a):
         student_answer=db_a.student_answer,
         review=db_a.review,
         synced=True,
-        mark=getattr(db_a, 'mark', 0),
+        mark=db_a.mark or 0,
 
         ug_reviews=[
             format_review(reviewer_user_id, review)
@@ -155,6 +175,19 @@ def db_to_incoming(alloc, db_a):
     )
 
 
+def db_list_to_incoming(alloc, db_entries):
+    """Turn a list of db entries back to wire-format, encoding their public IDs in one go"""
+    uris = alloc.to_public_ids((db_a.material_source_id, db_a.permutation) for db_a in db_entries)
+    # Render all review comments in one go, so db_to_incoming finds them in the cache
+    to_rst_many([
+        review['comments']
+        for db_a in db_entries
+        for _, review in (db_a.ug_reviews or [])
+        if review and review.get('comments', None)
+    ])
+    return [db_to_incoming(alloc, db_a, uri) for db_a, uri in zip(db_entries, uris)]
+
+
 def incoming_to_db(alloc, in_a):
     """Turn wire-format into a DB answer entry"""
     try:
@@ -163,20 +196,13 @@ def incoming_to_db(alloc, in_a):
         # Log exception along with real error
         log.exception("Could not parse question ID %s" % in_a['uri'])
         raise ValueError("Could not parse question ID %s" % in_a['uri'])
-    try:
-        ms = DBSession.query(Base.classes.material_source).filter_by(material_source_id=mss_id).one()
-    except NoResultFound:
-        log.exception("Could not parse question ID %s" % in_a['uri'])
-        raise ValueError("Cannot find question %s for user %s (are you logged in as the right user?)" % (
-            in_a['uri'],
-            alloc.db_student.user_name,
-        ))
 
-    return Base.classes.answer(
+    return SimpleNamespace(
+        answer_id=None,
         stage_id=alloc.db_stage.stage_id,  # NB: Assume incoming answers are based on the latest stage
         user_id=alloc.db_student.id,
 
-        material_source_id=ms.material_source_id,
+        material_source_id=mss_id,
         permutation=permutation,
         client_id=in_a['client_id'],
         time_start=timestamp_to_datetime(in_a['time_start']),
@@ -185,34 +211,136 @@ def incoming_to_db(alloc, in_a):
         correct=in_a['correct'],
         grade=in_a['grade_after'],
         coins_awarded=0,
+        mark=None,
+        mark_stamp=None,
 
         student_answer=in_a.get('student_answer', None),
         review=in_a.get('review', None),
+        sync_txid=None,
     )
 
 
-def sync_answer_queue(alloc, in_queue, time_offset):
+def insert_answers(alloc, new_entries):
+    """
+    Insert all (new_entries) in one statement, filling in their answer_id.
+    Entries that a concurrent sync has already inserted are left alone, and
+    refreshed from the DB instead. Returns the list of these entries.
+    """
+    answer = Base.classes.answer.__table__
+
+    # Make sure all material exists before trying to insert
+    known_mss_ids = set(x[0] for x in DBSession.execute(
+        "SELECT material_source_id FROM material_source WHERE material_source_id = ANY(:mss_ids)",
+        dict(mss_ids=list(set(e.material_source_id for e in new_entries))),
+    ))
+    for e in new_entries:
+        if e.material_source_id not in known_mss_ids:
+            raise ValueError("Cannot find question %s for user %s (are you logged in as the right user?)" % (
+                alloc.to_public_id(e.material_source_id, e.permutation),
+                alloc.db_student.user_name,
+            ))
+
+    # NB: answer_client_identity makes a retried insert a no-op, rather than a duplicate
+    def identity(x):
+        return (x.client_id, x.time_end)
+    inserted = dict((identity(r), r.answer_id) for r in DBSession.execute(
+        postgresql.insert(answer).values([dict(
+            (c, getattr(e, c)) for c in INSERT_COLUMNS
+        ) for e in new_entries]).on_conflict_do_nothing(
+            # NB: Name the index, so we fail if it's missing rather than insert duplicates
+            index_elements=['user_id', 'client_id', 'time_end'],
+        ).returning(
+            answer.c.answer_id, answer.c.client_id, answer.c.time_end,
+        )))
+    conflicted = []
+    for e in new_entries:
+        if identity(e) in inserted:
+            e.answer_id = inserted[identity(e)]
+        else:
+            conflicted.append(e)
+
+    if len(conflicted) > 0:
+        # Someone else got there first, use what they wrote
+        existing = dict((identity(r), r) for r in DBSession.execute(
+            select([answer])
+            .where(answer.c.user_id == alloc.db_student.id)
+            .where(answer.c.client_id.in_(set(e.client_id for e in conflicted)))
+            .where(answer.c.time_end.in_(set(e.time_end for e in conflicted)))
+        ))
+        for e in conflicted:
+            e.__dict__.update(dict(existing[identity(e)]))
+    return conflicted
+
+
+def update_answers(updated_entries):
+    """
+    Write back correct / coins_awarded / mark / review for all (updated_entries) in one statement.
+    Rows that already match (e.g. a concurrent sync marked them the same way) are left alone.
+    """
+    values = []
+    params = {}
+    for i, e in enumerate(updated_entries):
+        values.append((
+            "(CAST(:answer_id_{0} AS INTEGER), CAST(:correct_{0} AS BOOLEAN), CAST(:coins_awarded_{0} AS INTEGER)"
+            ", CAST(:mark_{0} AS INTEGER), CAST(:mark_stamp_{0} AS TEXT), CAST(:review_{0} AS JSONB))"
+        ).format(i))
+        params['answer_id_%d' % i] = e.answer_id
+        params['correct_%d' % i] = e.correct
+        params['coins_awarded_%d' % i] = e.coins_awarded
+        params['mark_%d' % i] = e.mark
+        params['mark_stamp_%d' % i] = e.mark_stamp
+        params['review_%d' % i] = json.dumps(e.review)
+    DBSession.execute("""
+        UPDATE answer
+           SET correct = v.correct
+             , coins_awarded = v.coins_awarded
+             , mark = v.mark
+             , mark_stamp = v.mark_stamp
+             , review = v.review
+          FROM (VALUES """ + ",".join(values) + """) AS v(answer_id, correct, coins_awarded, mark, mark_stamp, review)
+         WHERE answer.answer_id = v.answer_id
+           AND (answer.correct, answer.coins_awarded, answer.mark, answer.mark_stamp, answer.review)
+               IS DISTINCT FROM (v.correct, v.coins_awarded, v.mark, v.mark_stamp, v.review)
+    """, params)
+
+
+def merge_answer_queue(alloc, in_queue, time_offset, since_txid=None):
+    """
+    Merge (in_queue) with the student's answers in the DB, marking as we go
+    Returns ([(db_entry, changed), ...], additions), changed being true iff
+    the entry was sent to us, or has changed since (since_txid)
+
+    The merge is done in-memory, writing back with one INSERT for all new
+    answers and one UPDATE for all modified answers.
+    """
+    answer = Base.classes.answer.__table__
+
+    # NB: We're about to bypass the ORM, so make sure it's written everything
+    DBSession.flush()
+
     # Fetch all past stage_ids for this stage_id, so we consider answers from older stave revisions
     all_stages = [x[0] for x in DBSession.execute("""
-        SELECT stage_id FROM all_stage_versions WHERE latest_stage_id = :stage_id
+        SELECT stage_id FROM stage_lineage WHERE latest_stage_id = :stage_id
     """, dict(
         stage_id=alloc.db_stage.stage_id,
     ))]
 
-    # Lock answer_queue for this student, to stop any concorrent updates
-    db_queue = (DBSession.query(Base.classes.answer)
-                .filter(Base.classes.answer.stage_id.in_(all_stages))
-                .filter(Base.classes.answer.user_id == alloc.db_student.id)
-                .order_by(Base.classes.answer.time_end, Base.classes.answer.time_offset)
-                .with_for_update().all())
+    # NB: No locking, concurrent syncs can only collide inserting the same answer, which insert_answers handles
+    db_queue = [SimpleNamespace(**dict(r)) for r in DBSession.execute(
+        select([answer])
+        .where(answer.c.stage_id.in_(all_stages))
+        .where(answer.c.user_id == alloc.db_student.id)
+        .order_by(answer.c.time_end, answer.c.time_offset)
+    )]
 
     # Fetch any reviews if we've written content here
     # NB: This won't select items in in_queue that haven't been inserted yet, but
     #     should just be the self-review we won't return anyway.
     stage_ug_reviews = {}
-    for (answer_id, ug_reviews) in DBSession.execute(
+    stage_ug_txids = {}
+    for (answer_id, ug_reviews, reviews_sync_txid) in DBSession.execute(
             """
-            SELECT answer_id, reviews FROM stage_ugmaterial
+            SELECT answer_id, reviews, reviews_sync_txid FROM stage_ugmaterial
              WHERE user_id = :user_id
                AND material_source_id IN (
                 SELECT material_source_id FROM stage_material_sources sms
@@ -221,16 +349,56 @@ def sync_answer_queue(alloc, in_queue, time_offset):
             ORDER BY time_end
             """, dict(
                 stage_id=alloc.db_stage.stage_id,  # NB: This uses latest stage, since material will be carried over.
-                user_id=alloc.db_student.id,
+                user_id=alloc.db_student.user_id,
             )):
         stage_ug_reviews[answer_id] = ug_reviews
+        stage_ug_txids[answer_id] = reviews_sync_txid
+
+    def changed_since(db_entry):
+        """Has something changed that the client hasn't seen?"""
+        if since_txid is None:
+            return True
+        for txid in (db_entry.sync_txid, stage_ug_txids.get(db_entry.answer_id, None)):
+            if txid is not None and txid >= since_txid:
+                return True
+        return False
+
+    def written_state(db_entry):
+        """The parts of an entry merging can change"""
+        return (db_entry.correct, db_entry.coins_awarded, db_entry.mark, db_entry.mark_stamp, db_entry.review)
+
+    def mark_stamp(db_entry, grade_hwm):
+        """
+        Stamp describing everything marking depends on, if it matches we don't need to re-mark.
+        UG material depends on stage settings and the reviews against it. Other answers
+        depend on the highest grade before them, their coins were awarded under the settings of the time
+        """
+        if db_entry.answer_id in stage_ug_reviews:
+            return '%d:%s' % (alloc.db_stage.stage_id, hashlib.md5(
+                json.dumps(stage_ug_reviews[db_entry.answer_id], sort_keys=True).encode('utf8')
+            ).hexdigest())
+        return 'hwm:%.3f' % grade_hwm
+
+    def needs_marking(db_entry, stamp):
+        if db_entry.answer_id in stage_ug_reviews:
+            return db_entry.mark_stamp != stamp
+        if remark_following:
+            # An answer was inserted before this one, re-mark if it changed grade_hwm
+            return db_entry.mark_stamp != stamp
+        # NB: Any stamp will do, including the stage_id answers used to be stamped with
+        return db_entry.mark_stamp is None
 
     # First pass, fill in any missing time_offset fields
+    # NB: A retried answer gets the time_offset we stored it with, the client's clock may have moved since
+    stored_offsets = dict(((e.client_id, datetime_to_timestamp(e.time_end)), e.time_offset) for e in db_queue)
     for a in in_queue[:]:
         # If not complete, ignore it
         if not a.get('time_end', 0):
             in_queue.remove(a)
-        if a.get('time_offset', None) is None:
+            continue
+        if (a.get('client_id', None), a['time_end']) in stored_offsets:
+            a['time_offset'] = stored_offsets[(a['client_id'], a['time_end'])]
+        elif a.get('time_offset', None) is None:
             a['time_offset'] = time_offset
     # Re-sort based on any additional time_offsets
     in_queue.sort(key=lambda a: (a['time_end'], a['time_offset']))
@@ -239,7 +407,10 @@ def sync_answer_queue(alloc, in_queue, time_offset):
     in_i = 0
     additions = 0
     out = []
+    new_entries = []
+    updated_entries = []
     grade_hwm = 0
+    remark_following = False
     while True:
         if db_i >= len(db_queue):
             # Ran off the end of DB items, anything extra should be added to incoming
@@ -259,10 +430,12 @@ def sync_answer_queue(alloc, in_queue, time_offset):
 
         if cmp == 0:
             # Matching items, update any review
+            db_entry = db_queue[db_i]
+            old_state = written_state(db_entry)
             # NB: Only update the review when there's something to replace it with, so view_stage_ug_rewrite is saved
             if in_queue[in_i].get('review', None):
-                db_queue[db_i].review = in_queue[in_i]['review']
-            db_entry = db_queue[db_i]
+                db_entry.review = in_queue[in_i]['review']
+            changed = True
             db_i += 1
             in_i += 1
 
@@ -270,27 +443,101 @@ def sync_answer_queue(alloc, in_queue, time_offset):
             # An extra incoming item, insert it
             db_entry = incoming_to_db(alloc, in_queue[in_i])
             db_entry.time_offset = time_offset
-            DBSession.add(db_entry)
+            new_entries.append(db_entry)
+            old_state = None
+            # grade_hwm may have changed for any answers after this, so check their stamps
+            remark_following = True
+            changed = True
             additions += 1
             in_i += 1
 
-        else:  # i.e. cmp < 0
+        else:  # i.e. cmp > 0
             # An extra DB item, do nothing, will get added to outgoing list
             db_entry = db_queue[db_i]
+            old_state = written_state(db_entry)
+            changed = changed_since(db_entry)
             db_i += 1
 
         # If reviews are present, update DB entry based on them
         db_entry.ug_reviews = stage_ug_reviews.get(db_entry.answer_id, None)
-        mark_aq_entry(db_entry, alloc, grade_hwm)
-        out.append(db_to_incoming(alloc, db_entry))
+        new_stamp = mark_stamp(db_entry, grade_hwm)
+        if needs_marking(db_entry, new_stamp):
+            mark_aq_entry(db_entry, alloc, grade_hwm)
+            db_entry.mark_stamp = new_stamp
+        elif db_entry.ug_reviews is not None:
+            # Already marked, but still need marks for each review
+            tally_ug_reviews(db_entry.ug_reviews)
+        if old_state is not None and old_state != written_state(db_entry):
+            updated_entries.append(db_entry)
+            changed = changed or db_entry.correct != old_state[0]
+        out.append((db_entry, changed))
         if db_entry.grade > grade_hwm:
             grade_hwm = db_entry.grade
 
-        DBSession.flush()
+    # Write everything back in as few statements as possible
+    if len(new_entries) > 0:
+        additions -= len(insert_answers(alloc, new_entries))
+    if len(updated_entries) > 0:
+        update_answers(updated_entries)
+    if len(new_entries) > 0 or len(updated_entries) > 0:
+        mark_changed(DBSession())  # Mark this session changed, so sqlalchemy commits
+
     # Return combination of answer queues, and how many new entries we found
     return (out, additions)
 
 
+def sync_answer_queue(alloc, in_queue, time_offset):
+    """
+    Sync (in_queue) with the DB, return (entire answer queue, count of new entries)
+    """
+    (merged, additions) = merge_answer_queue(alloc, in_queue, time_offset)
+    return (db_list_to_incoming(alloc, [db_entry for db_entry, changed in merged]), additions)
+
+
+def sync_answer_queue_delta(alloc, in_queue, time_offset, sync_cursor):
+    """
+    Sync (in_queue) with the DB, only returning entries that the client hasn't
+    seen since (sync_cursor), a value returned by a previous call, or None.
+    (in_queue) only needs to contain entries the client hasn't synced yet.
+
+    Returns (changed entries, count of new entries, queue length, new sync_cursor).
+    If anything has changed, the latest entry in the queue is always included.
+
+    A cursor is "(stage_id):(txid):(queue length)", where (txid) is the oldest
+    transaction that could have been in progress whilst reading the queue.
+    Anything with a sync_txid at least this needs sending next time.
+    """
+    # NB: Fetch before reading anything, so we can't miss anything committed during the sync
+    new_txid = DBSession.execute("SELECT txid_snapshot_xmin(txid_current_snapshot())").scalar()
+
+    try:
+        (cursor_stage_id, since_txid, aq_length) = (int(x) for x in sync_cursor.split(':'))
+        if cursor_stage_id != alloc.db_stage.stage_id:
+            # Stage has been upgraded since, settings will have changed, so start again
+            since_txid = None
+    except (AttributeError, ValueError):
+        # No / unparsable cursor, send everything
+        since_txid = None
+
+    if since_txid is not None and not any(a.get('time_end', 0) for a in in_queue):
+        # Nothing to write, is there anything to read?
+        if not DBSession.execute(
+                "SELECT EXISTS(SELECT 1 FROM answer_queue_sync WHERE user_id = :user_id AND change_txid >= :since_txid)",
+                dict(user_id=alloc.db_student.id, since_txid=since_txid)).scalar():
+            return ([], 0, aq_length, '%d:%d:%d' % (alloc.db_stage.stage_id, new_txid, aq_length))
+
+    (merged, additions) = merge_answer_queue(alloc, in_queue, time_offset, since_txid=since_txid)
+    if any(changed for db_entry, changed in merged):
+        out = db_list_to_incoming(alloc, [
+            db_entry
+            for i, (db_entry, changed) in enumerate(merged)
+            if changed or i == len(merged) - 1
+        ])
+    else:
+        out = []
+    return (out, additions, len(merged), '%d:%d:%d' % (alloc.db_stage.stage_id, new_txid, len(merged)))
+
+
 def request_review(alloc):
     is_vetted = student_is_vetted(alloc.db_student, alloc.db_stage)
 
@@ -309,7 +556,7 @@ def request_review(alloc):
             ORDER BY """ + ('correct,' if is_vetted else '') + """ JSONB_ARRAY_LENGTH(reviews), RANDOM()
             """, dict(
                 stage_id=alloc.db_stage.stage_id,  # NB: This uses latest stage, since material will be carried over.
-                user_id=alloc.db_student.id,
+                user_id=alloc.db_student.user_id,
             )):
 
         # Consider all reviews
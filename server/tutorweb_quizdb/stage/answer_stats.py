@@ -0,0 +1,77 @@
+from zope.sqlalchemy import mark_changed
+
+from tutorweb_quizdb import DBSession
+
+# Counts answer_stats should contain, according to the answer table
+ANSWER_STATS_SQL = """
+    SELECT a.stage_id, a.material_source_id, a.permutation
+         , COUNT(*) answered
+         , COUNT(NULLIF(a.correct, false)) correct
+      FROM answer a
+     WHERE a.material_source_id IS NOT NULL
+       AND a.permutation IS NOT NULL
+  GROUP BY 1, 2, 3
+"""
+
+
+def answer_stats_rebuild():
+    """
+    Replace the contents of answer_stats with counts from the answer table,
+    return the number of rows in answer_stats.
+    """
+    # Stop anything writing answers (and so triggers updating answer_stats) until we're done
+    DBSession.execute("LOCK TABLE answer IN SHARE MODE")
+    DBSession.execute("DELETE FROM answer_stats")
+    out = DBSession.execute("""
+        INSERT INTO answer_stats (stage_id, material_source_id, permutation, answered, correct)
+    """ + ANSWER_STATS_SQL)
+    mark_changed(DBSession())
+    return out.rowcount
+
+
+def answer_stats_check():
+    """
+    Compare answer_stats to counts from the answer table, return a list of
+    (stage_id, material_source_id, permutation, answered, correct, stats_answered, stats_correct)
+    for every row that doesn't match.
+    """
+    return [tuple(r) for r in DBSession.execute("""
+        SELECT COALESCE(a.stage_id, ast.stage_id)
+             , COALESCE(a.material_source_id, ast.material_source_id)
+             , COALESCE(a.permutation, ast.permutation)
+             , COALESCE(a.answered, 0), COALESCE(a.correct, 0)
+             , COALESCE(ast.answered, 0), COALESCE(ast.correct, 0)
+          FROM (""" + ANSWER_STATS_SQL + """) a
+          FULL OUTER JOIN answer_stats ast
+            ON ast.stage_id = a.stage_id
+           AND ast.material_source_id = a.material_source_id
+           AND ast.permutation = a.permutation
+         WHERE (COALESCE(a.answered, 0), COALESCE(a.correct, 0)) != (COALESCE(ast.answered, 0), COALESCE(ast.correct, 0))
+      ORDER BY 1, 2, 3
+    """)]
+
+
+def script_answer_stats():
+    import sys
+    from tutorweb_quizdb import setup_script
+
+    argparse_arguments = [
+        dict(description='Check answer_stats matches the answer table, optionally rebuilding it first'),
+        dict(
+            name="--rebuild",
+            help="Replace answer_stats with counts from the answer table",
+            action="store_true",
+            default=False,
+        ),
+    ]
+
+    with setup_script(argparse_arguments) as env:
+        if env['args'].rebuild:
+            print("Rebuilt answer_stats: %d rows" % answer_stats_rebuild())
+
+        mismatches = answer_stats_check()
+        for m in mismatches:
+            print("stage %d, material_source %d, permutation %d: answered/correct %d/%d, answer_stats has %d/%d" % m)
+        print("%d mismatched rows in answer_stats" % len(mismatches))
+    if len(mismatches) > 0:
+        sys.exit(1)
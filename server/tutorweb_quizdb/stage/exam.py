@@ -0,0 +1,182 @@
+"""
+Prepare exam stages ahead of time, choosing each student's questions and
+rendering them, so when everyone starts the exam at once ExamAllocation
+only needs to read exam_sheet. See ExamAllocation
+"""
+import json
+import os
+import time
+
+from zope.sqlalchemy import mark_changed
+
+from tutorweb_quizdb import DBSession, Base
+from tutorweb_quizdb.material.render import material_render_many
+from tutorweb_quizdb.material.renderer import r as r_renderer
+from tutorweb_quizdb.models import User
+from .allocation import get_allocation, ExamAllocation
+from .setting import getStudentSettings
+
+# Students / rendered questions to write before calling checkpoint()
+BATCH_SIZE = 100
+
+
+def exam_stages(path):
+    """Current exam stages within (path)"""
+    stage_ids = [r[0] for r in DBSession.execute("""
+        SELECT st.stage_id
+          FROM stage st
+          JOIN syllabus sy ON sy.syllabus_id = st.syllabus_id
+         WHERE sy.path <@ :path
+           AND st.next_stage_id IS NULL
+           AND st.stage_setting_spec #>> '{allocation_method,value}' = 'exam'
+      ORDER BY sy.path, st.stage_name
+    """, dict(path=str(path)))]
+    return [DBSession.query(Base.classes.stage).get(stage_id) for stage_id in stage_ids]
+
+
+def exam_sheet_generate(db_stage, checkpoint=lambda: None):
+    """
+    Choose questions for every student subscribed to (db_stage) that
+    doesn't have an exam sheet yet. (checkpoint) is called after every
+    BATCH_SIZE students, e.g. to commit progress so far.
+    Returns the number of sheets generated.
+    """
+    stage_id = db_stage.stage_id
+    user_ids = [r[0] for r in DBSession.execute("""
+        SELECT DISTINCT sub.user_id
+          FROM stage st
+          JOIN syllabus lec ON lec.syllabus_id = st.syllabus_id
+          JOIN syllabus sy ON lec.path <@ sy.path
+          JOIN subscription sub ON sub.syllabus_id = sy.syllabus_id
+         WHERE st.stage_id = :stage_id
+           AND NOT EXISTS (SELECT 1 FROM exam_sheet es WHERE es.stage_id = st.stage_id AND es.user_id = sub.user_id)
+      ORDER BY sub.user_id
+    """, dict(stage_id=stage_id))]
+
+    generated = 0
+    for user_id in user_ids:
+        # NB: Fetch stage each time, since checkpoint() may have expired it
+        db_stage = DBSession.query(Base.classes.stage).get(stage_id)
+        db_student = DBSession.query(User).get(user_id)
+        alloc = get_allocation(getStudentSettings(db_stage, db_student), db_stage, db_student)
+        if not isinstance(alloc, ExamAllocation):
+            # Student's settings say this isn't an exam for them
+            continue
+        alloc.write_sheet(alloc.choose_sheet())
+        generated += 1
+        if generated % BATCH_SIZE == 0:
+            checkpoint()
+    checkpoint()
+    return generated
+
+
+def write_rendered(stage_ids, rendered):
+    """Store list of (mss_id, permutation, material_render output) in exam sheets for (stage_ids)"""
+    if len(rendered) == 0:
+        return
+    DBSession.execute("""
+        UPDATE exam_sheet es
+           SET rendered = CAST(u.rendered AS JSONB)
+          FROM UNNEST(CAST(:mss_ids AS INTEGER[]), CAST(:permutations AS INTEGER[]), CAST(:rendered AS TEXT[]))
+               u(material_source_id, permutation, rendered)
+         WHERE es.stage_id = ANY(:stage_ids)
+           AND es.material_source_id = u.material_source_id
+           AND es.permutation = u.permutation
+           AND es.rendered IS NULL
+    """, dict(
+        stage_ids=list(stage_ids),
+        mss_ids=[r[0] for r in rendered],
+        permutations=[r[1] for r in rendered],
+        rendered=[json.dumps(r[2]) for r in rendered],
+    ))
+    mark_changed(DBSession())
+
+
+def exam_sheet_render(stage_ids, checkpoint=lambda: None):
+    """
+    Render every question in exam sheets for (stage_ids) that hasn't been
+    rendered yet, BATCH_SIZE questions at a time with material_render_many,
+    so R questions are spread across R workers (if configured) and killed
+    if they take too long. Each question is rendered once, and shared
+    between every student that has it. (checkpoint) is called after every
+    batch is stored, e.g. to commit progress so far.
+
+    Questions that use student dataframes, or fail to render, are left to
+    be rendered when requested.
+
+    Returns dict of counts & time taken.
+    """
+    start = time.perf_counter()
+    out = dict(rendered=0, failed=0)
+    items = DBSession.execute("""
+        SELECT DISTINCT es.material_source_id, es.permutation
+          FROM exam_sheet es
+          JOIN material_source ms ON ms.material_source_id = es.material_source_id
+         WHERE es.stage_id = ANY(:stage_ids)
+           AND es.rendered IS NULL
+           AND CARDINALITY(ms.dataframe_paths) = 0
+      ORDER BY es.material_source_id, es.permutation
+    """, dict(stage_ids=list(stage_ids))).fetchall()
+
+    for i in range(0, len(items), BATCH_SIZE):
+        batch = items[i:i + BATCH_SIZE]
+        # NB: Fetch material sources each batch, since checkpoint() may have expired them
+        mss = dict((ms.material_source_id, ms) for ms in DBSession.query(Base.classes.material_source).filter(
+            Base.classes.material_source.material_source_id.in_(set(mss_id for mss_id, _ in batch))
+        ))
+        rendered = []
+        for (mss_id, permutation), r in zip(batch, material_render_many([
+            (mss[mss_id], permutation, {}) for mss_id, permutation in batch
+        ])):
+            if 'error' in r:
+                out['failed'] += 1
+            else:
+                rendered.append((mss_id, permutation, r))
+        write_rendered(stage_ids, rendered)
+        out['rendered'] += len(rendered)
+        checkpoint()
+    out['elapsed'] = time.perf_counter() - start
+    return out
+
+
+def script_exam_prepare():
+    from tutorweb_quizdb import setup_script
+
+    argparse_arguments = [
+        dict(description='Choose & render questions for every student in exam stages, ahead of the exam starting'),
+        dict(
+            name='--processes',
+            help='Number of R processes to render questions with, default one per CPU',
+            type=int,
+            default=None,
+        ),
+        dict(
+            name='path',
+            help='Tutorial/lecture path, prepare all exam stages within',
+        ),
+    ]
+
+    with setup_script(argparse_arguments) as env:
+        tm = env['request'].tm
+
+        def checkpoint():
+            # Commit what we've done so far, so if we're interrupted we can carry on where we left off
+            tm.commit()
+            tm.begin()
+
+        r_renderer.configure_pool(processes=env['args'].processes or os.cpu_count())
+        try:
+            for db_stage in exam_stages(env['args'].path):
+                stage_id = db_stage.stage_id
+                name = '%s/%s' % (db_stage.syllabus.path, db_stage.stage_name)
+                generated = exam_sheet_generate(db_stage, checkpoint=checkpoint)
+                out = exam_sheet_render([stage_id], checkpoint=checkpoint)
+                print("%s: %d sheets generated, %d questions rendered, %d failed in %.1fs" % (
+                    name,
+                    generated,
+                    out['rendered'],
+                    out['failed'],
+                    out['elapsed'],
+                ))
+        finally:
+            r_renderer.configure_pool(processes=0)
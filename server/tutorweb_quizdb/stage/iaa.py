@@ -0,0 +1,285 @@
+"""
+Server-side port of question allocation & grading from client/lib/iaa.js,
+so clients can ask for their next question instead of downloading the whole
+question bank to choose one themselves, and so we can check client grades.
+"""
+import functools
+import math
+
+import numpy as np
+
+from tutorweb_quizdb import DBSession
+from tutorweb_quizdb.student import get_current_student
+from .allocation import get_allocation
+from .material import stage_material
+from .utils import get_current_stage
+from .setting import getStudentSettings
+
+# How many of the most recent answers questionDistribution considers
+BIAS_HISTORY = 21
+
+
+class NoQuestionsException(Exception):
+    status_code = 400
+
+
+def get_setting(settings, key, default):
+    """Equivalent of getSetting in client/lib/settings.js"""
+    if isinstance(default, str):
+        return settings.get(key, None) or default
+    try:
+        out = float(settings.get(key, None))
+    except (TypeError, ValueError):
+        return default
+    return default if math.isnan(out) else out
+
+
+def qn_timeout(settings, grade):
+    """How long the student should get for their next question in seconds, or None. See qnTimeout"""
+    t_max = get_setting(settings, 'timeout_max', 0) * 60
+    t_min = get_setting(settings, 'timeout_min', 0) * 60
+    g_star = get_setting(settings, 'timeout_grade', 5)
+    s = get_setting(settings, 'timeout_std', 2)
+
+    if t_max == 0 or t_min == 0:
+        return None
+    return t_max - math.floor((t_max - t_min) * math.exp(-((grade - g_star) ** 2) / (2 * s ** 2)))
+
+
+def js_round(x):
+    """Math.round, i.e. halves round up, not to even"""
+    return np.floor(np.asarray(x) + 0.5)
+
+
+def grade_weighting(n, alpha, s, nmin, nmax):
+    """Array of weightings for the most recent (n) answers, most recent first. See gradeWeighting"""
+    nm = int(js_round(min(nmax or 30, max(n, nmin or 8))))
+
+    # Generate scaled curve from 1..(nm-1)
+    t = np.arange(1, nm + 1)
+    weightings = (t < nm).astype(float) if s == 0 else np.power(1 - t / nm, s)
+    # NB: Sum in order, as JS would, so we round the same way
+    weightings = weightings / np.cumsum(weightings)[-1]
+
+    # If initial value is less than alpha, prepend alpha & rescale
+    if weightings[0] < alpha:
+        if weightings[-1] > 0.0001:
+            raise ValueError("Last item in weightings %f, not 0" % weightings[-1])
+        weightings = np.concatenate(([alpha], weightings[:-1] * (1 - alpha)))
+    return weightings
+
+
+@functools.lru_cache(maxsize=1024)
+def grade_weighting_table(alpha, s, nmin, nmax):
+    """
+    2D array, row (m) is grade_weighting() for (m) answers, padded with zeros.
+    Weightings stop changing once we have nmax answers, so the last row is
+    used for any more than that
+    """
+    weightings = [grade_weighting(m, alpha, s, nmin, nmax) for m in range(int(math.ceil(nmax or 30)) + 1)]
+    window = max(len(w) for w in weightings)
+    out = np.array([np.pad(w, (0, window - len(w))) for w in weightings])
+    out.flags.writeable = False
+    return out
+
+
+def answer_queue_grades(correct, settings, question_count=None):
+    """
+    Given an array of correct (1), incorrect (0) or ungraded (NaN) answers,
+    oldest first, return an array of grade_after for each answer.
+    (question_count) is the number of questions in the stage, for ratiocorrect.
+    See gradeAllocation
+    """
+    correct = np.asarray(correct, dtype=float)
+    graded = correct[~np.isnan(correct)]
+    # Number of graded answers up to & including each answer, i.e. which graded prefix to use
+    prefix_len = np.cumsum(~np.isnan(correct))
+    correct_count = np.concatenate(([0], np.cumsum(graded == 1)))
+
+    algorithm = get_setting(settings, 'grade_algorithm', 'weighted')
+    if algorithm == 'weighted':
+        table = grade_weighting_table(
+            get_setting(settings, 'grade_alpha', 0.125),
+            get_setting(settings, 'grade_s', 2),
+            get_setting(settings, 'grade_nmin', 8),
+            get_setting(settings, 'grade_nmax', 30),
+        )
+        # Weightings for each prefix length
+        weightings = table[np.minimum(np.arange(len(graded) + 1), len(table) - 1)]
+        window = table.shape[1]
+
+        # Scores for each prefix, most recent first, padded with zeros where there's no answer
+        scores = np.concatenate((np.zeros(window), np.where(graded == 1, 1, -0.5)))
+        # NB: Index rather than sliding_window_view, which needs numpy 1.20
+        scores = scores[np.arange(len(graded) + 1)[:, np.newaxis] + np.arange(window - 1, -1, -1)]
+
+        totals = np.cumsum(weightings * scores, axis=1)[:, -1]
+        factor = 4
+    elif algorithm == 'ratiocorrect':
+        totals = correct_count / question_count
+        factor = 100
+    elif algorithm == 'scorrect':
+        totals = correct_count / get_setting(settings, 'grade_s', 3)
+        factor = 100
+    else:
+        raise ValueError("Unknown grade_algorithm %s" % algorithm)
+
+    return np.maximum(js_round(totals[prefix_len] * factor * 10) / factor, 0)
+
+
+def ia_pdf(count, grade, q, gpow):
+    """Probability for (count) questions in difficulty order, given (grade) 0..10. See ia_pdf"""
+    x = np.arange(1, count + 1) / (count + 1.0)
+    alpha = q * np.power(grade / 10, gpow)
+    beta = q - alpha
+    pdf = np.power(x, alpha) * np.power(1 - x, beta)
+    return pdf / pdf.sum()
+
+
+def question_bias(keys, answer_queue):
+    """
+    Array of how much to favour each of (keys) given (answer_queue), a list
+    of (key, correct) tuples, oldest first. See questionDistribution
+    """
+    bias = {}
+    # NB: Most recent answers will overwrite older
+    for i in range(max(len(answer_queue) - BIAS_HISTORY, 0), len(answer_queue)):
+        key, correct = answer_queue[i]
+        # If question incorrect, probablity increases with time. Correct questions less likely
+        bias[key] = 0.5 if correct else 1.05 ** (len(answer_queue) - i - 3)
+    return np.fromiter((bias.get(k, 1) for k in keys), float, len(keys))
+
+
+def question_distribution(chosen, correct, bias, grade, settings, rng):
+    """
+    Given arrays of (chosen) / (correct) counts & (bias) for each question,
+    return (indexes, probabilities), ordered by increasing probability.
+    Uses (rng) to place questions without enough answers. See questionDistribution
+    """
+    chosen = np.asarray(chosen, dtype=float)
+    correct = np.asarray(correct, dtype=float)
+    gpow = get_setting(settings, 'iaa_adaptive_gpow', 1)
+
+    # Significant numer of answers, so place normally
+    placed = chosen > 5
+    difficulty = 1.0 - np.divide(correct, chosen, out=np.zeros_like(chosen), where=placed)
+
+    # Mark new questions as easy / hard, so they are likely to get them regardless.
+    jitter = ((chosen[~placed] - correct[~placed]) / 2.0 + rng.random(np.count_nonzero(~placed))) / 100.0
+    difficulty[~placed] = jitter if grade < 1.5 else 1.0 - jitter
+    by_difficulty = np.argsort(difficulty, kind='stable')
+
+    # Generate a PDF based on grade, map questions to it ordered by difficulty, apply bias
+    probability = ia_pdf(len(by_difficulty), grade, len(by_difficulty) / 10.0, gpow) * bias[by_difficulty]
+
+    # Re-order based on probability, rescale to 1
+    by_probability = np.argsort(probability, kind='stable')
+    return by_difficulty[by_probability], probability[by_probability] / probability.sum()
+
+
+def choose_question(probabilities, target):
+    """
+    Return the index of the first of (probabilities) where the cumulative
+    probability reaches (target), or None if empty. See chooseQuestion
+    """
+    if len(probabilities) == 0:
+        return None
+    return min(int(np.searchsorted(np.cumsum(probabilities), target)), len(probabilities) - 1)
+
+
+def next_question(alloc, practice=False, rng=None):
+    """
+    Choose the next question for the student, returns a dict like newAllocation,
+    with mss_id/permutation of the question
+    """
+    rng = rng or np.random.default_rng()
+    settings = alloc.settings
+
+    material = alloc.get_material()
+    if len(material) == 0:
+        raise NoQuestionsException("Lecture has no questions")
+
+    # Fetch most recent answers, for all versions of this stage
+    aq_rows = DBSession.execute("""
+        SELECT material_source_id, permutation, correct, grade
+          FROM answer
+         WHERE stage_id IN (SELECT stage_id FROM stage_lineage WHERE latest_stage_id = :stage_id)
+           AND user_id = :user_id
+      ORDER BY time_end DESC, time_offset DESC
+         LIMIT :limit
+    """, dict(
+        stage_id=alloc.db_stage.stage_id,
+        user_id=alloc.db_student.id,
+        limit=BIAS_HISTORY,
+    )).fetchall()[::-1]
+    grade = float(aq_rows[-1][3]) if aq_rows else 0
+
+    # NB: There's no historical questions server-side, so hist_sel doesn't apply
+    iaa_type = get_setting(settings, 'iaa_type', 'adaptive')
+    if iaa_type == 'exam':
+        if practice:
+            raise ValueError("Practice during an exam is not allowed")
+        (aq_length,) = DBSession.execute("""
+            SELECT COUNT(*)
+              FROM answer
+             WHERE stage_id IN (SELECT stage_id FROM stage_lineage WHERE latest_stage_id = :stage_id)
+               AND user_id = :user_id
+        """, dict(
+            stage_id=alloc.db_stage.stage_id,
+            user_id=alloc.db_student.id,
+        )).fetchone()
+        if aq_length >= len(material):
+            raise NoQuestionsException("You have answered all questions. Press 'Back to main menu' to choose another lecture")
+        chosen_i = aq_length
+    elif iaa_type == 'adaptive':
+        # Combine initial stats with stage stats
+        initial = dict((r[0], (r[1], r[2])) for r in DBSession.execute("""
+            SELECT material_source_id, initial_answered, initial_correct
+              FROM material_source
+             WHERE material_source_id = ANY(:mss_ids)
+        """, dict(
+            mss_ids=list(set(mss_id for mss_id, permutation in material)),
+        )))
+        stats = alloc.get_stats(alloc.to_public_ids(material))
+        chosen = np.fromiter((initial[m[0]][0] + s['stage_answered'] for m, s in zip(material, stats)), float, len(material))
+        correct = np.fromiter((initial[m[0]][1] + s['stage_correct'] for m, s in zip(material, stats)), float, len(material))
+
+        indexes, probabilities = question_distribution(
+            chosen,
+            correct,
+            question_bias([tuple(m) for m in material], [((r[0], r[1]), r[2]) for r in aq_rows]),
+            grade,
+            settings,
+            rng,
+        )
+        chosen_i = indexes[choose_question(probabilities, rng.random())]
+    else:
+        raise ValueError("Unknown IAA %s" % iaa_type)
+
+    return dict(
+        mss_id=material[chosen_i][0],
+        permutation=material[chosen_i][1],
+        allotted_time=qn_timeout(settings, grade),
+        grade_before=grade,
+        student_answer=dict(practice=True) if practice else {},
+    )
+
+
+def view_stage_next_question(request):
+    """
+    Choose the next question for the student, return it and it's material
+    """
+    db_stage = get_current_stage(request)
+    db_student = get_current_student(request)
+    alloc = get_allocation(getStudentSettings(db_stage, db_student), db_stage, db_student)
+
+    alloc_out = next_question(alloc, practice=bool(request.params.get('practice', False)))
+    out = stage_material(alloc, [(alloc_out.pop('mss_id'), alloc_out.pop('permutation'))])
+    alloc_out['uri'] = out['stats'][0]['uri']
+    out['allocation'] = alloc_out
+    return out
+
+
+def includeme(config):
+    config.add_view(view_stage_next_question, route_name='stage_next_question', renderer='columnar')
+    config.add_route('stage_next_question', '/stage/next-question')
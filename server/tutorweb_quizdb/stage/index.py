@@ -1,13 +1,22 @@
+import logging
 import time
 
-from tutorweb_quizdb.stage.utils import stage_url, get_current_stage
+from sqlalchemy.orm.exc import NoResultFound
+import transaction
+
+from tutorweb_quizdb import DBSession
+from tutorweb_quizdb.stage.utils import stage_url, get_current_stage, get_stages_by_path
 from tutorweb_quizdb.student import get_current_student
+from tutorweb_quizdb.syllabus import path_to_ltree
 from tutorweb_quizdb.lti import lti_replace_grade
 from .allocation import get_allocation
-from .answer_queue import sync_answer_queue
+from .answer_queue import sync_answer_queue, sync_answer_queue_delta
 from .setting import getStudentSettings, clientside_settings
 
 
+log = logging.getLogger(__name__)
+
+
 class IncorrectUserException(Exception):
     status_code = 400
 
@@ -29,6 +38,15 @@ def alloc_for_view(request):
     return get_allocation(settings, db_stage, db_student)
 
 
+def check_incoming_user(alloc, incoming):
+    """Make sure the client isn't trying to sync another user's drills"""
+    if 'user' in incoming and alloc.db_student.user_name != incoming['user']:
+        raise IncorrectUserException("You are logged in as %s, but have drills for %s downloaded. Log out and start again" % (
+            alloc.db_student.user_name,
+            incoming['user'],
+        ))
+
+
 def stage_index(request):
     """
     Get all details for a stage
@@ -37,33 +55,56 @@ def stage_index(request):
 
     # Parse incoming JSON body
     incoming = request.json_body if request.body else {}
-    if 'user' in incoming and alloc.db_student.user_name != incoming['user']:
-        raise IncorrectUserException("You are logged in as %s, but have drills for %s downloaded. Log out and start again" % (
-            alloc.db_student.user_name,
-            incoming['user'],
-        ))
+    check_incoming_user(alloc, incoming)
 
-    # Work out how far off client clock is to ours, to nearest 10s (we're interested in clock-setting issues, request-timing)
-    time_offset = round(time.time() - incoming.get('current_time', time.time()), -2)
+    # NB: Concurrent syncs (retries, other tabs) are safe, answer_client_identity stops them inserting an answer twice
+    return stage_sync(alloc, incoming, request.params['path'])
 
-    # Sync answer queue
-    (answer_queue, additions) = sync_answer_queue(alloc, incoming.get('answerQueue', []), time_offset)
 
-    # Sync LTI if possible
+def lti_passback(alloc, answer_queue):
+    """Send the student's latest grade in (answer_queue) to any LTI, once the transaction commits"""
     if len(answer_queue) > 0:
         lti_replace_grade(alloc.db_stage, alloc.db_student, answer_queue[-1].get('grade_after', 0))
 
+
+def stage_sync(alloc, incoming, path, lti=True):
+    """
+    Sync (incoming) with the DB, return all details for the stage at (path).
+    lti: False if the caller will do lti_passback itself
+    """
+    # Work out how far off client clock is to ours, to nearest 10s (we're interested in clock-setting issues, request-timing)
+    time_offset = round(time.time() - incoming.get('current_time', time.time()), -2)
+
+    # Sync answer queue, just sending changes if the client understands sync_cursor
+    if 'sync_cursor' in incoming:
+        (answer_queue, additions, aq_length, sync_cursor) = sync_answer_queue_delta(
+            alloc,
+            incoming.get('answerQueue', []),
+            time_offset,
+            incoming['sync_cursor'],
+        )
+    else:
+        (answer_queue, additions) = sync_answer_queue(alloc, incoming.get('answerQueue', []), time_offset)
+        aq_length = len(answer_queue)
+        sync_cursor = None
+
+    # Now we know how many answers there are, store anything needed to serve material until the next refresh
+    alloc.update_bank()
+
+    if lti:
+        lti_passback(alloc, answer_queue)
+
     # If we've gone over a refresh interval, tell client to throw away questions
-    if alloc.should_refresh_questions(answer_queue, additions):
+    if alloc.should_refresh_questions(aq_length, additions):
         questions = []
     else:
         # Get new stats for each question, update
         questions = incoming.get('questions', [])
         update_stats(alloc, questions)
 
-    return dict(
-        uri=stage_url(path=request.params['path']),
-        path=request.params['path'],
+    out = dict(
+        uri=stage_url(path=path),
+        path=path,
         user=alloc.db_student.username,
         title=alloc.db_stage.title,
         settings=clientside_settings(alloc.settings),
@@ -72,8 +113,62 @@ def stage_index(request):
         answerQueue=answer_queue,
         time_offset=time_offset,
     )
+    if sync_cursor is not None:
+        # answerQueue only contains changes, client should merge with what it has
+        out['sync_cursor'] = sync_cursor
+    return out
+
+
+def stage_sync_many(request):
+    """
+    Sync many stages in one request, e.g. all of a student's subscriptions
+
+    Body is {"stages": [...]}, each what stage_index would get as a body, plus "path".
+    Returns {"stages": [...]}, each what stage_index would return, or
+    {"path": path, "error": {"type": ..., "message": ...}} if that stage failed.
+    """
+    db_student = get_current_student(request)
+    incoming_stages = request.json.get('stages', [])
+
+    # Fetch everything we can for all stages up front
+    db_stages = get_stages_by_path(incoming['path'] for incoming in incoming_stages)
+    lti_stage_ids = set(x[0] for x in DBSession.execute(
+        "SELECT stage_id FROM lti_sourcedid WHERE user_id = :user_id",
+        dict(user_id=db_student.id),
+    ))
+
+    out = []
+    for incoming in incoming_stages:
+        # Each stage gets a savepoint, so a failure doesn't lose everything else
+        savepoint = transaction.savepoint()
+        try:
+            if incoming['path'] not in db_stages:
+                raise NoResultFound("Unknown stage %s" % incoming['path'])
+            db_stage = db_stages[incoming['path']]
+            alloc = get_allocation(getStudentSettings(db_stage, db_student), db_stage, db_student)
+            check_incoming_user(alloc, incoming)
+            stage_out = stage_sync(
+                alloc,
+                incoming,
+                str(path_to_ltree(incoming['path'])),  # NB: Older clients use the stage URL as a path
+                lti=False,
+            )
+            if db_stage.stage_id in lti_stage_ids:
+                # NB: Only once the sync has worked, rolling back the savepoint won't cancel the grade post
+                lti_passback(alloc, stage_out['answerQueue'])
+        except Exception as e:
+            log.exception("Failed to sync %s" % incoming['path'])
+            savepoint.rollback()
+            stage_out = dict(path=incoming['path'], error=dict(
+                type=e.__class__.__name__,
+                message=str(e),
+            ))
+        out.append(stage_out)
+    return dict(stages=out)
 
 
 def includeme(config):
-    config.add_view(stage_index, route_name='stage_index', renderer='json')
+    config.add_view(stage_index, route_name='stage_index', renderer='columnar')
     config.add_route('stage_index', '/stage')
+    config.add_view(stage_sync_many, route_name='stage_sync_many', renderer='columnar')
+    config.add_route('stage_sync_many', '/stage/sync-many')
@@ -1,5 +1,5 @@
 from tutorweb_quizdb import DBSession, Base
-from tutorweb_quizdb.material.render import material_render
+from tutorweb_quizdb.material.render import material_render_many
 from tutorweb_quizdb.student import get_current_student, student_is_vetted
 from .allocation import get_allocation
 from .index import update_stats
@@ -44,22 +44,23 @@ def stage_material(alloc, requested_ids):
     """Turn list of (mss_id, permutation) or public ID into a structure with both material stats and data"""
     # Given public IDs, make them mss_id/permutation tuples
     if len(requested_ids) > 0 and isinstance(requested_ids[0], str):
-        requested_ids = [alloc.from_public_id(x) for x in requested_ids]
+        requested_ids = alloc.from_public_ids(requested_ids)
 
     # Turn tuples into DB objects
     requested_material = [
         (DBSession.query(Base.classes.material_source).filter_by(material_source_id=mss_id).one(), permutation)
         for mss_id, permutation in requested_ids
     ]
+    uris = alloc.to_public_ids((ms.material_source_id, permutation) for ms, permutation in requested_material)
 
     out = dict(
         stats=[
             dict(
-                uri=alloc.to_public_id(ms.material_source_id, permutation),
+                uri=uri,
                 initial_answered=ms.initial_answered,
                 initial_correct=ms.initial_correct,
                 _type='regular',  # TODO: ...or historical?
-            ) for ms, permutation in requested_material
+            ) for (ms, permutation), uri in zip(requested_material, uris)
         ],
         data={},
     )
@@ -69,15 +70,24 @@ def stage_material(alloc, requested_ids):
         (ms for ms, _ in requested_material),
         alloc.db_student
     )
-    for ms, permutation in requested_material:
-        rendered = material_render(ms, permutation, student_dataframes[ms.bank])
-
+    prerendered = alloc.get_rendered((ms.material_source_id, permutation) for ms, permutation in requested_material)
+    rendered_list = [prerendered.get((ms.material_source_id, permutation), None) for ms, permutation in requested_material]
+
+    # Render everything that wasn't prerendered in one batch
+    to_render = [i for i, rendered in enumerate(rendered_list) if rendered is None]
+    for i, rendered in zip(to_render, material_render_many([
+        (requested_material[i][0], requested_material[i][1], student_dataframes[requested_material[i][0].bank])
+        for i in to_render
+    ])):
+        rendered_list[i] = rendered
+
+    for (ms, permutation), uri, rendered in zip(requested_material, uris, rendered_list):
         if 'type.template' in ms.material_tags and permutation < 0:
             # It's a user-generated question, add in special review boxes for vetted reviewers
             if student_is_vetted(alloc.db_student, alloc.db_stage):
                 rendered['review_questions'].insert(0, VETTED_REVIEW_TEMPLATE)
 
-        out['data'][alloc.to_public_id(ms.material_source_id, permutation)] = rendered
+        out['data'][uri] = rendered
     return out
 
 
@@ -98,5 +108,5 @@ def view_stage_material(request):
 
 
 def includeme(config):
-    config.add_view(view_stage_material, route_name='stage_material', renderer='json')
+    config.add_view(view_stage_material, route_name='stage_material', renderer='columnar')
     config.add_route('stage_material', '/stage/material')
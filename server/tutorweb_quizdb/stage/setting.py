@@ -2,11 +2,15 @@
 See ``doc/settings.rst`` for more details on the structures used here
 """
 import itertools
+import json
 import random
 
 import numpy.random
+import transaction
+from zope.sqlalchemy import mark_changed
 
 from tutorweb_quizdb import DBSession, Base
+from tutorweb_quizdb.lru import LRUCache
 
 
 # Randomly-chosen questions that should result in an integer value
@@ -26,11 +30,13 @@ INTEGER_SETTINGS = set((
     'ugreview_minreviews',
 ))
 STRING_SETTINGS = set((
+    'allocation_bank_selection',
     'allocation_encryption_key',
     'iaa_mode',
     'grade_algorithm',
 ))
 SERVERSIDE_SETTINGS = set((
+    'allocation_bank_selection',
     'allocation_encryption_key',
     'allocation_seed',
     'prob_template_eval',
@@ -48,6 +54,10 @@ GLOBAL_SPECS = dict(
     allocation_seed=dict(min=0, max=2**32),
 )
 
+# Process-wide cache of (stage_id, user_id) -> settings, see getStudentSettings
+SETTINGS_CACHE_SIZE = 65536
+SETTINGS_CACHE = LRUCache(SETTINGS_CACHE_SIZE)
+
 
 class SettingSpec():
     """
@@ -128,19 +138,87 @@ class SettingSpec():
         # If we get here, there's something wrong with spec or is_customised
         raise ValueError("Should be customised, but found no means to!")
 
+    def choose_values(self, count):
+        """Return a list of (count) new values according to our restrictions, see choose_value"""
+        if not self.is_customised():
+            return [self.choose_value()] * count
+
+        if self.key in STRING_SETTINGS:
+            if self.spec.get('randstring', None) is not None:
+                chars = numpy.random.randint(32, 128, size=(count, self.spec['randstring']))
+                return ["".join(chr(c) for c in row) for row in chars]
+            raise ValueError("Cannot choose random value for setting %s" % self.key)
+
+        if self.spec.get('shape', None) is not None:
+            # Fetch values according to a gamma function, re-choosing any out of range
+            out = numpy.empty(count)
+            todo = numpy.arange(count)
+            for i in range(10):
+                out[todo] = numpy.random.gamma(shape=float(self.spec['shape']), scale=float(self.spec['value']), size=len(todo))
+                if self.spec.get('max', None) is None:
+                    break
+                todo = todo[(out[todo] < (self.spec.get('min', None) or 0)) | (out[todo] >= self.spec['max'])]
+                if len(todo) == 0:
+                    break
+            else:
+                raise ValueError("Cannot pick value that satisfies shape %f / value %f / min %f / max %f" % (
+                    self.spec['shape'],
+                    self.spec['value'],
+                    self.spec['min'],
+                    self.spec['max'],
+                ))
+        elif self.spec.get('max', None) is not None:
+            # Uniform random choice
+            out = numpy.random.uniform(self.spec.get('min', 0) or 0, self.spec['max'], size=count)
+        else:
+            raise ValueError("Should be customised, but found no means to!")
+
+        if self.key in INTEGER_SETTINGS:
+            return [str(int(round(x))) for x in out]
+        return [str(float(x)) for x in out]
+
 
 def getStudentSettings(db_stage, db_user):
-    """Fetch settings for this lecture, customised for the student"""
+    """
+    Fetch settings for this lecture, customised for the student
+
+    Once a student's settings are stored, they are cached by (stage_id, user_id).
+    Changing a stage's settings makes a new version of the stage, with a new
+    stage_id, so cached settings never go stale. Stages with variants aren't
+    cached, as whether a variant applies depends on the student's
+    subscriptions, which can change without the stage changing.
+    """
+    cache_key = (db_stage.stage_id, db_user.id)
+    cached = SETTINGS_CACHE.get(cache_key)
+    if cached is not None:
+        return dict(cached)
+
+    # Fetch settings stored for this student in this lecture, this stage first, then most recent
+    stored = DBSession.execute("""
+        SELECT st.stage_id, st.stage_setting_spec, uss.settings
+          FROM user_stage_setting uss
+          JOIN stage st ON st.stage_id = uss.stage_id
+         WHERE uss.user_id = :user_id
+           AND st.syllabus_id = :syllabus_id
+      ORDER BY st.stage_id = :stage_id DESC, st.version DESC
+    """, dict(
+        stage_id=db_stage.stage_id,
+        syllabus_id=db_stage.syllabus_id,
+        user_id=db_user.id,
+    )).fetchall()
+
     # Copy any existing student-specific settings in first
-    out = {}
-    for ss in DBSession.query(Base.classes.stage_setting).filter_by(
-        stage=db_stage,
-        user=db_user,
-    ):
-        out[ss.key] = ss.value
+    out = dict(stored[0][2]) if len(stored) > 0 and stored[0][0] == db_stage.stage_id else {}
+    previous = [(spec, settings) for stage_id, spec, settings in stored if stage_id != db_stage.stage_id]
+    new_settings = {}
 
     # Function for testing applicability of variants
     va_cache = {}
+    cacheable = not any(
+        k.startswith('variant:')
+        for spec in (db_stage.stage_setting_spec or {}).values()
+        for k in (spec or {}).keys()
+    )
 
     def _variantApplicable(variant):
         """Is this variant applicable to this student?"""
@@ -170,42 +248,168 @@ def getStudentSettings(db_stage, db_user):
             out[key] = spec.choose_value()
             continue
 
-        # Find any previous settings for this stage/student
-        x = (
-            DBSession.query(Base.classes.stage, Base.classes.stage_setting)
-            .filter(Base.classes.stage_setting.stage_id == Base.classes.stage.stage_id)
-            .filter(Base.classes.stage_setting.key == key)
-            # For this student
-            .filter(Base.classes.stage_setting.user_id == db_user.id)
-            # For this lecture
-            .filter_by(syllabus_id=db_stage.syllabus_id)
-            # But not this stage
-            .filter(Base.classes.stage.stage_id != db_stage.stage_id)
-            # NB: Ideally we traverse list, but instead we assume versions increment
-            .order_by(Base.classes.stage.version.desc())
-        ).all()
-        if len(x) > 0:
-            (old_stage, old_ss) = x[0]
+        # Find any previous settings for this student in this lecture, but not this stage
+        # NB: Ideally we traverse list, but instead we assume versions increment
+        old_stage_spec, old_settings = next((p for p in previous if key in p[1]), (None, None))
+        if old_settings is not None:
             if key in GLOBAL_SPECS:
                 old_spec = SettingSpec(key, GLOBAL_SPECS[key], _variantApplicable)
             else:
-                old_spec = SettingSpec(key, old_stage.stage_setting_spec.get(key, {}), _variantApplicable)
+                old_spec = SettingSpec(key, (old_stage_spec or {}).get(key, {}), _variantApplicable)
             equivalent = spec.equivalent(old_spec)
         else:
             equivalent = False
 
         # If it's equivalent, re-use it. Otherwise choose a new value
-        out[key] = old_ss.value if equivalent else spec.choose_value()
-        DBSession.add(Base.classes.stage_setting(
+        out[key] = new_settings[key] = old_settings[key] if equivalent else spec.choose_value()
+
+    if len(new_settings) > 0:
+        # NB: If a concurrent request got there first, keep what it chose
+        (stored_settings,) = DBSession.execute("""
+            INSERT INTO user_stage_setting (stage_id, user_id, settings)
+                 VALUES (:stage_id, :user_id, CAST(:settings AS JSONB))
+            ON CONFLICT (stage_id, user_id) DO UPDATE SET settings = EXCLUDED.settings || user_stage_setting.settings
+              RETURNING settings
+        """, dict(
             stage_id=db_stage.stage_id,
             user_id=db_user.id,
-            key=key,
-            value=out[key],
-        ))
-    DBSession.flush()
+            settings=json.dumps(new_settings),
+        )).fetchone()
+        out.update(stored_settings)
+        mark_changed(DBSession())
+        if cacheable:
+            # Cache once the transaction commits, so we never cache values that get rolled back
+            transaction.get().addAfterCommitHook(_cache_settings, args=(cache_key, dict(out)))
+    elif cacheable:
+        SETTINGS_CACHE.put(cache_key, out)
+    return dict(out)
+
+
+def _cache_settings(success, cache_key, settings):
+    """After-commit hook for getStudentSettings, cache (settings) if they were stored"""
+    if success:
+        SETTINGS_CACHE.put(cache_key, settings)
+
+
+def assign_student_settings(db_stage, user_ids=None):
+    """
+    Choose settings for all students subscribed to (db_stage) without them,
+    or just (user_ids), in one batch & store them in one query. This saves
+    getStudentSettings choosing them as each student first visits.
+
+    Like getStudentSettings, values are carried over from earlier stages in
+    the lecture if their spec is equivalent. Variants are not applied.
+    Returns the number of students assigned settings.
+    """
+    if user_ids is None:
+        user_ids = [r[0] for r in DBSession.execute("""
+            SELECT DISTINCT sub.user_id
+              FROM stage st
+              JOIN syllabus lec ON lec.syllabus_id = st.syllabus_id
+              JOIN syllabus sy ON lec.path <@ sy.path
+              JOIN subscription sub ON sub.syllabus_id = sy.syllabus_id
+             WHERE st.stage_id = :stage_id
+        """, dict(stage_id=db_stage.stage_id))]
+    user_ids = [r[0] for r in DBSession.execute("""
+        SELECT u.user_id
+          FROM UNNEST(CAST(:user_ids AS INTEGER[])) u(user_id)
+         WHERE NOT EXISTS (SELECT 1 FROM user_stage_setting uss WHERE uss.stage_id = :stage_id AND uss.user_id = u.user_id)
+      ORDER BY u.user_id
+    """, dict(stage_id=db_stage.stage_id, user_ids=list(user_ids)))]
+    if len(user_ids) == 0:
+        return 0
+
+    # Settings stored for these students in earlier stages of this lecture, most recent first
+    previous = {}
+    for user_id, stage_id, spec, settings in DBSession.execute("""
+        SELECT uss.user_id, st.stage_id, st.stage_setting_spec, uss.settings
+          FROM user_stage_setting uss
+          JOIN stage st ON st.stage_id = uss.stage_id
+         WHERE uss.user_id = ANY(:user_ids)
+           AND st.syllabus_id = :syllabus_id
+           AND st.stage_id != :stage_id
+      ORDER BY uss.user_id, st.version DESC
+    """, dict(
+        stage_id=db_stage.stage_id,
+        syllabus_id=db_stage.syllabus_id,
+        user_ids=user_ids,
+    )):
+        previous.setdefault(user_id, []).append((stage_id, spec, settings))
+
+    out = dict((user_id, {}) for user_id in user_ids)
+    for key, spec in itertools.chain(GLOBAL_SPECS.items(), (db_stage.stage_setting_spec or {}).items()):
+        spec = SettingSpec(key, spec)
+        if not spec.is_customised():
+            # Not stored, getStudentSettings will use the global value
+            continue
+
+        # Re-use the most recent previous value, if the spec it was chosen with is equivalent
+        equivalent = {}
+        new_user_ids = []
+        for user_id in user_ids:
+            old_stage_id, old_stage_spec, old_settings = next((p for p in previous.get(user_id, []) if key in p[2]), (None, None, None))
+            if old_settings is not None and old_stage_id not in equivalent:
+                equivalent[old_stage_id] = spec.equivalent(SettingSpec(
+                    key,
+                    GLOBAL_SPECS[key] if key in GLOBAL_SPECS else (old_stage_spec or {}).get(key, {}),
+                ))
+            if old_settings is not None and equivalent[old_stage_id]:
+                out[user_id][key] = old_settings[key]
+            else:
+                new_user_ids.append(user_id)
+
+        # Choose new values for everyone else
+        for user_id, value in zip(new_user_ids, spec.choose_values(len(new_user_ids))):
+            out[user_id][key] = value
+
+    # NB: If a student got there first, keep what they have
+    DBSession.execute("""
+        INSERT INTO user_stage_setting (stage_id, user_id, settings)
+             SELECT :stage_id, u.user_id, CAST(u.settings AS JSONB)
+               FROM UNNEST(CAST(:user_ids AS INTEGER[]), CAST(:settings AS TEXT[])) u(user_id, settings)
+        ON CONFLICT DO NOTHING
+    """, dict(
+        stage_id=db_stage.stage_id,
+        user_ids=user_ids,
+        settings=[json.dumps(out[user_id]) for user_id in user_ids],
+    ))
+    mark_changed(DBSession())
+    return len(user_ids)
+
+
+def assign_settings_within(path):
+    """Assign settings for all current stages within (path), returns a list of (stage, students assigned)"""
+    stage_ids = [r[0] for r in DBSession.execute("""
+        SELECT st.stage_id
+          FROM stage st
+          JOIN syllabus sy ON sy.syllabus_id = st.syllabus_id
+         WHERE sy.path <@ :path
+           AND st.next_stage_id IS NULL
+      ORDER BY sy.path, st.stage_name
+    """, dict(path=str(path)))]
+    out = []
+    for stage_id in stage_ids:
+        db_stage = DBSession.query(Base.classes.stage).get(stage_id)
+        out.append((db_stage, assign_student_settings(db_stage)))
     return out
 
 
 def clientside_settings(settings):
     """Filter result of getStudentSettings, returning only settings relevant to client side"""
     return dict((k, v) for k, v in settings.items() if k not in SERVERSIDE_SETTINGS)
+
+
+def script_stage_settings_assign():
+    from tutorweb_quizdb import setup_script
+
+    argparse_arguments = [
+        dict(description='Choose settings for every subscribed student in all stages within a tutorial/lecture, ahead of them visiting'),
+        dict(
+            name='path',
+            help='Tutorial/lecture path',
+        ),
+    ]
+
+    with setup_script(argparse_arguments) as env:
+        for db_stage, count in assign_settings_within(env['args'].path):
+            print("%s/%s: %d students assigned settings" % (db_stage.syllabus.path, db_stage.stage_name, count))
@@ -42,3 +42,29 @@ def get_current_stage(request, optional=False):
             .filter(Base.classes.syllabus.host_id == ACTIVE_HOST)
             .filter(Base.classes.syllabus.path == path[:-1])
             .one())
+
+
+def get_stages_by_path(paths):
+    """
+    Find the current stage objects for many stage paths in one query, return
+    a dict of path -> stage. Paths that don't match a stage are left out
+    """
+    wanted = {}
+    for path in paths:
+        ltree = path_to_ltree(path)
+        wanted[(ltree[:-1], str(ltree[-1]))] = path
+    if len(wanted) == 0:
+        return {}
+
+    out = {}
+    for db_stage, db_syllabus_path in (
+            DBSession.query(Base.classes.stage, Base.classes.syllabus.path)
+            .filter_by(next_stage_id=None)
+            .join(Base.classes.syllabus)
+            .filter(Base.classes.syllabus.host_id == ACTIVE_HOST)
+            .filter(Base.classes.syllabus.path.in_(set(k[0] for k in wanted.keys())))
+            .filter(Base.classes.stage.stage_name.in_(set(k[1] for k in wanted.keys())))):
+        key = (db_syllabus_path, db_stage.stage_name)
+        if key in wanted:
+            out[wanted[key]] = db_stage
+    return out
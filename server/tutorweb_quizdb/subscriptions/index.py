@@ -161,9 +161,9 @@ def view_subscription_remove(request):
 
 
 def includeme(config):
-    config.add_view(view_subscription_list, route_name='view_subscription_list', renderer='json')
+    config.add_view(view_subscription_list, route_name='view_subscription_list', renderer='columnar')
     config.add_route('view_subscription_list', '/subscriptions/list')
-    config.add_view(view_subscription_add, route_name='view_subscription_add', renderer='json')
+    config.add_view(view_subscription_add, route_name='view_subscription_add', renderer='columnar')
     config.add_route('view_subscription_add', '/subscriptions/add')
-    config.add_view(view_subscription_remove, route_name='view_subscription_remove', renderer='json')
+    config.add_view(view_subscription_remove, route_name='view_subscription_remove', renderer='columnar')
     config.add_route('view_subscription_remove', '/subscriptions/remove')
@@ -39,6 +39,7 @@
 }
 """
 import json
+import time
 
 from sqlalchemy.sql import expression
 from sqlalchemy.orm.exc import NoResultFound
@@ -46,6 +47,8 @@ from sqlalchemy_utils import Ltree
 from sqlalchemy_utils.types.ltree import LQUERY
 
 from tutorweb_quizdb import DBSession, Base, ACTIVE_HOST
+from tutorweb_quizdb.material.stage_link import count_stage_material
+from tutorweb_quizdb.stage.setting import assign_settings_within
 from tutorweb_quizdb.student import get_group
 
 
@@ -113,6 +116,7 @@ def lec_import(tut_struct):
         db_lecs[s.path] = s
 
     # Add all lectures & stages
+    new_stages = []
     for lec_name, lec_title, lec_href, *_unused_ in (l + [None, None] for l in tut_struct['lectures']):
         db_lec = upsert_syllabus(path + Ltree(lec_name), lec_title, lec_href, tut_struct.get('requires_group', None))
         if path + Ltree(lec_name) in db_lecs:
@@ -142,13 +146,14 @@ def lec_import(tut_struct):
                         DBSession.flush()
                     continue
             # Add it, let the database worry about bumping version
-            DBSession.add(Base.classes.stage(
+            new_stages.append(Base.classes.stage(
                 syllabus=db_lec,
                 stage_name=stage_tmpl['name'],
                 title=stage_tmpl['title'],
                 material_tags=material_tags,
                 stage_setting_spec=setting_spec
             ))
+            DBSession.add(new_stages[-1])
             DBSession.flush()
 
     # Tidy up any unused lectures
@@ -157,21 +162,26 @@ def lec_import(tut_struct):
         if s.requires_group_id != deleted_id:
             s.requires_group_id = deleted_id
     DBSession.flush()
+    return new_stages
 
 
 def multiple_lec_import(data):
-    """Import a list of lectures, allowing previous lectures to define defaults"""
+    """
+    Import a list of lectures, allowing previous lectures to define defaults
+    Returns list of new stages
+    """
     if not isinstance(data, list):
         # Only one lecture, just import it
-        lec_import(data)
-        return
+        return lec_import(data)
 
+    new_stages = []
     for i in range(len(data)):
         # Lecture i should be a combination of itself and everything before it
         merged = {}
         for j in range(i + 1):
             merged.update(data[j])
-        lec_import(merged)
+        new_stages.extend(lec_import(merged))
+    return new_stages
 
 
 def script():
@@ -187,8 +197,23 @@ def script():
             type=argparse.FileType('r'),
             nargs='*',
             default=sys.stdin),
+        dict(
+            name='--assign-settings',
+            help="Choose settings for all subscribed students now, instead of when they first visit",
+            action="store_true",
+            default=False,
+        ),
     ]
 
     with setup_script(argparse_arguments) as env:
         for f in env['args'].infile:
-            multiple_lec_import(json.load(f))
+            start = time.perf_counter()
+            data = json.load(f)
+            new_stages = multiple_lec_import(data)
+            out = count_stage_material(stage_ids=[s.stage_id for s in new_stages])
+            out['elapsed'] = time.perf_counter() - start
+            print("%s: %d new stages, %d stage_material links added in %.3fs" % (f.name, out['stages'], out['added'], out['elapsed']))
+            if env['args'].assign_settings:
+                for path in set(d['path'] for d in (data if isinstance(data, list) else [data]) if 'path' in d):
+                    for db_stage, count in assign_settings_within(path):
+                        print("%s/%s: %d students assigned settings" % (db_stage.syllabus.path, db_stage.stage_name, count))
@@ -0,0 +1,177 @@
+import itertools
+import time
+
+import numpy as np
+from sqlalchemy import text
+from zope.sqlalchemy import mark_changed
+
+from tutorweb_quizdb import DBSession
+from tutorweb_quizdb.stage.allocation import OriginalAllocation
+from tutorweb_quizdb.stage.iaa import answer_queue_grades
+from tutorweb_quizdb.stage.setting import SettingSpec
+
+# Settings that affect a student's grade
+GRADE_SETTINGS = ('grade_algorithm', 'grade_alpha', 'grade_s', 'grade_nmin', 'grade_nmax', 'allocation_method')
+
+# Rows to fetch from the server-side cursor at a time, and answers to update at once
+FETCH_SIZE = 10000
+
+# Stored grades are NUMERIC(5, 3), anything closer than this is the same grade
+GRADE_TOLERANCE = 0.0005
+
+
+def grade_settings(path):
+    """
+    Fetch settings that affect grading for all stages within (path).
+    Returns (stage_settings, user_settings) dicts, stage_id -> settings and
+    (stage_id, user_id) -> settings the student has been assigned
+    """
+    stage_settings = {}
+    for stage_id, spec in DBSession.execute("""
+        SELECT st.stage_id, st.stage_setting_spec
+          FROM stage st
+          JOIN syllabus sy ON sy.syllabus_id = st.syllabus_id
+         WHERE sy.path <@ :path
+    """, dict(path=str(path))):
+        stage_settings[stage_id] = {}
+        for key in GRADE_SETTINGS:
+            setting_spec = SettingSpec(key, (spec or {}).get(key, None))
+            if not setting_spec.is_customised():
+                stage_settings[stage_id][key] = setting_spec.choose_value()
+
+    user_settings = {}
+    for stage_id, user_id, settings in DBSession.execute("""
+        SELECT uss.stage_id, uss.user_id, uss.settings
+          FROM user_stage_setting uss
+         WHERE uss.stage_id = ANY(:stage_ids)
+    """, dict(stage_ids=list(stage_settings.keys()))):
+        user_settings[(stage_id, user_id)] = dict((k, v) for k, v in settings.items() if k in GRADE_SETTINGS)
+    return stage_settings, user_settings
+
+
+def stage_question_count(stage_id, settings):
+    """How many questions a student would have had in (stage_id), for ratiocorrect"""
+    (count,) = DBSession.execute("""
+        SELECT COALESCE(SUM(ms.permutation_count), 0)
+          FROM stage_material_sources sms
+          JOIN material_source ms ON ms.material_source_id = sms.material_source_id
+         WHERE sms.stage_id = :stage_id
+           AND ms.next_material_source_id IS NULL
+    """, dict(stage_id=stage_id)).fetchone()
+    if (settings.get('allocation_method', None) or 'original') == 'original':
+        count = min(count, OriginalAllocation.question_cap)
+    return count
+
+
+def write_grades(updates):
+    """Write list of (answer_id, user_id, syllabus_id, stage_name, grade), triggers update user_stage_progress to match"""
+    if len(updates) == 0:
+        return
+    DBSession.execute("""
+        UPDATE answer a
+           SET grade = u.grade
+          FROM UNNEST(CAST(:answer_ids AS INTEGER[]), CAST(:grades AS NUMERIC[])) u(answer_id, grade)
+         WHERE a.answer_id = u.answer_id
+    """, dict(
+        answer_ids=[u[0] for u in updates],
+        grades=[u[4] for u in updates],
+    ))
+    mark_changed(DBSession())
+
+
+def regrade(path, update=False, summary=None):
+    """
+    Recompute grades for every answer within (path), as the client would
+    have, yielding (answer_id, lecture path, stage_name, user_name, time_end,
+    stored grade, computed grade) for every answer where they differ.
+    If (update) is true, replace the stored grades with the computed ones.
+    (summary), if given, is a dict filled in with counts & time taken.
+    """
+    start = time.perf_counter()
+    if summary is None:
+        summary = {}
+    summary.update(answers=0, queues=0, discrepancies=0)
+    stage_settings, user_settings = grade_settings(path)
+    question_counts = {}
+    updates = []
+
+    # Stream all answers, grouped by student & stage (including older versions of that stage)
+    result = DBSession.connection().execution_options(stream_results=True).execute(text("""
+        SELECT a.answer_id, a.user_id, st.syllabus_id, st.stage_name, a.stage_id
+             , sy.path, u.user_name, a.time_end, a.correct, a.grade
+          FROM answer a
+          JOIN stage st ON st.stage_id = a.stage_id
+          JOIN syllabus sy ON sy.syllabus_id = st.syllabus_id
+          JOIN "user" u ON u.user_id = a.user_id
+         WHERE sy.path <@ :path
+      ORDER BY a.user_id, st.syllabus_id, st.stage_name, a.time_end, a.time_offset
+    """), path=str(path))
+
+    def all_rows():
+        while True:
+            rows = result.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            yield from rows
+
+    for (user_id, syllabus_id, stage_name), rows in itertools.groupby(all_rows(), lambda r: (r[1], r[2], r[3])):
+        rows = list(rows)
+        correct = np.fromiter((np.nan if r[8] is None else float(r[8]) for r in rows), float, len(rows))
+        stored = np.fromiter((float(r[9]) for r in rows), float, len(rows))
+        computed = np.empty(len(rows))
+
+        # Each answer is graded with the settings from the version of the stage it was answered in
+        stage_ids = np.fromiter((r[4] for r in rows), int, len(rows))
+        for stage_id in np.unique(stage_ids):
+            stage_id = int(stage_id)
+            settings = dict(stage_settings[stage_id])
+            settings.update(user_settings.get((stage_id, user_id), {}))
+            if settings.get('grade_algorithm', None) == 'ratiocorrect' and stage_id not in question_counts:
+                question_counts[stage_id] = stage_question_count(stage_id, settings)
+            grades = answer_queue_grades(correct, settings, question_counts.get(stage_id, None))
+            computed[stage_ids == stage_id] = grades[stage_ids == stage_id]
+
+        for i in np.flatnonzero(np.abs(stored - computed) > GRADE_TOLERANCE):
+            r = rows[i]
+            summary['discrepancies'] += 1
+            yield (r[0], str(r[5]), r[3], r[6], r[7], float(r[9]), float(computed[i]))
+            if update:
+                updates.append((r[0], user_id, syllabus_id, stage_name, float(computed[i])))
+        summary['answers'] += len(rows)
+        summary['queues'] += 1
+
+        if len(updates) >= FETCH_SIZE:
+            write_grades(updates)
+            updates = []
+    result.close()
+    write_grades(updates)
+    summary['elapsed'] = time.perf_counter() - start
+
+
+def script_syllabus_regrade():
+    import csv
+    import sys
+    from tutorweb_quizdb import setup_script
+
+    argparse_arguments = [
+        dict(description='Recompute grades for all answers within a tutorial/lecture path, output any that differ'),
+        dict(
+            name="--update",
+            help="Replace stored grades with recomputed grades",
+            action="store_true",
+            default=False,
+        ),
+        dict(
+            name='path',
+            help='Tutorial/lecture path, regrade answers from all stages within',
+        ),
+    ]
+
+    with setup_script(argparse_arguments) as env:
+        out_csv = csv.writer(sys.stdout)
+        out_csv.writerow(['answer_id', 'lecture', 'stage', 'student', 'time', 'grade', 'computed grade'])
+
+        summary = {}
+        for r in regrade(env['args'].path, update=env['args'].update, summary=summary):
+            out_csv.writerow(r)
+        sys.stderr.write("%(answers)d answers in %(queues)d answer queues, %(discrepancies)d discrepancies in %(elapsed).1fs\n" % summary)
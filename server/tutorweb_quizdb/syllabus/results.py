@@ -10,21 +10,18 @@ def result_summary(path=''):
     cols = set()
     data = collections.defaultdict(dict)
     for r in DBSession.execute("""
-       SELECT DISTINCT ON (sy.path, st.stage_name, u.user_name)
-              sy.path
+       SELECT sy.path
               -- NB: We don't care about stage version, stage_names are constant
-            , st.stage_name
+            , usp.stage_name
             , u.user_name
-            , a.grade
-         FROM answer a
-            , stage st
+            , usp.latest_grade grade
+         FROM user_stage_progress usp
             , syllabus sy
             , "user" u
-        WHERE a.stage_id = st.stage_id
-          AND st.syllabus_id = sy.syllabus_id
-          AND a.user_id = u.user_id
+        WHERE usp.syllabus_id = sy.syllabus_id
+          AND usp.user_id = u.user_id
           AND sy.path <@ :path
-     ORDER BY sy.path, st.stage_name, u.user_name, time_end DESC
+     ORDER BY sy.path, usp.stage_name, u.user_name
     """, dict(
         path=str(path)
     )):